@@ -24,8 +24,49 @@ CONFIG_COPY_CHILDREN                = 'copy_children'
 CONFIG_MAX_SPEED                    = 'max_speed'
 CONFIG_NUM_THREADS                  = 'num_threads'
 CONFIG_NUM_THREADS_DEFAULT          = 5
+# Adjust the number of concurrent downloads, between min_threads and
+# max_threads, to the measured throughput and error rate
+CONFIG_ADAPTIVE_CONCURRENCY         = 'adaptive_concurrency'
+CONFIG_ADAPTIVE_CONCURRENCY_DEFAULT = False
+CONFIG_MIN_THREADS                  = 'min_threads'
+CONFIG_MIN_THREADS_DEFAULT          = 1
+CONFIG_MAX_THREADS                  = 'max_threads'
+CONFIG_MAX_THREADS_DEFAULT          = 20
+# Size, in bytes, from which units are downloaded as several byte ranges in
+# parallel; 0 (the default) disables segmented downloads
+CONFIG_SEGMENTED_DOWNLOAD_THRESHOLD = 'segmented_download_threshold'
+CONFIG_DOWNLOAD_SEGMENTS            = 'download_segments'
+CONFIG_DOWNLOAD_SEGMENTS_DEFAULT    = 4
+# Spread package downloads across all the mirrors of the feed, instead of
+# downloading from the mirror the metadata came from
+CONFIG_STRIPE_MIRRORS               = 'stripe_mirrors'
+CONFIG_STRIPE_MIRRORS_DEFAULT       = False
+# Start syncs from the fastest mirror with the newest metadata, probing the
+# mirrors of the feed at most once every mirror_probe_ttl seconds
+CONFIG_PROBE_MIRRORS                = 'probe_mirrors'
+CONFIG_PROBE_MIRRORS_DEFAULT        = False
+CONFIG_MIRROR_PROBE_TTL             = 'mirror_probe_ttl'
+CONFIG_MIRROR_PROBE_TTL_DEFAULT     = 3600
+# Size of the pool extracting metadata from downloaded files; the number of
+# CPUs by default
+CONFIG_NUM_PROCESSING_WORKERS       = 'num_processing_workers'
 CONFIG_REMOVE_MISSING_UNITS         = 'remove_missing_units'
 CONFIG_REMOVE_MISSING_UNITS_DEFAULT = False
+# One of native, msiinfo, msidump
+CONFIG_METADATA_BACKEND             = 'metadata_backend'
+# Maximum number of entries in the metadata cache; 0 disables it
+CONFIG_METADATA_CACHE_SIZE          = 'metadata_cache_size'
+CONFIG_METADATA_CACHE_SIZE_DEFAULT  = 10000
+# Sync even if the upstream metadata did not change since the last sync
+CONFIG_FORCE_FULL_SYNC              = 'force_full_sync'
+CONFIG_FORCE_FULL_SYNC_DEFAULT      = False
+# Create synced units out of primary.xml, once the checksum is verified,
+# instead of extracting the metadata from the file
+CONFIG_TRUST_UPSTREAM_METADATA         = 'trust_upstream_metadata'
+CONFIG_TRUST_UPSTREAM_METADATA_DEFAULT = False
+# Fraction of trusted units extracted anyway, and compared with primary.xml
+CONFIG_TRUST_AUDIT_RATE                = 'trust_upstream_metadata_audit_rate'
+CONFIG_TRUST_AUDIT_RATE_DEFAULT        = 0.0
 
 # Distributor configuration key names
 CONFIG_SERVE_HTTP      = 'serve_http'
@@ -0,0 +1,133 @@
+"""
+Content-addressed cache for the tables extracted out of MSI/MSM files.
+
+The same installer is frequently uploaded to several repositories or synced
+from several feeds; extracting its metadata again produces the same result.
+Entries are keyed by the sha256 checksum and size of the file, and by the
+version of the extractor that produced them. The cache is a sqlite database
+in the Pulp working directory, bounded in size with LRU eviction.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from pulp.server import config as pulp_config
+from pulp_win.common import constants
+
+_LOGGER = logging.getLogger(__name__)
+
+CACHE_FILENAME = 'win_metadata_cache.sqlite'
+
+
+class MetadataCache(object):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metadata (
+            checksum TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            version TEXT NOT NULL,
+            data TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (checksum, size, version)
+        );
+        CREATE INDEX IF NOT EXISTS metadata_last_used
+            ON metadata (last_used);
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections cannot be shared with worker processes; they will
+        # open their own
+        return dict(path=self.path, max_entries=self.max_entries)
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['max_entries'])
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Return a cache as described by the importer config, or None if
+        caching is disabled.
+        """
+        max_entries = config.get(constants.CONFIG_METADATA_CACHE_SIZE)
+        if max_entries is None:
+            max_entries = constants.CONFIG_METADATA_CACHE_SIZE_DEFAULT
+        max_entries = int(max_entries)
+        if max_entries <= 0:
+            return None
+        working_dir = pulp_config.config.get('server', 'working_directory')
+        return cls(os.path.join(working_dir, CACHE_FILENAME), max_entries)
+
+    def _connection(self):
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # Listener callbacks may come in from the downloader's threads
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   check_same_thread=False)
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def get(self, checksum, size, version):
+        """
+        :return: the (tables, rows) tuple previously stored, or None
+        """
+        key = (checksum, size, version)
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    row = conn.execute(
+                        "SELECT data FROM metadata WHERE checksum=? AND "
+                        "size=? AND version=?", key).fetchone()
+                    if row is None:
+                        return None
+                    conn.execute(
+                        "UPDATE metadata SET last_used=? WHERE checksum=? "
+                        "AND size=? AND version=?", (time.time(), ) + key)
+        except sqlite3.Error as e:
+            _LOGGER.warning("Unable to read from metadata cache %s: %s",
+                            self.path, e)
+            return None
+        data = json.loads(row[0])
+        return set(data['tables']), data['rows']
+
+    def put(self, checksum, size, version, tables, rows):
+        data = json.dumps(dict(tables=sorted(tables), rows=rows))
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO metadata "
+                        "(checksum, size, version, data, last_used) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (checksum, size, version, data, time.time()))
+                    self._evict(conn)
+        except sqlite3.Error as e:
+            _LOGGER.warning("Unable to write to metadata cache %s: %s",
+                            self.path, e)
+
+    def _evict(self, conn):
+        count = conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        conn.execute(
+            "DELETE FROM metadata WHERE rowid IN ("
+            "SELECT rowid FROM metadata ORDER BY last_used LIMIT ?)",
+            (count - self.max_entries, ))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
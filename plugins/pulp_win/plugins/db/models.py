@@ -1,23 +1,42 @@
+import contextlib
+import hashlib
 import io
+import itertools
 import logging
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os
+import shutil
 import subprocess
+import tempfile
+from collections import namedtuple
 import mongoengine
+import pymongo
+from pymongo.errors import BulkWriteError
+from pulp.common import dateutils
 from pulp.plugins.util import verification
 from pulp.server import util
 from pulp.server.controllers import repository as repo_controller
-from pulp.server.db.model import FileContentUnit
+from pulp.server.db.model import FileContentUnit, RepositoryContentUnit
 from pulp_rpm.plugins.db.fields import ChecksumTypeStringField
 from pulp_win.common import ids
+from pulp_win.plugins.db import msidb, storage
 from xml.etree import ElementTree
 
 MSIINFO_PATH = '/usr/bin/msiinfo'
-if not os.path.exists(MSIINFO_PATH):
-    raise RuntimeError("msiinfo is not available")
+MSIDUMP_PATH = '/usr/bin/msidump'
 
 _LOGGER = logging.getLogger(__name__)
 
 NotUniqueError = mongoengine.NotUniqueError
+# E11000 (and E11001 on older servers) is a duplicate key error
+DUPLICATE_KEY_ERRORS = (11000, 11001)
+# Maximum number of units per $in query or bulk write
+BULK_CHUNK_SIZE = 1000
+# Package.metadata_source of units created out of primary.xml; the metadata
+# of other units was extracted from their file
+METADATA_SOURCE_UPSTREAM = 'upstream'
 
 
 class Error(ValueError):
@@ -28,6 +47,205 @@ class InvalidPackageError(Error):
     pass
 
 
+class MetadataBackend(object):
+    """
+    Reads tables out of an MSI database.
+    """
+    name = None
+    # Bump this when the backend's output changes, to invalidate the cache
+    version = 1
+    # Whether the backend can read from an already opened file object,
+    # instead of from a path
+    reads_streams = False
+
+    @classmethod
+    def read_tables(cls, filename, table_names):
+        """
+        Read the specified tables from filename.
+
+        :return: a tuple (tables, rows), where tables is the set of all table
+                 names in the database, and rows is a dictionary of the rows
+                 (as lists of strings) for each of the requested tables that
+                 are present
+        """
+        raise NotImplementedError()
+
+
+class NativeMetadataBackend(MetadataBackend):
+    """
+    Reads all tables in-process, with a single open of the file.
+    """
+    name = 'native'
+    reads_streams = True
+
+    @classmethod
+    def read_tables(cls, filename, table_names):
+        try:
+            return msidb.read_tables(filename, table_names)
+        except msidb.InvalidFileError as e:
+            raise InvalidPackageError(str(e))
+        except msidb.Error as e:
+            raise Error(str(e))
+
+
+class MsiinfoMetadataBackend(MetadataBackend):
+    """
+    Reads tables by running msiinfo, once for listing the tables and once
+    for every exported table.
+    """
+    name = 'msiinfo'
+
+    @classmethod
+    def read_tables(cls, filename, table_names):
+        stdout, _ = cls._run_cmd([MSIINFO_PATH, 'tables', filename])
+        tables = set(h.rstrip() for h in stdout.split('\n'))
+        tables.discard('')
+        rows = dict()
+        for table_name in table_names:
+            if table_name not in tables:
+                continue
+            cmd = [MSIINFO_PATH, 'export', filename, table_name]
+            stdout, _ = cls._run_cmd(cmd)
+            rows[table_name] = cls._parse_idt(stdout, table_name)
+        return tables, rows
+
+    @classmethod
+    def _parse_idt(cls, contents, table_name):
+        """
+        Parse the exported table. The format is described in
+        https://msdn.microsoft.com/en-us/library/windows/desktop/aa367854(v=vs.85).aspx
+        The first row has the column names and the second one the column
+        types. The third row has the table name and the primary keys.
+        """
+        lines = [x.rstrip('\r') for x in contents.split('\n')]
+        lines = lines[2:]
+        if lines and lines[0].split('\t', 1)[0] == table_name:
+            lines = lines[1:]
+        return [x.split('\t') for x in lines if x]
+
+    @classmethod
+    def _run_cmd(cls, cmd):
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate()
+        except Exception, e:
+            raise Error(str(e))
+        if p.returncode != 0:
+            raise InvalidPackageError(stderr)
+        return stdout, stderr
+
+
+class MsidumpMetadataBackend(MsiinfoMetadataBackend):
+    """
+    Runs msidump once, into a scratch directory, and reads the tables from
+    the dumped .idt files.
+    """
+    name = 'msidump'
+    IDT_SUFFIX = '.idt'
+
+    @classmethod
+    def read_tables(cls, filename, table_names):
+        dump_dir = tempfile.mkdtemp(prefix='msidump-')
+        try:
+            cls._run_cmd([MSIDUMP_PATH, '-d', dump_dir, filename])
+            tables = set(
+                x[:-len(cls.IDT_SUFFIX)] for x in os.listdir(dump_dir)
+                if x.endswith(cls.IDT_SUFFIX))
+            rows = dict()
+            for table_name in table_names:
+                if table_name not in tables:
+                    continue
+                path = os.path.join(dump_dir, table_name + cls.IDT_SUFFIX)
+                with open(path) as fobj:
+                    rows[table_name] = cls._parse_idt(fobj.read(), table_name)
+        finally:
+            shutil.rmtree(dump_dir, ignore_errors=True)
+        return tables, rows
+
+
+METADATA_BACKENDS = dict((x.name, x) for x in [
+    NativeMetadataBackend,
+    MsiinfoMetadataBackend,
+    MsidumpMetadataBackend,
+])
+DEFAULT_METADATA_BACKEND = NativeMetadataBackend.name
+# Tables that are stored in the metadata cache, so an entry can be used for
+# either an MSI or an MSM
+CACHED_METADATA_TABLES = ('Property', 'ModuleSignature', 'ModuleDependency')
+
+
+@contextlib.contextmanager
+def mapped_file(fobj):
+    """
+    Memory-map the file, if possible. Computing checksums will then pull the
+    file into memory, and reading the metadata (which seeks around in the
+    file) will not have to go back to the disk.
+    Falls back to the file object itself if it cannot be mapped.
+    """
+    try:
+        mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError,
+            io.UnsupportedOperation):
+        # Not a real file, or an empty one
+        yield fobj
+        return
+    try:
+        yield mapped
+    finally:
+        mapped.close()
+
+
+FileResult = namedtuple("FileResult", "path unit error")
+
+
+def _unit_data_from_file(task):
+    """
+    Worker for Package.from_files. Errors are returned rather than raised,
+    so one bad file does not abort the whole batch.
+    """
+    cls, path, kwargs = task
+    try:
+        return path, cls._unit_data_from_file(path, **kwargs), None
+    except Error as e:
+        return path, None, e
+    except util.InvalidChecksumType as e:
+        return path, None, Error(str(e))
+
+
+def new_pool(workers):
+    """
+    Return a pool of workers suitable for Package.from_files.
+    """
+    if multiprocessing.current_process().daemon:
+        # Daemonic processes are not allowed to have children. Most of the
+        # work (hashing, running msiinfo) releases the GIL, so threads still
+        # help.
+        return multiprocessing.pool.ThreadPool(workers)
+    return multiprocessing.Pool(workers)
+
+
+def _chunks(items, size):
+    """
+    Split an iterable in lists of at most size items.
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_metadata_backend(name=None):
+    if name is None:
+        name = DEFAULT_METADATA_BACKEND
+    try:
+        return METADATA_BACKENDS[name]
+    except KeyError:
+        raise Error("Unknown metadata backend: {}".format(name))
+
+
 class Package(FileContentUnit):
     meta = dict(abstract=True)
 
@@ -39,9 +257,14 @@ class Package(FileContentUnit):
 
     filename = mongoengine.StringField(required=True)
     relativepath = mongoengine.StringField()
+    # METADATA_SOURCE_UPSTREAM if the fields primary.xml does not carry are
+    # missing
+    metadata_source = mongoengine.StringField()
 
     UNIT_KEY_TO_FIELD_MAP = dict()
     REPOMD_EXTRA_FIELDS = []
+    # Tables exported from the MSI database in order to extract metadata
+    METADATA_TABLES = ()
 
     def __init__(self, *args, **kwargs):
         super(Package, self).__init__(*args, **kwargs)
@@ -50,6 +273,8 @@ class Package(FileContentUnit):
         self.base_url = None
         # Needed by sync verification
         self.checksums = {}
+        # How import_content placed the file in content storage
+        self.import_method = None
 
     def __str__(self):
         return '<%s: %s>' % (
@@ -58,20 +283,102 @@ class Package(FileContentUnit):
                       for name in self.unit_key_fields))
 
     @classmethod
-    def from_file(cls, filename, user_metadata=None):
+    def from_file(cls, filename, user_metadata=None, metadata_backend=None,
+                  metadata_cache=None, checksum_types=None):
+        """
+        Create a unit out of the file. The file is read only once: the
+        sha256 checksum (and any other checksum_types, made available in the
+        checksums attribute of the unit) and the size are computed in one
+        pass, and the native metadata backend reads from the same mapping.
+        """
+        metadata, checksums = cls._unit_data_from_file(
+            filename, user_metadata=user_metadata,
+            metadata_backend=metadata_backend,
+            metadata_cache=metadata_cache,
+            checksum_types=checksum_types)
+        return cls._from_unit_data(metadata, checksums)
+
+    @classmethod
+    def from_files(cls, paths, workers=None, user_metadata=None,
+                   metadata_backend=None, metadata_cache=None,
+                   checksum_types=None, pool=None):
+        """
+        Create units out of many files concurrently, using a pool of workers
+        (the number of CPUs by default). An existing pool (see new_pool) can
+        be passed in instead, and is left running.
+
+        Results are generated as they become available, not necessarily in
+        the order of paths.
+
+        :return: a generator of FileResult, with either the unit or the
+                 error (an instance of Error) set
+        """
+        kwargs = dict(user_metadata=user_metadata,
+                      metadata_backend=metadata_backend,
+                      metadata_cache=metadata_cache,
+                      checksum_types=checksum_types)
+        tasks = ((cls, path, kwargs) for path in paths)
+        own_pool = None
+        if pool is None:
+            if workers is None:
+                workers = multiprocessing.cpu_count()
+            if workers > 1:
+                pool = own_pool = new_pool(workers)
+        if pool is not None:
+            results = pool.imap_unordered(_unit_data_from_file, tasks)
+        else:
+            results = itertools.imap(_unit_data_from_file, tasks)
+        try:
+            for path, unit_data, error in results:
+                if error is not None:
+                    yield FileResult(path, None, error)
+                    continue
+                yield FileResult(path, cls._from_unit_data(*unit_data), None)
+        finally:
+            if own_pool is not None:
+                own_pool.terminate()
+                own_pool.join()
+
+    @classmethod
+    def _from_unit_data(cls, metadata, checksums):
+        unit = cls(**metadata)
+        unit.checksums = checksums
+        return unit
+
+    @classmethod
+    def _unit_data_from_file(cls, filename, user_metadata=None,
+                             metadata_backend=None, metadata_cache=None,
+                             checksum_types=None):
+        """
+        Read the file and compute the unit's fields.
+
+        :return: a tuple (metadata, checksums)
+        """
         if hasattr(filename, "read"):
             fobj = filename
         else:
             try:
-                fobj = open(filename, "r")
+                fobj = open(filename, "rb")
             except IOError as e:
                 raise Error(str(e))
         if not user_metadata:
             user_metadata = {}
-        unit_md = cls._read_metadata(filename)
+        backend = get_metadata_backend(metadata_backend)
+        try:
+            with mapped_file(fobj) as stream:
+                checksums, size = cls._compute_checksums(stream,
+                                                         checksum_types)
+                checksum = checksums[util.TYPE_SHA256]
+                source = stream if backend.reads_streams else filename
+                unit_md = cls._read_metadata(source, backend.name,
+                                             metadata_cache=metadata_cache,
+                                             checksum=checksum, size=size)
+        finally:
+            if fobj is not filename:
+                fobj.close()
         unit_md.update(checksumtype=util.TYPE_SHA256,
-                       checksum=cls._compute_checksum(fobj),
-                       size=fobj.tell())
+                       checksum=checksum,
+                       size=size)
 
         ignored = set(['filename'])
 
@@ -106,25 +413,72 @@ class Package(FileContentUnit):
         # metadata seems dangerous. If this statement is not correct,
         # uncomment the line below.
         # metadata.update(user_md)
-        return cls(**metadata)
+        return metadata, checksums
 
     @classmethod
-    def _run_cmd(cls, cmd):
-        try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            stdout, stderr = p.communicate()
-        except Exception, e:
-            raise Error(str(e))
-        if p.returncode != 0:
-            raise InvalidPackageError(stderr)
-        return stdout, stderr
+    def _read_metadata(cls, filename, metadata_backend=None,
+                       metadata_cache=None, checksum=None, size=None):
+        """
+        Extract the metadata out of the file. If a metadata_cache is
+        specified, the sha256 checksum and size of the file should be
+        passed in too.
+        """
+        backend = get_metadata_backend(metadata_backend)
+        if metadata_cache is None or checksum is None:
+            tables, rows = backend.read_tables(filename, cls.METADATA_TABLES)
+            return cls._metadata_from_tables(tables, rows)
+        version = "{0}-{1}".format(backend.name, backend.version)
+        cached = metadata_cache.get(checksum, size, version)
+        if cached is None:
+            tables, rows = backend.read_tables(filename,
+                                               CACHED_METADATA_TABLES)
+            metadata_cache.put(checksum, size, version, tables, rows)
+        else:
+            tables, rows = cached
+        return cls._metadata_from_tables(tables, rows)
+
+    @classmethod
+    def _metadata_from_tables(cls, tables, rows):
+        raise NotImplementedError()
 
     @classmethod
     def _compute_checksum(cls, fobj):
         cstype = util.TYPE_SHA256
         return util.calculate_checksums(fobj, [cstype])[cstype]
 
+    @classmethod
+    def file_checksums(cls, filename, checksum_types=None):
+        """
+        Compute the checksums (see _compute_checksums) and the size of the
+        file, without extracting any metadata.
+
+        :return: a tuple (checksums, size)
+        """
+        with open(filename, "rb") as fobj:
+            return cls._compute_checksums(fobj, checksum_types)
+
+    @classmethod
+    def _compute_checksums(cls, fobj, checksum_types=None):
+        """
+        Compute the sha256 checksum, as well as any of the checksum_types,
+        in a single pass over the file.
+
+        :return: a tuple (checksums, size)
+        """
+        cstypes = set([util.TYPE_SHA256])
+        cstypes.update(checksum_types or [])
+        checksums = util.calculate_checksums(fobj, sorted(cstypes))
+        return checksums, fobj.tell()
+
+    @classmethod
+    def type_field_names(cls):
+        """
+        Names of the metadata fields specific to the unit type.
+        """
+        return sorted(fname for fname in cls._fields
+                      if fname not in Package._fields and
+                      not fname.startswith('_'))
+
     @classmethod
     def filename_from_unit_key(cls, unit_key):
         return "{0}-{1}.{2}".format(
@@ -165,7 +519,7 @@ class Package(FileContentUnit):
             repository=repo, unit=self)
         return self
 
-    def save_and_associate(self, file_path, repo):
+    def save_and_associate(self, file_path, repo, link_content=False):
         with_filename = ('filename' in self.__class__._fields)
         if with_filename:
             filename = self.filename_from_unit_key(self.unit_key)
@@ -174,39 +528,257 @@ class Package(FileContentUnit):
         try:
             self.save()
             if with_filename:
-                self.safe_import_content(file_path)
+                if link_content:
+                    self.import_method = self.import_content(file_path)
+                else:
+                    self.safe_import_content(file_path)
         except NotUniqueError:
             unit = self.__class__.objects.filter(**unit.unit_key).first()
         unit.associate(repo)
         return unit
 
+    def import_content(self, path):
+        """
+        Place the file in content storage like safe_import_content does,
+        but sharing its data with path (hard link, reflink) when the
+        filesystem allows it, instead of copying it.
+
+        :return: how the file was imported, one of the storage module's
+                 HARDLINK, REFLINK, COPY_FILE_RANGE and COPY
+        :rtype:  str
+        """
+        return storage.import_file(path, self._storage_path)
+
+    @classmethod
+    def bulk_save_and_associate(cls, units_and_paths, repo,
+                                link_content=False):
+        """
+        Save many units and associate them with the repository. New units
+        are inserted with a single unordered insert per unit type, units
+        that already exist are looked up with a single query per unit type,
+        and all associations are created with a single bulk write.
+
+        :param units_and_paths: list of (unit, file_path) tuples. file_path
+                                is None for units without a file.
+        :param repo: the repository to associate the units with
+        :type  repo: pulp.server.db.model.Repository
+        :param link_content: import files with import_content rather than
+                             safe_import_content
+        :type  link_content: bool
+        :return: the saved (or already existing) units, in the same order
+        :rtype:  list
+        """
+        by_class = dict()
+        for idx, (unit, file_path) in enumerate(units_and_paths):
+            by_class.setdefault(unit.__class__, []).append(
+                (idx, unit, file_path))
+        ret = [None] * len(units_and_paths)
+        for klass, items in by_class.items():
+            saved = klass._bulk_save([(x[1], x[2]) for x in items],
+                                     link_content=link_content)
+            for (idx, _, _), unit in zip(items, saved):
+                ret[idx] = unit
+        cls.bulk_associate(ret, repo)
+        return ret
+
+    @classmethod
+    def _bulk_save(cls, units_and_paths, link_content=False):
+        with_filename = ('filename' in cls._fields)
+        for unit, _ in units_and_paths:
+            if with_filename:
+                unit.set_storage_path(
+                    unit.filename_from_unit_key(unit.unit_key))
+            # insert_many does not go through save(), so do what it would,
+            # in the same order: pre_save fills in required fields such as
+            # _last_updated
+            cls.pre_save_signal(cls, unit)
+            unit.validate()
+        duplicates = set()
+        try:
+            cls._get_collection().insert_many(
+                [unit.to_mongo() for unit, _ in units_and_paths],
+                ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get('writeErrors', []):
+                if err.get('code') not in DUPLICATE_KEY_ERRORS:
+                    raise
+                duplicates.add(err['index'])
+        existing = cls.find_by_unit_keys(
+            [units_and_paths[idx][0] for idx in sorted(duplicates)])
+        ret = []
+        for idx, (unit, file_path) in enumerate(units_and_paths):
+            if idx in duplicates:
+                ret.append(existing[unit.unit_key_as_named_tuple])
+                continue
+            if with_filename and file_path is not None:
+                if link_content:
+                    unit.import_content(file_path)
+                else:
+                    unit.safe_import_content(file_path)
+            ret.append(unit)
+        return ret
+
+    @classmethod
+    def find_by_unit_keys(cls, units):
+        """
+        Find the units stored in the database that have the same unit key
+        as any of the specified units. Units are looked up with $in queries
+        on the (indexed) checksum, grouped by checksum type, in chunks of
+        BULK_CHUNK_SIZE.
+
+        :return: a dictionary of the units, keyed by unit_key_as_named_tuple
+        :rtype:  dict
+        """
+        wanted = set(u.unit_key_as_named_tuple for u in units)
+        by_checksumtype = dict()
+        for unit in units:
+            by_checksumtype.setdefault(unit.checksumtype, set()).add(
+                unit.checksum)
+        ret = dict()
+        for checksumtype, checksums in sorted(by_checksumtype.items()):
+            for chunk in _chunks(sorted(checksums), BULK_CHUNK_SIZE):
+                query = cls.objects.filter(checksumtype=checksumtype,
+                                           checksum__in=chunk)
+                for unit in query:
+                    key = unit.unit_key_as_named_tuple
+                    if key in wanted:
+                        ret[key] = unit
+        return ret
+
+    @classmethod
+    def bulk_associate(cls, units, repo, skip_associated=False):
+        """
+        Associate the units with the repository, with one bulk upsert per
+        BULK_CHUNK_SIZE units.
+
+        :param skip_associated: if True, units already associated with the
+                                repository are left alone (their updated
+                                timestamp does not change)
+        :return: the number of units that were (re-)associated
+        :rtype:  int
+        """
+        now = dateutils.format_iso8601_utc_timestamp(
+            dateutils.now_utc_timestamp())
+        unit_ids = dict()
+        for unit in units:
+            unit_ids[unit.id] = unit._content_type_id
+        collection = RepositoryContentUnit._get_collection()
+        count = 0
+        for chunk in _chunks(sorted(unit_ids.items()), BULK_CHUNK_SIZE):
+            if skip_associated:
+                associated = set(
+                    x['unit_id'] for x in collection.find(
+                        dict(repo_id=repo.repo_id,
+                             unit_id={'$in': [x[0] for x in chunk]}),
+                        projection=dict(unit_id=True, _id=False)))
+                chunk = [x for x in chunk if x[0] not in associated]
+                if not chunk:
+                    continue
+            ops = [
+                pymongo.UpdateOne(
+                    dict(repo_id=repo.repo_id, unit_id=unit_id,
+                         unit_type_id=unit_type_id),
+                    {'$setOnInsert': dict(created=now),
+                     '$set': dict(updated=now)},
+                    upsert=True)
+                for unit_id, unit_type_id in chunk]
+            collection.bulk_write(ops, ordered=False)
+            count += len(ops)
+        return count
+
+    @classmethod
+    def bulk_unassociate(cls, unit_ids, repo):
+        """
+        Remove the units from the repository, with one delete per
+        BULK_CHUNK_SIZE units. unit_ids can be any iterable, and is only
+        consumed one chunk at a time.
+
+        :return: the number of associations that were removed
+        :rtype:  int
+        """
+        collection = RepositoryContentUnit._get_collection()
+        count = 0
+        for chunk in _chunks(unit_ids, BULK_CHUNK_SIZE):
+            result = collection.delete_many(
+                dict(repo_id=repo.repo_id, unit_id={'$in': chunk}))
+            count += result.deleted_count
+        return count
+
+    @classmethod
+    def unit_key_digest(cls, unit_key):
+        """
+        Compact fingerprint of a unit key, for keeping the unit keys of a
+        whole repository in a set.
+
+        :param unit_key: a dictionary with (at least) the unit key fields
+        :return: a 20-byte string
+        :rtype:  str
+        """
+        digest = hashlib.sha1(cls.TYPE_ID)
+        for fname in cls.unit_key_fields:
+            value = unit_key.get(fname)
+            if value is None:
+                value = ''
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            digest.update('\0%s' % (value, ))
+        return digest.digest()
+
     @classmethod
-    def _read_msi_module_signature(cls, filename):
+    def repo_unit_key_digests(cls, repo):
+        """
+        Generate (unit id, unit key digest) for the units of this type that
+        are associated with the repository. Associations are streamed,
+        projected on the unit id, and the unit keys are fetched
+        BULK_CHUNK_SIZE units at a time, projected on the unit key fields.
+        """
+        associations = RepositoryContentUnit._get_collection().find(
+            dict(repo_id=repo.repo_id, unit_type_id=cls.TYPE_ID),
+            projection=dict(unit_id=True, _id=False))
+        collection = cls._get_collection()
+        projection = dict((fname, True) for fname in cls.unit_key_fields)
+        for chunk in _chunks((x['unit_id'] for x in associations),
+                             BULK_CHUNK_SIZE):
+            for doc in collection.find({'_id': {'$in': chunk}},
+                                       projection=projection):
+                yield doc['_id'], cls.unit_key_digest(doc)
+
+    @classmethod
+    def repo_has_upstream_metadata(cls, repo):
+        """
+        Return True if any of the units of this type associated with the
+        repository was created out of primary.xml, and still misses the
+        fields primary.xml does not carry. Associations are streamed and the
+        units looked up BULK_CHUNK_SIZE at a time.
+        """
+        associations = RepositoryContentUnit._get_collection().find(
+            dict(repo_id=repo.repo_id, unit_type_id=cls.TYPE_ID),
+            projection=dict(unit_id=True, _id=False))
+        collection = cls._get_collection()
+        for chunk in _chunks((x['unit_id'] for x in associations),
+                             BULK_CHUNK_SIZE):
+            query = {'_id': {'$in': chunk},
+                     'metadata_source': METADATA_SOURCE_UPSTREAM}
+            if collection.find_one(query, projection=dict(_id=True)):
+                return True
+        return False
+
+    @classmethod
+    def _module_signature(cls, rows):
         # https://msdn.microsoft.com/en-us/library/windows/desktop/aa370051(v=vs.85).aspx
-        cmd = [MSIINFO_PATH, 'export', filename, 'ModuleSignature']
-        stdout, _ = cls._run_cmd(cmd)
         # According to the document linked above, the ModuleID is always
-        # name.GUID. msiinfo will return a bunch of header rows which are not
-        # in that format, so the rpartition will skip them.
+        # name.GUID. Rows not in that format are skipped.
         metadata = []
-        for row in stdout.split('\n'):
-            arr = row.rstrip().split('\t', 2)
-            if len(arr) != 3:
+        for row in rows:
+            if len(row) < 3:
                 continue
-            name, sep, guid = arr[0].rpartition('.')
+            name, sep, guid = row[0].rpartition('.')
             if not sep:
                 continue
-            metadata.append(dict(name=name, guid=guid, version=arr[2]))
+            metadata.append(dict(name=name, guid=guid, version=row[2]))
         metadata.sort(key=lambda x: (x['name'], x['version']))
         return metadata
 
-    @classmethod
-    def _read_msi_tables(cls, filename):
-        cmd = [MSIINFO_PATH, 'tables', filename]
-        stdout, _ = cls._run_cmd(cmd)
-        tables = set(h.rstrip() for h in stdout.split('\n'))
-        return tables
-
     def render_primary(self, checksumtype):
         sio = io.BytesIO()
         el = self._package_to_xml(checksumtype)
@@ -260,6 +832,7 @@ class MSI(Package):
     UNIT_KEY_TO_FIELD_MAP = dict(name=('ShortName', 'ProductName'),
                                  version='ProductVersion')
     REPOMD_EXTRA_FIELDS = ['ProductCode', 'UpgradeCode', 'ProductName']
+    METADATA_TABLES = ('Property', 'ModuleSignature')
 
     ProductName = mongoengine.StringField()
     UpgradeCode = mongoengine.StringField()
@@ -273,21 +846,13 @@ class MSI(Package):
                                                default=TYPE_ID)
 
     @classmethod
-    def _read_metadata(cls, filename):
-        tables = cls._read_msi_tables(filename)
+    def _metadata_from_tables(cls, tables, rows):
         if 'Property' not in tables:
             raise InvalidPackageError("MSI does not have a Property table")
-        cmd = [MSIINFO_PATH, 'export', filename, 'Property']
-        stdout, stderr = cls._run_cmd(cmd)
-        headers = (h.rstrip().partition('\t')
-                   for h in stdout.split('\n'))
-        headers = dict((x[0], x[2]) for x in headers if x[1] == '\t')
+        headers = dict((x[0], x[1]) for x in rows['Property'] if len(x) >= 2)
         # Add the module signature, to link an MSI to an MSM
-        if 'ModuleSignature' in tables:
-            module_signature = cls._read_msi_module_signature(filename)
-        else:
-            module_signature = []
-        headers['ModuleSignature'] = module_signature
+        headers['ModuleSignature'] = cls._module_signature(
+            rows.get('ModuleSignature', []))
         return headers
 
 
@@ -301,6 +866,8 @@ class MSM(Package):
     unit_display_name = 'MSM'
     unit_description = 'MSM'
 
+    METADATA_TABLES = ('ModuleSignature', 'ModuleDependency')
+
     guid = mongoengine.StringField()
     ModuleDependency = mongoengine.ListField()
 
@@ -310,24 +877,16 @@ class MSM(Package):
                                                default=TYPE_ID)
 
     @classmethod
-    def _read_msm_module_dependency(cls, filename):
+    def _module_dependency(cls, rows):
         # https://msdn.microsoft.com/en-us/library/windows/desktop/aa370046(v=vs.85).aspx
-        cmd = [MSIINFO_PATH, 'export', filename, 'ModuleDependency']
-        stdout, _ = cls._run_cmd(cmd)
-        # According to the document linked above, the ModuleID is always name.GUID.
-        metadata = []
-        for row in stdout.split('\n'):
-            if '.' not in row or len(row.split()) != 4:
-                continue
-            name =row.rstrip().split()[-2]
-            metadata.append(dict(name=name))
+        # The RequiredID column holds the ModuleID of the required module
+        metadata = [dict(name=row[2]) for row in rows if len(row) >= 4]
         metadata.sort(key=lambda x: x['name'])
         return metadata
 
     @classmethod
-    def _read_metadata(cls, filename):
-        # First, dump tables. An MSM should not contain Property
-        tables = cls._read_msi_tables(filename)
+    def _metadata_from_tables(cls, tables, rows):
+        # An MSM should not contain Property
         if 'Property' in tables:
             raise InvalidPackageError("Attempt to handle an MSI as an MSM")
         if 'ModuleSignature' not in tables:
@@ -335,19 +894,13 @@ class MSM(Package):
             # https://msdn.microsoft.com/en-us/library/windows/desktop/aa370051(v=vs.85).aspx
             raise InvalidPackageError("ModuleSignature is missing")
 
-        # According to the document linked above, the ModuleID is always
-        # name.GUID. msiinfo will return a bunch of header rows which are not
-        # in that format, so the rpartition will skip them.
-        module_signature = cls._read_msi_module_signature(filename)
+        module_signature = cls._module_signature(rows['ModuleSignature'])
         if len(module_signature) != 1:
             raise InvalidPackageError(
                 "Not a valid MSM: more than one entry in ModuleSignature")
         metadata = module_signature[0]
 
-        if 'ModuleDependency' in tables:
-            module_dependency = cls._read_msm_module_dependency(filename)
-        else:
-            module_dependency = []
-        metadata['ModuleDependency'] = module_dependency
+        metadata['ModuleDependency'] = cls._module_dependency(
+            rows.get('ModuleDependency', []))
 
         return metadata
@@ -0,0 +1,447 @@
+"""
+Pure-python reader for MSI (and MSM) databases.
+
+An MSI file is an OLE compound document. Every database table is stored as a
+stream in the root storage, with all strings interned in a shared string pool
+(the _StringPool and _StringData streams). Tables are stored column-wise.
+
+The layout is documented in [MS-CFB]:
+https://msdn.microsoft.com/en-us/library/dd942138.aspx
+The MSI-specific encodings are not officially documented; they follow what
+Wine and msitools (which msiinfo is part of) implement.
+"""
+import array
+import struct
+import sys
+
+SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+HEADER_SIZE = 512
+DIRENTRY_SIZE = 128
+
+# Special sector numbers
+MAXREGSECT = 0xFFFFFFFA
+DIFSECT = 0xFFFFFFFC
+FATSECT = 0xFFFFFFFD
+ENDOFCHAIN = 0xFFFFFFFE
+FREESECT = 0xFFFFFFFF
+NOSTREAM = 0xFFFFFFFF
+
+# Directory entry types
+STGTY_STORAGE = 1
+STGTY_STREAM = 2
+STGTY_ROOT = 5
+
+# Column type bits, as stored in the _Columns table
+MSITYPE_VALID = 0x0100
+MSITYPE_LOCALIZABLE = 0x0200
+MSITYPE_STRING = 0x0800
+MSITYPE_NULLABLE = 0x1000
+MSITYPE_KEY = 0x2000
+MSITYPE_TEMPORARY = 0x4000
+
+# Stream names of tables are prefixed with this character
+TABLE_PREFIX = u'\u4840'
+
+_CODEPAGES = {
+    0: 'cp1252',
+    65001: 'utf-8',
+}
+
+
+class Error(ValueError):
+    pass
+
+
+class InvalidFileError(Error):
+    pass
+
+
+def _uint32_array(data):
+    arr = array.array('I')
+    if arr.itemsize != 4:
+        arr = array.array('L')
+    arr.fromstring(data)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+
+def _int_value(raw, bits):
+    """
+    Integers are stored with the sign bit flipped; 0 is NULL.
+    """
+    if not raw:
+        return u''
+    value = raw ^ (1 << (bits - 1))
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return u'%d' % value
+
+
+def _mime2utf(x):
+    if x < 10:
+        return unichr(x + ord('0'))
+    if x < 10 + 26:
+        return unichr(x - 10 + ord('A'))
+    if x < 10 + 26 + 26:
+        return unichr(x - 10 - 26 + ord('a'))
+    if x == 10 + 26 + 26:
+        return u'.'
+    return u'_'
+
+
+def decode_stream_name(name):
+    """
+    MSI compresses stream names by packing two base64-like characters in a
+    single UTF-16 code point. Table streams are additionally prefixed with
+    TABLE_PREFIX, which is preserved in the decoded name.
+    """
+    ret = []
+    for ch in name:
+        c = ord(ch)
+        if 0x3800 <= c < 0x4800:
+            c -= 0x3800
+            ret.append(_mime2utf(c & 0x3f))
+            ret.append(_mime2utf((c >> 6) & 0x3f))
+        elif 0x4800 <= c < 0x4840:
+            ret.append(_mime2utf(c - 0x4800))
+        else:
+            ret.append(ch)
+    return u''.join(ret)
+
+
+class DirEntry(object):
+    __slots__ = ('name', 'type', 'left', 'right', 'child', 'start', 'size')
+
+    def __init__(self, name, type, left, right, child, start, size):
+        self.name = name
+        self.type = type
+        self.left = left
+        self.right = right
+        self.child = child
+        self.start = start
+        self.size = size
+
+
+class CompoundFile(object):
+    """
+    Minimal read-only OLE compound file parser.
+
+    Only the FAT sectors needed to follow the chains of the streams that are
+    actually read get loaded, so large files (cabinets are usually embedded
+    as streams) do not need to be scanned.
+    """
+    def __init__(self, fobj):
+        self._fobj = fobj
+        header = self._read_at(0, HEADER_SIZE)
+        if len(header) < HEADER_SIZE or header[:8] != SIGNATURE:
+            raise InvalidFileError("Not an OLE compound file")
+        major_version, byte_order, sector_shift, mini_sector_shift = \
+            struct.unpack('<HHHH', header[0x1A:0x22])
+        if byte_order != 0xFFFE:
+            raise InvalidFileError("Invalid byte order mark")
+        if (major_version, sector_shift) not in ((3, 9), (4, 12)):
+            raise InvalidFileError(
+                "Unsupported compound file version %s" % major_version)
+        (_, _, first_dir_sector, _, self.mini_stream_cutoff,
+         first_minifat_sector, _, first_difat_sector, num_difat_sectors) = \
+            struct.unpack('<9I', header[0x28:0x4C])
+        self.major_version = major_version
+        self.sector_size = 1 << sector_shift
+        self.mini_sector_size = 1 << mini_sector_shift
+        self._fat_entries_per_sector = self.sector_size // 4
+
+        fat_sectors = [x for x in _uint32_array(header[0x4C:HEADER_SIZE])
+                       if x <= MAXREGSECT]
+        sect = first_difat_sector
+        for _ in range(num_difat_sectors):
+            if sect > MAXREGSECT:
+                break
+            entries = _uint32_array(self._read_sector(sect))
+            fat_sectors.extend(x for x in entries[:-1] if x <= MAXREGSECT)
+            sect = entries[-1]
+        self._fat_sectors = fat_sectors
+        self._fat_cache = dict()
+
+        entries = self._read_chain(first_dir_sector)
+        self._entries = [self._parse_direntry(entries[i:i + DIRENTRY_SIZE])
+                         for i in range(0, len(entries), DIRENTRY_SIZE)]
+        if not self._entries or self._entries[0].type != STGTY_ROOT:
+            raise InvalidFileError("Root storage not found")
+        root = self._entries[0]
+        self._ministream = None
+        self._ministream_entry = root
+        self._first_minifat_sector = first_minifat_sector
+        self._minifat = None
+
+    def _read_at(self, offset, size):
+        self._fobj.seek(offset)
+        return self._fobj.read(size)
+
+    def _read_sector(self, sect):
+        data = self._read_at((sect + 1) * self.sector_size, self.sector_size)
+        if len(data) != self.sector_size:
+            raise InvalidFileError("Truncated sector %d" % sect)
+        return data
+
+    def _next_sector(self, sect):
+        idx, offset = divmod(sect, self._fat_entries_per_sector)
+        fat = self._fat_cache.get(idx)
+        if fat is None:
+            if idx >= len(self._fat_sectors):
+                raise InvalidFileError("Sector %d is not mapped" % sect)
+            fat = self._fat_cache[idx] = _uint32_array(
+                self._read_sector(self._fat_sectors[idx]))
+        return fat[offset]
+
+    def _read_chain(self, sect, size=None):
+        chunks = []
+        # Protect against loops in the sector chain
+        max_sectors = len(self._fat_sectors) * self._fat_entries_per_sector
+        while sect != ENDOFCHAIN:
+            if sect > MAXREGSECT or len(chunks) > max_sectors:
+                raise InvalidFileError("Corrupted sector chain")
+            chunks.append(self._read_sector(sect))
+            if size is not None and len(chunks) * self.sector_size >= size:
+                break
+            sect = self._next_sector(sect)
+        data = b''.join(chunks)
+        if size is not None:
+            if len(data) < size:
+                raise InvalidFileError("Truncated stream")
+            data = data[:size]
+        return data
+
+    def _parse_direntry(self, data):
+        name_len, type_ = struct.unpack('<HB', data[64:67])
+        left, right, child = struct.unpack('<III', data[68:80])
+        start, size = struct.unpack('<IQ', data[116:128])
+        if self.major_version == 3:
+            # The high part of the size may contain garbage in version 3
+            size &= 0xFFFFFFFF
+        name = data[:max(name_len - 2, 0)].decode('utf-16-le', 'replace')
+        return DirEntry(name, type_, left, right, child, start, size)
+
+    def _read_mini_chain(self, sect, size):
+        if self._minifat is None:
+            self._minifat = _uint32_array(
+                self._read_chain(self._first_minifat_sector))
+            root = self._ministream_entry
+            self._ministream = self._read_chain(root.start, root.size)
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            if sect >= len(self._minifat):
+                raise InvalidFileError("Corrupted mini sector chain")
+            offset = sect * self.mini_sector_size
+            chunks.append(self._ministream[offset:offset +
+                                           self.mini_sector_size])
+            remaining -= self.mini_sector_size
+            sect = self._minifat[sect]
+        data = b''.join(chunks)
+        if len(data) < size:
+            raise InvalidFileError("Truncated stream")
+        return data[:size]
+
+    def root_streams(self):
+        """
+        Return a dictionary of the streams in the root storage, keyed by
+        their (undecoded) name.
+        """
+        ret = dict()
+        seen = set()
+        stack = [self._entries[0].child]
+        while stack:
+            idx = stack.pop()
+            if idx == NOSTREAM or idx in seen:
+                continue
+            if idx >= len(self._entries):
+                raise InvalidFileError("Invalid directory entry %d" % idx)
+            seen.add(idx)
+            entry = self._entries[idx]
+            if entry.type == STGTY_STREAM:
+                ret[entry.name] = entry
+            stack.append(entry.left)
+            stack.append(entry.right)
+        return ret
+
+    def read_stream(self, entry):
+        if entry.size == 0:
+            return b''
+        if entry.size < self.mini_stream_cutoff:
+            return self._read_mini_chain(entry.start, entry.size)
+        return self._read_chain(entry.start, entry.size)
+
+
+class Database(object):
+    """
+    Read-only access to the tables of an MSI database.
+
+    Values are returned as unicode strings, in the same representation
+    msiinfo export uses: integers are rendered in decimal, NULL values and
+    binary (stream) columns are empty strings.
+    """
+    def __init__(self, fobj):
+        self._cfb = CompoundFile(fobj)
+        self._streams = dict(
+            (decode_stream_name(name), entry)
+            for name, entry in self._cfb.root_streams().items())
+        self._load_string_pool()
+        self._columns = None
+        self._tables = [self._strings[x] for x in
+                        self._read_refs(self._read_table_stream('_Tables'))]
+
+    def _read_table_stream(self, name):
+        entry = self._streams.get(TABLE_PREFIX + name)
+        if entry is None:
+            return b''
+        return self._cfb.read_stream(entry)
+
+    def _load_string_pool(self):
+        pool = self._read_table_stream('_StringPool')
+        data = self._read_table_stream('_StringData')
+        if len(pool) < 4:
+            raise InvalidFileError("String pool is missing")
+        codepage, flags = struct.unpack('<HH', pool[:4])
+        codepage |= (flags & 0x7FFF) << 16
+        self.ref_size = 3 if flags & 0x8000 else 2
+        encoding = _CODEPAGES.get(codepage, 'cp%d' % codepage)
+        try:
+            u''.encode(encoding)
+        except LookupError:
+            encoding = _CODEPAGES[0]
+        words = array.array('H')
+        words.fromstring(pool[4:len(pool) & ~3])
+        if sys.byteorder != 'little':
+            words.byteswap()
+        # String id 0 is the NULL string
+        strings = [u'']
+        offset = 0
+        i = 0
+        count = len(words)
+        while i + 1 < count:
+            length, refs = words[i], words[i + 1]
+            if length == 0 and refs != 0 and i + 3 < count:
+                # Strings longer than 64k: the high word of the length is
+                # stored in the reference count of a null entry
+                length = (refs << 16) + words[i + 2]
+                i += 4
+            else:
+                i += 2
+            strings.append(data[offset:offset + length].decode(
+                encoding, 'replace'))
+            offset += length
+        self._strings = strings
+
+    def _read_refs(self, data, count=None):
+        if count is None:
+            count = len(data) // self.ref_size
+        if self.ref_size == 2:
+            return struct.unpack('<%dH' % count, data[:2 * count])
+        return [struct.unpack('<I', data[i:i + 3] + b'\0')[0]
+                for i in range(0, 3 * count, 3)]
+
+    def _column_width(self, coltype):
+        if coltype & ~MSITYPE_NULLABLE == MSITYPE_STRING | MSITYPE_VALID:
+            # Binary columns reference a stream
+            return 2
+        if coltype & MSITYPE_STRING:
+            return self.ref_size
+        if coltype & 0xFF <= 2:
+            return 2
+        return 4
+
+    def _read_columns(self, data, columns):
+        """
+        Decode the column-wise stored table data.
+        columns is a list of column types.
+        """
+        row_size = sum(self._column_width(t) for t in columns)
+        if not row_size:
+            return []
+        nrows = len(data) // row_size
+        offset = 0
+        ret = []
+        for coltype in columns:
+            width = self._column_width(coltype)
+            coldata = data[offset:offset + width * nrows]
+            offset += width * nrows
+            if coltype & ~MSITYPE_NULLABLE == MSITYPE_STRING | MSITYPE_VALID:
+                values = [u''] * nrows
+            elif coltype & MSITYPE_STRING:
+                values = [self._string(x)
+                          for x in self._read_refs(coldata, nrows)]
+            elif width == 2:
+                values = [_int_value(x, 16)
+                          for x in struct.unpack('<%dH' % nrows, coldata)]
+            else:
+                values = [_int_value(x, 32)
+                          for x in struct.unpack('<%dI' % nrows, coldata)]
+            ret.append(values)
+        return ret
+
+    def _string(self, ref):
+        if ref >= len(self._strings):
+            raise InvalidFileError("Invalid string reference %d" % ref)
+        return self._strings[ref]
+
+    def _load_columns(self):
+        # The schema of _Columns is fixed: Table, Number, Name, Type
+        str_type = MSITYPE_STRING | MSITYPE_VALID | 64
+        int_type = MSITYPE_VALID | 2
+        tables, numbers, _, types = self._read_columns(
+            self._read_table_stream('_Columns'),
+            [str_type, int_type, str_type, int_type])
+        columns = dict()
+        for table, number, coltype in zip(tables, numbers, types):
+            columns.setdefault(table, []).append(
+                (int(number), int(coltype) & 0xFFFF))
+        self._columns = dict(
+            (table, [x[1] for x in sorted(cols)])
+            for table, cols in columns.items())
+
+    def tables(self):
+        return list(self._tables)
+
+    def rows(self, table):
+        """
+        Return the rows of the specified table, as lists of unicode strings
+        """
+        if table not in self._tables:
+            raise Error("Table %s not found" % table)
+        if self._columns is None:
+            self._load_columns()
+        columns = self._columns.get(table, [])
+        columns = [t for t in columns if not t & MSITYPE_TEMPORARY]
+        values = self._read_columns(self._read_table_stream(table), columns)
+        return [list(x) for x in zip(*values)]
+
+
+def read_tables(filename, table_names):
+    """
+    Open filename (a path or a file object) once and read the specified
+    tables.
+
+    :return: a tuple (tables, rows), where tables is the set of all table
+             names in the database, and rows is a dictionary of the rows for
+             each of the requested tables that are present
+    """
+    if hasattr(filename, "read"):
+        return _read_tables(filename, table_names)
+    try:
+        fobj = open(filename, "rb")
+    except IOError as e:
+        raise Error(str(e))
+    with fobj:
+        return _read_tables(fobj, table_names)
+
+
+def _read_tables(fobj, table_names):
+    try:
+        db = Database(fobj)
+        tables = set(db.tables())
+        rows = dict((name, db.rows(name)) for name in table_names
+                    if name in tables)
+    except struct.error as e:
+        raise InvalidFileError(str(e))
+    return tables, rows
@@ -0,0 +1,156 @@
+"""
+Placing files into Pulp's content storage without copying their data when
+the filesystem allows it.
+
+In order of preference, a file is imported:
+ - as a hard link, if source and destination share a filesystem
+ - as a reflink (FICLONE), if the filesystem supports sharing extents
+   (btrfs, XFS)
+ - with copy_file_range(2), which copies in the kernel and lets NFS 4.2
+   servers copy server-side
+ - with a streaming copy, when nothing else is possible
+
+The file is assembled under a temporary name next to the destination, and
+renamed into place, so a partially imported file is never visible.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import uuid
+
+_LOGGER = logging.getLogger(__name__)
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+COPY = 'copy'
+
+# _IOW(0x94, 9, int), from linux/fs.h
+FICLONE = 0x40049409
+
+COPY_BLOCK_SIZE = 1024 * 1024
+# Errors meaning a method is not available for this pair of files, as
+# opposed to an I/O error
+UNSUPPORTED_ERRORS = frozenset([
+    errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK, errno.ENOSYS,
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL])
+
+_copy_file_range = None
+
+
+def _get_copy_file_range():
+    """
+    The copy_file_range function from libc (glibc 2.27 and later), or None.
+    """
+    global _copy_file_range
+    if _copy_file_range is None:
+        func = False
+        libc_name = ctypes.util.find_library('c')
+        if libc_name:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            func = getattr(libc, 'copy_file_range', False)
+            if func:
+                func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                 ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_uint]
+                func.restype = ctypes.c_ssize_t
+        _copy_file_range = func
+    return _copy_file_range or None
+
+
+def import_file(src, dst, allow_hardlink=True):
+    """
+    Place a copy of src at dst, sharing data with src where possible.
+
+    :param src: path to the file to import
+    :type  src: str
+    :param dst: path in content storage. Missing parent directories are
+                created, and an existing file is replaced.
+    :type  dst: str
+    :param allow_hardlink: if False, src and dst are never the same inode
+    :type  allow_hardlink: bool
+    :return: how the file was imported: one of HARDLINK, REFLINK,
+             COPY_FILE_RANGE and COPY
+    :rtype:  str
+    """
+    dst_dir = os.path.dirname(dst)
+    try:
+        os.makedirs(dst_dir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmp_path = os.path.join(dst_dir, '.%s.%s' % (os.path.basename(dst),
+                                                 uuid.uuid4().hex))
+    try:
+        method = _place(src, tmp_path, allow_hardlink)
+        os.rename(tmp_path, dst)
+    except:  # noqa
+        _unlink(tmp_path)
+        raise
+    _LOGGER.debug("Imported %s into %s (%s)", src, dst, method)
+    return method
+
+
+def _place(src, tmp_path, allow_hardlink):
+    if allow_hardlink:
+        try:
+            os.link(src, tmp_path)
+            return HARDLINK
+        except OSError, e:
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+    with open(src, 'rb') as fsrc:
+        # Same permissions a plain copy would have
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        with os.fdopen(fd, 'wb') as fdst:
+            for method, func in ((REFLINK, _reflink),
+                                 (COPY_FILE_RANGE, _kernel_copy)):
+                try:
+                    func(fsrc, fdst)
+                    return method
+                except (IOError, OSError), e:
+                    if e.errno not in UNSUPPORTED_ERRORS:
+                        raise
+                    # Start over, in case some of the data was copied
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, COPY_BLOCK_SIZE)
+            return COPY
+
+
+def _reflink(fsrc, fdst):
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _kernel_copy(fsrc, fdst):
+    copy_file_range = _get_copy_file_range()
+    if copy_file_range is None:
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    size = os.fstat(fsrc.fileno()).st_size
+    copied = 0
+    while copied < size:
+        count = copy_file_range(fsrc.fileno(), None, fdst.fileno(), None,
+                                min(size - copied, 1 << 30), 0)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        if count == 0:
+            # The file got truncated underneath us
+            break
+        copied += count
+    # Both file offsets were moved by copy_file_range
+    fdst.seek(copied)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -0,0 +1,111 @@
+"""
+Adaptive number of concurrent downloads.
+
+The downloader is started with as many threads as the upper bound allows,
+and units are only handed to it while a download slot is available. The
+number of slots is adjusted as downloads complete, by hill climbing on the
+aggregate throughput: it keeps moving in the same direction while the
+throughput improves, and turns around when it does not. A high error rate
+halves it.
+"""
+import logging
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Minimum duration of a measurement window, in seconds
+ADJUST_INTERVAL = 5
+# Relative throughput improvement worth another step in the same direction
+MIN_IMPROVEMENT = 0.05
+# Fraction of failed downloads, in a window, that halves the concurrency
+MAX_ERROR_RATE = 0.1
+
+
+class AdaptiveConcurrency(object):
+    def __init__(self, minimum, maximum, initial=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        if initial is None:
+            initial = self.minimum
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.active = 0
+        # Average throughput of a single download in the last window
+        self.connection_rate = None
+        self._cond = threading.Condition()
+        self._direction = 1
+        self._last_rate = None
+        self._new_window(time.time())
+
+    def _new_window(self, now):
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_failures = 0
+        self._window_seconds = 0.0
+
+    def acquire(self):
+        """
+        Wait for a download slot.
+        """
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait(1)
+            self.active += 1
+
+    def release(self, nbytes, seconds, failed=False):
+        """
+        Give back a download slot, recording how the download went.
+
+        :param nbytes: bytes downloaded
+        :param seconds: how long the download took, or None if unknown
+        :param failed: whether the download failed
+        :return: True if the concurrency changed
+        :rtype:  bool
+        """
+        with self._cond:
+            self.active = max(0, self.active - 1)
+            self._window_count += 1
+            self._window_bytes += nbytes
+            if failed:
+                self._window_failures += 1
+            if seconds:
+                self._window_seconds += seconds
+            changed = self._adjust(time.time())
+            self._cond.notify_all()
+            return changed
+
+    def throttle(self, items):
+        """
+        Generate the items, each one once a download slot is available.
+        """
+        for item in items:
+            self.acquire()
+            yield item
+
+    def _adjust(self, now):
+        elapsed = now - self._window_start
+        # Wait for a full round of downloads at the current limit
+        if elapsed < ADJUST_INTERVAL or self._window_count < self.limit:
+            return False
+        rate = self._window_bytes / elapsed
+        if self._window_seconds:
+            self.connection_rate = self._window_bytes / self._window_seconds
+        error_rate = float(self._window_failures) / self._window_count
+        previous = self.limit
+        if error_rate > MAX_ERROR_RATE:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._direction = 1
+        else:
+            if (self._last_rate is not None and
+                    rate <= self._last_rate * (1 + MIN_IMPROVEMENT)):
+                self._direction = -self._direction
+            self.limit = min(max(self.limit + self._direction, self.minimum),
+                             self.maximum)
+        self._last_rate = rate
+        self._new_window(now)
+        if self.limit != previous:
+            _LOGGER.debug(
+                "Download concurrency %s -> %s (%.0f B/s, %.0f%% errors)",
+                previous, self.limit, rate, error_rate * 100)
+        return self.limit != previous
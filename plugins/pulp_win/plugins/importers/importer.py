@@ -5,8 +5,9 @@ from pulp.plugins.importer import Importer
 from pulp.plugins.util import importer_config
 from pulp.server.db import model as platform_models
 from gettext import gettext as _
+from pulp_win.common import constants
 from pulp_win.common.ids import SUPPORTED_TYPES, TYPE_ID_IMPORTER_WIN
-from pulp_win.plugins.db import models
+from pulp_win.plugins.db import cache, models
 from pulp_win.plugins.importers import sync
 
 _LOG = logging.getLogger(__name__)
@@ -36,14 +37,129 @@ class WinImporter(Importer):
     def validate_config(self, repo, config):
         try:
             importer_config.validate_config(config)
-            return True, None
+            failure_messages = []
         except importer_config.InvalidConfig, e:
-            # Concatenate all of the failure messages into a single message
-            msg = _('Configuration errors:\n')
-            for failure_message in e.failure_messages:
-                msg += failure_message + '\n'
-            msg = msg.rstrip()  # remove the trailing \n
-            return False, msg
+            failure_messages = list(e.failure_messages)
+        failure_messages.extend(self._validate_win_config(config))
+        if not failure_messages:
+            return True, None
+        # Concatenate all of the failure messages into a single message
+        msg = _('Configuration errors:\n')
+        for failure_message in failure_messages:
+            msg += failure_message + '\n'
+        msg = msg.rstrip()  # remove the trailing \n
+        return False, msg
+
+    @classmethod
+    def _validate_win_config(cls, config):
+        failure_messages = []
+        backend = config.get(constants.CONFIG_METADATA_BACKEND)
+        if backend is not None and backend not in models.METADATA_BACKENDS:
+            failure_messages.append(
+                _('Unknown value for %(k)s: %(v)s') % dict(
+                    k=constants.CONFIG_METADATA_BACKEND, v=backend))
+        cache_size = config.get(constants.CONFIG_METADATA_CACHE_SIZE)
+        if cache_size is not None:
+            try:
+                if int(cache_size) < 0:
+                    raise ValueError(cache_size)
+            except (TypeError, ValueError):
+                failure_messages.append(
+                    _('%(k)s must be a non-negative integer') % dict(
+                        k=constants.CONFIG_METADATA_CACHE_SIZE))
+        workers = config.get(constants.CONFIG_NUM_PROCESSING_WORKERS)
+        if workers is not None:
+            try:
+                if int(workers) < 1:
+                    raise ValueError(workers)
+            except (TypeError, ValueError):
+                failure_messages.append(
+                    _('%(k)s must be a positive integer') % dict(
+                        k=constants.CONFIG_NUM_PROCESSING_WORKERS))
+        adaptive = config.get(constants.CONFIG_ADAPTIVE_CONCURRENCY)
+        if adaptive is not None and not isinstance(adaptive, bool):
+            failure_messages.append(
+                _('%(k)s must be a boolean') % dict(
+                    k=constants.CONFIG_ADAPTIVE_CONCURRENCY))
+        bounds = dict()
+        for key in (constants.CONFIG_MIN_THREADS,
+                    constants.CONFIG_MAX_THREADS):
+            value = config.get(key)
+            if value is None:
+                continue
+            try:
+                bounds[key] = int(value)
+                if bounds[key] < 1:
+                    raise ValueError(value)
+            except (TypeError, ValueError):
+                bounds.pop(key, None)
+                failure_messages.append(
+                    _('%(k)s must be a positive integer') % dict(k=key))
+        if bounds.get(constants.CONFIG_MIN_THREADS, 0) > bounds.get(
+                constants.CONFIG_MAX_THREADS,
+                constants.CONFIG_MAX_THREADS_DEFAULT):
+            failure_messages.append(
+                _('%(k)s must not be greater than %(m)s') % dict(
+                    k=constants.CONFIG_MIN_THREADS,
+                    m=constants.CONFIG_MAX_THREADS))
+        threshold = config.get(constants.CONFIG_SEGMENTED_DOWNLOAD_THRESHOLD)
+        if threshold is not None:
+            try:
+                if int(threshold) < 0:
+                    raise ValueError(threshold)
+            except (TypeError, ValueError):
+                failure_messages.append(
+                    _('%(k)s must be a non-negative integer') % dict(
+                        k=constants.CONFIG_SEGMENTED_DOWNLOAD_THRESHOLD))
+        segments = config.get(constants.CONFIG_DOWNLOAD_SEGMENTS)
+        if segments is not None:
+            try:
+                if int(segments) < 1:
+                    raise ValueError(segments)
+            except (TypeError, ValueError):
+                failure_messages.append(
+                    _('%(k)s must be a positive integer') % dict(
+                        k=constants.CONFIG_DOWNLOAD_SEGMENTS))
+        stripe = config.get(constants.CONFIG_STRIPE_MIRRORS)
+        if stripe is not None and not isinstance(stripe, bool):
+            failure_messages.append(
+                _('%(k)s must be a boolean') % dict(
+                    k=constants.CONFIG_STRIPE_MIRRORS))
+        probe = config.get(constants.CONFIG_PROBE_MIRRORS)
+        if probe is not None and not isinstance(probe, bool):
+            failure_messages.append(
+                _('%(k)s must be a boolean') % dict(
+                    k=constants.CONFIG_PROBE_MIRRORS))
+        probe_ttl = config.get(constants.CONFIG_MIRROR_PROBE_TTL)
+        if probe_ttl is not None:
+            try:
+                if int(probe_ttl) < 0:
+                    raise ValueError(probe_ttl)
+            except (TypeError, ValueError):
+                failure_messages.append(
+                    _('%(k)s must be a non-negative integer') % dict(
+                        k=constants.CONFIG_MIRROR_PROBE_TTL))
+        force_full_sync = config.get(constants.CONFIG_FORCE_FULL_SYNC)
+        if force_full_sync is not None and \
+                not isinstance(force_full_sync, bool):
+            failure_messages.append(
+                _('%(k)s must be a boolean') % dict(
+                    k=constants.CONFIG_FORCE_FULL_SYNC))
+        trust = config.get(constants.CONFIG_TRUST_UPSTREAM_METADATA)
+        if trust is not None and not isinstance(trust, bool):
+            failure_messages.append(
+                _('%(k)s must be a boolean') % dict(
+                    k=constants.CONFIG_TRUST_UPSTREAM_METADATA))
+        audit_rate = config.get(constants.CONFIG_TRUST_AUDIT_RATE)
+        if audit_rate is not None:
+            try:
+                if not 0 <= float(audit_rate) <= 1:
+                    raise ValueError(audit_rate)
+            except (TypeError, ValueError):
+                failure_messages.append(
+                    _('%(k)s must be a number between 0 and 1') % dict(
+                        k=constants.CONFIG_TRUST_AUDIT_RATE))
+        return failure_messages
 
     def upload_unit(self, transfer_repo, type_id, unit_key, metadata,
                     file_path, conduit, config):
@@ -59,16 +175,26 @@ class WinImporter(Importer):
         unit_data.update(metadata or {})
         unit_data.update(unit_key or {})
 
+        metadata_backend = config.get(constants.CONFIG_METADATA_BACKEND)
+        metadata_cache = cache.MetadataCache.from_config(config)
         try:
-            unit = model_class.from_file(file_path, unit_data)
+            unit = model_class.from_file(file_path, unit_data,
+                                         metadata_backend=metadata_backend,
+                                         metadata_cache=metadata_cache)
         except models.Error as e:
             return self.fail_report(str(e))
 
-        unit = unit.save_and_associate(file_path, repo)
+        # The uploaded file is removed once imported, so content storage can
+        # take it over (hard link) if it is on the same filesystem
+        unit = unit.save_and_associate(file_path, repo, link_content=True)
+        if unit.import_method is not None:
+            _LOG.info("Imported %s into content storage (%s)" %
+                      (unit.filename, unit.import_method))
         return dict(success_flag=True, summary="",
                     details=dict(
                         unit=dict(unit_key=unit.unit_key,
-                                  metadata=unit.all_properties)))
+                                  metadata=unit.all_properties),
+                        import_method=unit.import_method))
 
     def import_units(self, source_transfer_repo, dest_transfer_repo,
                      import_conduit, config, units=None):
@@ -86,8 +212,7 @@ class WinImporter(Importer):
         units = sorted(set(units))
         _LOG.info("Importing %s units from %s to %s" %
                   (len(units), source_repo.id, dest_repo.id))
-        for u in units:
-            u.associate(dest_repo)
+        models.Package.bulk_associate(units, dest_repo)
         _LOG.debug("%s units from %s have been associated to %s" %
                    (len(units), source_repo.id, dest_repo.id))
         return units
@@ -136,3 +261,48 @@ class WinImporter(Importer):
         report = self._current_sync.run()
         _LOG.info("Repo sync finished.")
         return report
+
+    def sync_repo_group(self, repos_to_sync):
+        """
+        Synchronizes several repositories sharing a feed in a single pass:
+        the upstream metadata is downloaded and parsed once, each missing
+        file is downloaded once, and units are associated with all the
+        repositories in bulk.
+
+        Pulp itself only ever calls sync_repo, one repository at a time:
+        this is meant for code running in a Pulp worker task (for instance,
+        a site-specific Celery task), which builds the arguments the way
+        Pulp's sync controller does for sync_repo, and records the sync
+        results and last sync time of each repository itself. Content unit
+        counts are rebuilt here for every repository.
+
+        :param repos_to_sync: (transfer_repo, sync_conduit, call_config)
+                              tuples, as passed to sync_repo, one per
+                              repository. All must use the same feed.
+        :type  repos_to_sync: list
+
+        :return: a report of the details of the sync for each repository,
+                 in the same order
+        :rtype:  list of pulp.plugins.model.SyncReport
+        """
+        _LOG.info("Group sync of %s repos started." % len(repos_to_sync))
+        syncs = []
+        for transfer_repo, sync_conduit, call_config in repos_to_sync:
+            repo = transfer_repo.repo_obj
+            sync_conduit.repo = repo
+            syncs.append(sync.RepoSync(repo, sync_conduit, call_config))
+        self._current_sync = sync.RepoSync.grouped(syncs)
+        report = self._current_sync.run()
+        reports = [report]
+        for member in syncs[1:]:
+            if report.success_flag:
+                build_report = member.conduit.build_success_report
+            else:
+                build_report = member.conduit.build_failure_report
+            reports.append(build_report(self._current_sync.progress_summary,
+                                        self._current_sync.progress_report))
+        for member in syncs:
+            models.repo_controller.rebuild_content_unit_counts(
+                member.conduit.repo)
+        _LOG.info("Group sync finished.")
+        return reports
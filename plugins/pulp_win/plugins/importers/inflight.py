@@ -0,0 +1,151 @@
+"""
+Registry of the downloads in progress on this host.
+
+Repositories whose feeds overlap are often synced at the same time, by
+different workers. Before downloading a unit, a sync claims it, keyed by
+(checksumtype, checksum); a sync that finds the unit claimed elsewhere waits
+for that download to finish, and then picks up the saved unit instead of
+downloading it again.
+
+A claim is an exclusive flock on a file named after the key, in Pulp's
+working directory, so claims are visible to all the workers on the host, and
+go away with the process holding them if it dies. Claim files are removed on
+release; a process that locked a file removed in the meantime tries again.
+"""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from pulp.server import config as pulp_config
+
+_LOGGER = logging.getLogger(__name__)
+
+REGISTRY_DIRNAME = 'win_downloads'
+# Seconds between checks while waiting for a download made elsewhere
+POLL_INTERVAL = 1
+# Longest wait for a download made elsewhere, after which it is made again
+WAIT_TIMEOUT = 3600
+
+
+class DownloadRegistry(object):
+    def __init__(self, path):
+        self.path = path
+        # key -> file descriptor holding the lock
+        self._claims = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        working_dir = pulp_config.config.get('server', 'working_directory')
+        return cls(os.path.join(working_dir, REGISTRY_DIRNAME))
+
+    def _claim_path(self, key):
+        # Checksums come from upstream metadata; never use them as paths
+        return os.path.join(self.path,
+                            hashlib.sha1('%s:%s' % key).hexdigest())
+
+    def _open(self, key):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return os.open(self._claim_path(key), os.O_RDWR | os.O_CREAT, 0644)
+
+    def _try_lock(self, fd, operation):
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def claim(self, key):
+        """
+        Claim the download of a unit.
+
+        :param key: (checksumtype, checksum) tuple
+        :return: True if the download is now claimed by this registry, False
+                 if it is in progress elsewhere
+        :rtype:  bool
+        """
+        with self._lock:
+            if key in self._claims:
+                return True
+            while True:
+                fd = self._open(key)
+                if not self._try_lock(fd, fcntl.LOCK_EX):
+                    os.close(fd)
+                    return False
+                if self._is_current(fd, key):
+                    self._claims[key] = fd
+                    return True
+                # Released (and removed) between open and lock
+                os.close(fd)
+
+    def _is_current(self, fd, key):
+        try:
+            return os.fstat(fd).st_ino == os.stat(
+                self._claim_path(key)).st_ino
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def release(self, key):
+        """
+        Release the claim on a download, if this registry holds it.
+        """
+        with self._lock:
+            fd = self._claims.pop(key, None)
+            if fd is None:
+                return
+            try:
+                os.unlink(self._claim_path(key))
+            except OSError:
+                pass
+            os.close(fd)
+
+    def release_all(self):
+        with self._lock:
+            keys = list(self._claims)
+        for key in keys:
+            self.release(key)
+
+    def wait(self, key, timeout=WAIT_TIMEOUT, cancel=None):
+        """
+        Wait for the download of a unit, claimed elsewhere, to finish.
+
+        :param cancel: threading.Event that ends the wait when set
+        :return: True if the download is no longer in progress, False if it
+                 still was when the timeout expired or the wait was
+                 cancelled
+        :rtype:  bool
+        """
+        deadline = time.time() + timeout
+        try:
+            fd = os.open(self._claim_path(key), os.O_RDONLY)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Already released
+            return True
+        try:
+            while not self._try_lock(fd, fcntl.LOCK_SH):
+                if time.time() >= deadline:
+                    _LOGGER.warning("Timed out waiting for the download of "
+                                    "%s:%s", *key)
+                    return False
+                if cancel is None:
+                    time.sleep(POLL_INTERVAL)
+                elif cancel.wait(POLL_INTERVAL) or cancel.is_set():
+                    return False
+        finally:
+            os.close(fd)
+        return True
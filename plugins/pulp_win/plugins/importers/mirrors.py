@@ -0,0 +1,109 @@
+"""
+Mirrors packages are downloaded from, when the feed lists several.
+
+Each download goes to a mirror picked at random, weighted by the throughput
+observed from it so far; mirrors not measured yet get the average weight,
+so they are tried too. A mirror that fails is left out for a while, twice
+as long after each consecutive error.
+"""
+import logging
+import random
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds a mirror is left out after an error
+ERROR_BACKOFF = 30
+MAX_BACKOFF = 600
+# Weight of the latest download in the throughput of a mirror
+SMOOTHING = 0.3
+
+
+class Mirror(object):
+    __slots__ = ('url', 'rate', 'errors', 'available_at')
+
+    def __init__(self, url):
+        self.url = url
+        # Bytes per second, None until measured
+        self.rate = None
+        # Consecutive errors
+        self.errors = 0
+        self.available_at = 0
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.url)
+
+
+class MirrorSet(object):
+    def __init__(self, urls):
+        self.mirrors = []
+        for url in urls:
+            if not url.endswith('/'):
+                url += '/'
+            if url not in [m.url for m in self.mirrors]:
+                self.mirrors.append(Mirror(url))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def _get(self, url):
+        for mirror in self.mirrors:
+            if url.startswith(mirror.url):
+                return mirror
+        return None
+
+    def choose(self, exclude=()):
+        """
+        Pick a mirror to download from.
+
+        :param exclude: URLs of the mirrors not to pick
+        :return: the URL of the mirror, or None if all are excluded
+        :rtype:  str
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [m for m in self.mirrors if m.url not in exclude]
+            if not candidates:
+                return None
+            available = [m for m in candidates if m.available_at <= now]
+            if not available:
+                # All of them failed recently; do not stall
+                available = [min(candidates, key=lambda m: m.available_at)]
+            rates = [m.rate for m in available if m.rate]
+            default = sum(rates) / len(rates) if rates else 1.0
+            weights = [m.rate or default for m in available]
+            pick = random.uniform(0, sum(weights))
+            for mirror, weight in zip(available, weights):
+                pick -= weight
+                if pick <= 0:
+                    break
+            return mirror.url
+
+    def record(self, url, nbytes, seconds, failed=False):
+        """
+        Record how a download from a mirror went.
+
+        :param url: the URL of the mirror, or of the file downloaded from it
+        """
+        with self._lock:
+            mirror = self._get(url)
+            if mirror is None:
+                return
+            if failed:
+                mirror.errors += 1
+                backoff = min(ERROR_BACKOFF * 2 ** (mirror.errors - 1),
+                              MAX_BACKOFF)
+                mirror.available_at = time.time() + backoff
+                _LOGGER.info("Leaving out mirror %s for %s seconds",
+                             mirror.url, backoff)
+                return
+            mirror.errors = 0
+            if not seconds:
+                return
+            rate = nbytes / seconds
+            if mirror.rate is None:
+                mirror.rate = rate
+            else:
+                mirror.rate += SMOOTHING * (rate - mirror.rate)
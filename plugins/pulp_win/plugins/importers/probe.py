@@ -0,0 +1,117 @@
+"""
+Latency probes of the mirrors of a feed.
+
+repomd.xml is fetched from all the mirrors at once, recording how long each
+one took to return it and the revision it carries. Mirrors with the newest
+revision come first, fastest first, followed by the ones lagging behind,
+then by the ones that could not be probed, in their original order.
+"""
+import logging
+import threading
+import time
+import urlparse
+from xml.etree import cElementTree
+
+_LOGGER = logging.getLogger(__name__)
+
+# (connect, read) timeouts, in seconds; a mirror this slow is ranked last
+# anyway
+PROBE_TIMEOUT = (3.05, 10)
+REPOMD_PATH = 'repodata/repomd.xml'
+REVISION_TAG = '{http://linux.duke.edu/metadata/repo}revision'
+
+
+class ProbeResult(object):
+    __slots__ = ('url', 'latency', 'revision', 'error')
+
+    def __init__(self, url, latency=None, revision=None, error=None):
+        self.url = url
+        # Seconds taken to return repomd.xml
+        self.latency = latency
+        self.revision = revision
+        self.error = error
+
+    def __repr__(self):
+        return '<%s: %s %s %s>' % (self.__class__.__name__, self.url,
+                                   self.latency, self.revision or self.error)
+
+
+def revision_key(revision):
+    """
+    Sort key for repomd revisions: usually timestamps, compared as numbers
+    when they are; anything else compares as a string, below any number.
+    """
+    if revision is None:
+        return (0, 0, '')
+    try:
+        return (2, int(revision), '')
+    except ValueError:
+        return (1, 0, revision)
+
+
+def probe(session, urls, timeout=PROBE_TIMEOUT, url_modify=None):
+    """
+    Fetch repomd.xml from each of urls, on its own thread.
+
+    :param session: requests session to use
+    :param url_modify: called with the URL of each repomd.xml, returns the
+                       URL to request
+    :return: a ProbeResult for each URL, in the same order
+    :rtype:  list
+    """
+    results = [ProbeResult(url) for url in urls]
+    threads = [threading.Thread(target=_probe_one,
+                                args=(session, result, timeout, url_modify))
+               for result in results]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _probe_one(session, result, timeout, url_modify):
+    url = result.url
+    if not url.endswith('/'):
+        url += '/'
+    url = urlparse.urljoin(url, REPOMD_PATH)
+    if url_modify is not None:
+        url = url_modify(url)
+    start = time.time()
+    try:
+        response = session.get(url, timeout=timeout)
+        try:
+            if response.status_code != 200:
+                result.error = 'HTTP %s %s' % (response.status_code,
+                                               response.reason)
+                return
+            content = response.content
+        finally:
+            response.close()
+        result.latency = time.time() - start
+        revision = cElementTree.fromstring(content).find(REVISION_TAG)
+        if revision is not None and revision.text:
+            result.revision = revision.text.strip()
+    except Exception, e:
+        # Whatever went wrong, the mirror is just ranked last
+        result.latency = None
+        result.error = str(e) or e.__class__.__name__
+    if result.error:
+        _LOGGER.info("Probing %s failed: %s", url, result.error)
+
+
+def rank(results):
+    """
+    Order probed mirrors: newest revision first, then lowest latency.
+    Mirrors that could not be probed come last.
+
+    :return: the URLs of the mirrors
+    :rtype:  list
+    """
+    probed = [r for r in results if r.error is None]
+    # Stable sorts: by latency within each revision
+    probed.sort(key=lambda r: r.latency)
+    probed.sort(key=lambda r: revision_key(r.revision), reverse=True)
+    return ([r.url for r in probed] +
+            [r.url for r in results if r.error is not None])
@@ -0,0 +1,260 @@
+"""
+Downloads made with HTTP Range requests.
+
+nectar only accepts complete (200) responses, so files partially downloaded
+by an earlier sync are resumed here instead, with a requests session
+configured like nectar's, and so are large files fetched as several byte
+ranges in parallel.
+
+Data is written at the requested offset, and the offset up to which it is
+known to be on disk is reported every CHECKPOINT_SIZE bytes. A transfer
+that breaks is retried from there, and so can the next sync, once the
+offset is journaled.
+"""
+import functools
+import logging
+import os
+import re
+import threading
+
+_LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Bytes written between checkpoints
+CHECKPOINT_SIZE = 16 * CHUNK_SIZE
+# (connect, read) timeouts, in seconds, when nectar's are not configured
+DEFAULT_TIMEOUT = (6.05, 27)
+# Attempts at a transfer, each one resuming where the previous one broke
+DEFAULT_TRIES = 5
+
+_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class RangeDownloadError(IOError):
+    """
+    Unexpected response; not retried.
+    """
+
+
+class RangeNotSupported(RangeDownloadError):
+    """
+    The server returned the whole file for a byte range.
+    """
+
+
+class IncompleteDownload(IOError):
+    """
+    The transfer ended before all the data was received.
+    """
+
+
+def split(size, count):
+    """
+    Split a file into count segments of about the same size.
+
+    :return: [start, end, done] lists: the byte range [start, end) of each
+             segment, and the offset up to which it was downloaded
+    :rtype:  list
+    """
+    count = max(1, min(count, size))
+    bounds = [size * idx // count for idx in range(count + 1)]
+    return [[start, end, start] for start, end in zip(bounds, bounds[1:])]
+
+
+class RangeDownloader(object):
+    def __init__(self, session, timeout=DEFAULT_TIMEOUT, tries=DEFAULT_TRIES):
+        self.session = session
+        self.timeout = timeout
+        self.tries = tries
+
+    @classmethod
+    def from_nectar_config(cls, nectar_config):
+        # Imported here, so the rest of the module does not need nectar
+        from nectar.downloaders import threaded
+        timeout = (
+            getattr(nectar_config, 'connect_timeout', None) or
+            DEFAULT_TIMEOUT[0],
+            getattr(nectar_config, 'read_timeout', None) or
+            DEFAULT_TIMEOUT[1])
+        return cls(threaded.build_session(nectar_config), timeout)
+
+    def fetch(self, url, path, offset=0, checkpoint=None):
+        """
+        Download url into path, starting at offset. The file is created if
+        needed; data past offset is replaced. If the server does not
+        honor the Range request, the whole file is downloaded again.
+
+        :param checkpoint: called with the offset up to which data is on
+                           disk, every CHECKPOINT_SIZE bytes
+        :return: the size of the file
+        :rtype:  int
+
+        :raises RangeDownloadError: on an unexpected response
+        :raises IOError: if the transfer failed self.tries times
+        """
+        progress = [offset]
+
+        def _checkpoint(done):
+            progress[0] = done
+            if checkpoint is not None:
+                checkpoint(done)
+
+        return self._with_retries(url, lambda: self._fetch(
+            url, path, progress[0], _checkpoint))
+
+    def fetch_segmented(self, url, path, size, segments, checkpoint=None):
+        """
+        Download url into path as byte range segments, each one fetched on
+        its own thread.
+
+        :param segments: [start, end, done] lists, as returned by split();
+                         segments are resumed from done
+        :param checkpoint: called with the updated segments whenever one of
+                           them reaches a checkpoint
+        :return: the size of the file
+        :rtype:  int
+
+        :raises RangeNotSupported: if the server does not honor Range
+                                   requests
+        :raises RangeDownloadError: on an unexpected response
+        :raises IOError: if the transfer of a segment failed self.tries times
+        """
+        segments = [list(segment) for segment in segments]
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as fobj:
+            fobj.truncate(size)
+        lock = threading.Lock()
+        abort = threading.Event()
+        errors = []
+
+        def _checkpoint(segment, done):
+            with lock:
+                segment[2] = done
+                if checkpoint is not None:
+                    checkpoint([list(s) for s in segments])
+
+        def _run(segment):
+            try:
+                self._with_retries(url, lambda: self._fetch_segment(
+                    url, path, segment,
+                    functools.partial(_checkpoint, segment), abort))
+            except Exception, e:
+                with lock:
+                    errors.append(e)
+                # No point going on with the other segments
+                abort.set()
+
+        threads = [threading.Thread(target=_run, args=(segment, ))
+                   for segment in segments if segment[2] < segment[1]]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # The first error is the cause, the others are aborts
+            raise errors[0]
+        return size
+
+    def _with_retries(self, url, attempt):
+        for remaining in reversed(range(self.tries)):
+            try:
+                return attempt()
+            except RangeDownloadError:
+                raise
+            except IOError, e:
+                if not remaining:
+                    raise
+                _LOGGER.info("%s: %s; resuming", url, e)
+
+    def _get(self, url, headers):
+        return self.session.get(url, headers=headers, stream=True,
+                                timeout=self.timeout)
+
+    def _fetch(self, url, path, offset, checkpoint):
+        headers = dict()
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        response = self._get(url, headers)
+        try:
+            if response.status_code == 416 and offset:
+                # Nothing past offset: the file is already complete
+                return offset
+            if response.status_code == 200:
+                if offset:
+                    _LOGGER.info("%s: Range not honored, restarting", url)
+                offset = 0
+            else:
+                self._check_partial(response, url, offset)
+            end = None
+            if response.headers.get('Content-Length'):
+                end = offset + int(response.headers['Content-Length'])
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as fobj:
+                fobj.seek(offset)
+                fobj.truncate()
+                return self._write(response, fobj, url, offset, end,
+                                   checkpoint)
+        finally:
+            response.close()
+
+    def _fetch_segment(self, url, path, segment, checkpoint, abort):
+        start, end, done = segment
+        response = self._get(url, {'Range': 'bytes=%d-%d' % (done, end - 1)})
+        try:
+            if response.status_code == 200:
+                raise RangeNotSupported('%s: Range not honored' % url)
+            self._check_partial(response, url, done)
+            with open(path, 'r+b') as fobj:
+                return self._write(response, fobj, url, done, end,
+                                   checkpoint, abort)
+        finally:
+            response.close()
+
+    @classmethod
+    def _check_partial(cls, response, url, offset):
+        if response.status_code != 206:
+            raise RangeDownloadError(
+                '%s: HTTP %s %s' % (url, response.status_code,
+                                    response.reason))
+        match = _CONTENT_RANGE.match(
+            response.headers.get('Content-Range') or '')
+        if match is None:
+            raise RangeDownloadError(
+                '%s: invalid Content-Range %r' % (
+                    url, response.headers.get('Content-Range')))
+        if int(match.group(1)) != offset:
+            raise RangeDownloadError(
+                '%s: asked for data from %d, got it from %s' % (
+                    url, offset, match.group(1)))
+
+    @classmethod
+    def _write(cls, response, fobj, url, offset, end, checkpoint,
+               abort=None):
+        """
+        Write the response body at offset, up to end if not None.
+        """
+        fobj.seek(offset)
+        last_checkpoint = offset
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if abort is not None and abort.is_set():
+                raise RangeDownloadError('%s: aborted' % url)
+            if end is not None:
+                chunk = chunk[:end - offset]
+            fobj.write(chunk)
+            offset += len(chunk)
+            if offset - last_checkpoint >= CHECKPOINT_SIZE:
+                cls._sync(fobj)
+                last_checkpoint = offset
+                checkpoint(offset)
+            if end is not None and offset >= end:
+                break
+        cls._sync(fobj)
+        checkpoint(offset)
+        if end is not None and offset < end:
+            raise IncompleteDownload(
+                '%s: transfer ended at %d, expected %d' % (url, offset, end))
+        return offset
+
+    @classmethod
+    def _sync(cls, fobj):
+        fobj.flush()
+        os.fsync(fobj.fileno())
@@ -2,6 +2,7 @@
 
 from gettext import gettext as _
 import logging
+import threading
 
 from pulp_win.common import constants
 from pulp_win.plugins.db import models
@@ -19,6 +20,13 @@ type_total_map = {
     'msm_total': models.MSM.TYPE,
 }
 
+type_total_attr_map = dict((v, k) for k, v in type_total_map.items())
+
+type_removed_map = {
+    models.MSI.TYPE: 'msi_removed',
+    models.MSM.TYPE: 'msm_removed',
+}
+
 
 class DistributionReport(dict):
     def __init__(self):
@@ -34,6 +42,9 @@ class DistributionReport(dict):
 
 class ContentReport(dict):
     def __init__(self):
+        # Units are counted from the pipeline producer, the processing
+        # thread and the range download pool at the same time
+        self._lock = threading.Lock()
         self['error_details'] = []
         self['items_total'] = 0
         self['items_left'] = 0
@@ -45,30 +56,65 @@ class ContentReport(dict):
             'msi_total': 0,
             'msm_done': 0,
             'msm_total': 0,
+            'msi_removed': 0,
+            'msm_removed': 0,
         }
 
     def set_initial_values(self, counts, total_size):
-        self['size_total'] = total_size
-        self['size_left'] = total_size
-        self['items_total'] = sum(counts.values())
-        self['items_left'] = sum(counts.values())
-        for total_name, total_type in type_total_map.iteritems():
-            self['details'][total_name] = counts.get(total_type, 0)
+        with self._lock:
+            self['size_total'] = total_size
+            self['size_left'] = total_size
+            self['items_total'] = sum(counts.values())
+            self['items_left'] = sum(counts.values())
+            for total_name, total_type in type_total_map.iteritems():
+                self['details'][total_name] = counts.get(total_type, 0)
+
+    def skipped(self, model):
+        """
+        Remove from the totals a unit that does not need to be downloaded.
+        """
+        total_attribute = type_total_attr_map[model._content_type_id]
+        with self._lock:
+            self['items_total'] -= 1
+            self['items_left'] -= 1
+            self['size_total'] -= model.size or 0
+            self['size_left'] -= model.size or 0
+            self['details'][total_attribute] -= 1
+        return self
+
+    def concurrency(self, limit):
+        """
+        Record the number of concurrent downloads chosen in adaptive mode.
+        """
+        self['download_concurrency'] = limit
+        return self
+
+    def removed(self, model_class, count):
+        """
+        Record units no longer present upstream, removed from the repository.
+        """
+        removed_attribute = type_removed_map[model_class.TYPE]
+        with self._lock:
+            self['details'][removed_attribute] += count
+        return self
 
     def success(self, model):
-        self['items_left'] -= 1
-        if self['items_left'] % 100 == 0:
-            _logger.debug(_('%(n)s items left to download.') %
-                          {'n': self['items_left']})
-        self['size_left'] -= model.size
         done_attribute = type_done_map[model._content_type_id]
-        self['details'][done_attribute] += 1
+        with self._lock:
+            self['items_left'] -= 1
+            items_left = self['items_left']
+            self['size_left'] -= model.size
+            self['details'][done_attribute] += 1
+        if items_left % 100 == 0:
+            _logger.debug(_('%(n)s items left to download.') %
+                          {'n': items_left})
         return self
 
     def failure(self, model, error_report):
-        self['items_left'] -= 1
-        self['size_left'] -= model.size
         done_attribute = type_done_map[model._content_type_id]
-        self['details'][done_attribute] += 1
-        self['error_details'].append(error_report)
+        with self._lock:
+            self['items_left'] -= 1
+            self['size_left'] -= model.size or 0
+            self['details'][done_attribute] += 1
+            self['error_details'].append(error_report)
         return self
@@ -0,0 +1,243 @@
+"""
+Persistent staging area for downloads.
+
+Units are downloaded into a directory kept across syncs, one per repository,
+in Pulp's working directory, instead of the temporary directory of the sync.
+A journal records, for each file, the unit it is downloaded for (checksum
+type, checksum and size), the offset up to which its data is known to be on
+disk (or, for files downloaded in segments, the offset reached in each
+segment), and whether its checksum was verified. If a sync is cancelled or its
+worker dies, the next sync of the repository imports the complete files
+right away, and resumes the partial ones with HTTP Range requests.
+
+The journal is a file of JSON records, one per line, appended to as
+downloads progress; the last record for a file wins. It is rewritten, with
+one record per file, when the staging area is opened. Files and records
+that do not match are dropped then.
+"""
+import errno
+import json
+import logging
+import os
+import threading
+
+from pulp.server import config as pulp_config
+
+_LOGGER = logging.getLogger(__name__)
+
+STAGING_DIRNAME = 'win_staging'
+JOURNAL_FILENAME = '.journal'
+
+
+class StagingArea(object):
+    def __init__(self, path):
+        self.path = path
+        # file name -> journal record
+        self._entries = dict()
+        # file names used by this sync
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._journal = None
+        self._load()
+
+    @classmethod
+    def from_config(cls, repo_id):
+        working_dir = pulp_config.config.get('server', 'working_directory')
+        return cls(os.path.join(working_dir, STAGING_DIRNAME, repo_id))
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.path, JOURNAL_FILENAME)
+
+    @classmethod
+    def file_name(cls, unit):
+        # Same name the downloader saves the file as
+        return os.path.basename(unit.download_path)
+
+    def _load(self):
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        entries = dict()
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as fobj:
+                for line in fobj:
+                    try:
+                        entry = json.loads(line)
+                        entries[entry['name']] = entry
+                    except (ValueError, KeyError, TypeError):
+                        # Torn write, when the worker died
+                        continue
+        for name in os.listdir(self.path):
+            if name == JOURNAL_FILENAME:
+                continue
+            entry = entries.get(name)
+            if entry is None or not self._check(entry):
+                _LOGGER.debug("Removing stale staged file %s", name)
+                self._remove(name)
+            else:
+                self._entries[name] = entry
+        # Compact the journal
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as fobj:
+            for entry in self._entries.values():
+                fobj.write(json.dumps(entry) + '\n')
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        os.rename(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+
+    def _check(self, entry):
+        """
+        Bring the offset of an entry in line with the size of its file.
+        Return False if the file cannot be used.
+        """
+        path = os.path.join(self.path, entry['name'])
+        if not os.path.isfile(path):
+            return False
+        file_size = os.path.getsize(path)
+        size = entry.get('size')
+        if entry.get('segments'):
+            # Segmented downloads are made into a file of the final size
+            if file_size != size:
+                return False
+            entry['offset'] = self._segments_done(entry['segments'])
+            return True
+        if size is not None and file_size > size:
+            return False
+        if entry.get('verified') and file_size != size:
+            return False
+        offset = entry.get('offset')
+        # Without an offset, the file was written sequentially by the
+        # downloader: all of it is usable
+        entry['offset'] = file_size if offset is None else min(offset,
+                                                               file_size)
+        return True
+
+    @classmethod
+    def _segments_done(cls, segments):
+        return sum(done - start for start, _, done in segments)
+
+    def _remove(self, name):
+        try:
+            os.unlink(os.path.join(self.path, name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _record(self, entry, sync=False):
+        self._entries[entry['name']] = entry
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
+        if sync:
+            os.fsync(self._journal.fileno())
+
+    def _matches(self, entry, unit):
+        return (entry['checksumtype'] == unit.checksumtype and
+                entry['checksum'] == unit.checksum and
+                entry.get('size') == unit.size)
+
+    def lookup(self, unit):
+        """
+        Find what an earlier sync downloaded for a unit.
+
+        :return: (path, offset, segments) for the staged file; offset is
+                 the number of bytes downloaded, 0 if nothing usable was;
+                 segments is None unless the file is downloaded in segments
+        :rtype:  tuple
+        """
+        name = self.file_name(unit)
+        path = os.path.join(self.path, name)
+        with self._lock:
+            self._seen.add(name)
+            entry = self._entries.get(name)
+            if entry is None:
+                return path, 0, None
+            if not self._matches(entry, unit):
+                # Same file name, different unit upstream
+                del self._entries[name]
+                self._remove(name)
+                return path, 0, None
+            return path, entry['offset'], entry.get('segments')
+
+    def start(self, unit, segments=None):
+        """
+        Record that a unit is about to be downloaded from scratch.
+
+        :param segments: the segments, as returned by ranged.split(), if the
+                         file is downloaded in segments
+        :return: the path to download to
+        :rtype:  str
+        """
+        name = self.file_name(unit)
+        with self._lock:
+            self._seen.add(name)
+            self._record(dict(name=name, checksumtype=unit.checksumtype,
+                              checksum=unit.checksum, size=unit.size,
+                              offset=None, segments=segments,
+                              verified=False))
+        return os.path.join(self.path, name)
+
+    def checkpoint(self, path, offset):
+        """
+        Record the offset up to which a file is known to be on disk.
+        """
+        name = os.path.basename(path)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            self._record(dict(entry, offset=offset), sync=True)
+
+    def checkpoint_segments(self, path, segments):
+        """
+        Record the offsets reached in the segments of a file.
+        """
+        name = os.path.basename(path)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            self._record(dict(entry, segments=segments,
+                              offset=self._segments_done(segments)),
+                         sync=True)
+
+    def verified(self, path):
+        """
+        Record that the checksum of a file was verified.
+        """
+        name = os.path.basename(path)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            with open(path, 'rb') as fobj:
+                os.fsync(fobj.fileno())
+            self._record(dict(entry, offset=os.path.getsize(path),
+                              segments=None, verified=True), sync=True)
+
+    def discard(self, path):
+        """
+        Forget about a file, and remove it.
+        """
+        name = os.path.basename(path)
+        with self._lock:
+            self._entries.pop(name, None)
+            self._remove(name)
+
+    def prune(self):
+        """
+        Remove the files not used by this sync, once it downloaded
+        everything it needed.
+        """
+        with self._lock:
+            for name in set(self._entries) - self._seen:
+                del self._entries[name]
+                self._remove(name)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
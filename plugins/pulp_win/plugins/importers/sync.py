@@ -1,16 +1,35 @@
+import functools
+import io
+import itertools
 import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import Queue
+import random
 import shutil
+import sys
 import tempfile
+import threading
+import time
 import traceback
+import urllib
+import urlparse
 from gettext import gettext as _
 
+from nectar.downloaders import threaded as nectar_threaded
+from nectar import report as nectar_report
+from nectar import request as nectar_request
+
 from pulp.common.plugins import importer_constants
 from pulp.plugins.util import verification
-from pulp.server.controllers import units as units_controller
+from pulp.server.db import model as platform_models
 from pulp.server.exceptions import PulpCodedException
 from pulp.server import util
 
-from pulp_win.plugins.db import models
+from pulp_win.common import constants
+from pulp_win.plugins.db import cache, models
+from pulp_win.plugins.importers import concurrency, inflight, mirrors, probe, ranged, staging
 from pulp_win.plugins.importers.report import ContentReport
 
 from pulp_rpm.plugins import error_codes
@@ -20,6 +39,139 @@ from pulp_rpm.plugins.importers.yum import sync as yumsync
 
 _logger = logging.getLogger(__name__)
 
+# Importer scratchpad key for the state of the last successful sync
+SCRATCHPAD_SYNC_STATE = 'win_sync_state'
+# Importer scratchpad key for the ranking of the mirrors of the feed
+SCRATCHPAD_MIRROR_RANKING = 'win_mirror_ranking'
+# Number of packages from primary.xml handled at once
+PRIMARY_BATCH_SIZE = 1000
+# Maximum number of units waiting to be handed to the downloader
+DOWNLOAD_QUEUE_SIZE = 1000
+# Parts of the sync state describing the upstream repository
+UPSTREAM_STATE_KEYS = ('revision', 'primary_checksum', 'etag', 'last_modified')
+
+
+class UpstreamPackage(object):
+    """
+    Compact record of a package listed in primary.xml, used while deciding
+    what to download instead of a full document. Only units that are
+    actually saved become documents, with to_unit().
+    """
+    UNIT_KEY_FIELDS = ('name', 'version', 'checksumtype', 'checksum')
+    __slots__ = UNIT_KEY_FIELDS + (
+        'model_class', 'size', 'relativepath', 'filename', 'extra')
+
+    def __init__(self, model_class, package_info):
+        self.model_class = model_class
+        package_info = dict(package_info)
+        for fname in self.UNIT_KEY_FIELDS:
+            setattr(self, fname, package_info.pop(fname, None))
+        self.size = package_info.pop('size', None)
+        self.relativepath = package_info.pop('relativepath', None)
+        self.filename = package_info.pop('filename', None)
+        # Whatever other fields primary.xml had
+        self.extra = tuple(sorted(package_info.items()))
+
+    def __repr__(self):
+        return '<%s: %s-%s>' % (self.__class__.__name__, self.name,
+                                self.version)
+
+    @property
+    def _content_type_id(self):
+        return self.model_class.TYPE_ID
+
+    @property
+    def unit_key(self):
+        return dict((fname, getattr(self, fname))
+                    for fname in self.model_class.unit_key_fields)
+
+    @property
+    def unit_key_as_named_tuple(self):
+        return self.model_class.NAMED_TUPLE(**self.unit_key)
+
+    @property
+    def download_key(self):
+        return (self.checksumtype, self.checksum)
+
+    @property
+    def unit_key_digest(self):
+        return self.model_class.unit_key_digest(self.unit_key)
+
+    @property
+    def download_path(self):
+        return self.relativepath
+
+    def to_unit(self):
+        fields = dict(self.extra)
+        fields.update(self.unit_key)
+        fields.update(size=self.size, relativepath=self.relativepath,
+                      filename=self.filename)
+        return self.model_class(**fields)
+
+
+class PackageExtractor(object):
+    """
+    Builds UpstreamPackage records for one unit type out of primary.xml
+    package elements.
+
+    The mapping of tags to fields is computed once, and each element's
+    children are walked only once.
+    """
+    SIZE_TAG = '{%s}size' % primary.COMMON_SPEC_URL
+    CHECKSUM_TAG = '{%s}checksum' % primary.COMMON_SPEC_URL
+
+    def __init__(self, klass):
+        self.klass = klass
+        field_names = set(klass._fields.keys())
+        field_names.add('size')
+        # Set by the sync, not read from upstream
+        field_names.discard('metadata_source')
+        self.tag_to_field = dict(
+            ('{%s}%s' % (primary.COMMON_SPEC_URL, fname), fname)
+            for fname in field_names if not fname.startswith('_'))
+        if 'relativepath' in klass._fields:
+            self.location_tag = primary.LOCATION_TAG
+        else:
+            self.location_tag = None
+
+    def __call__(self, el):
+        package_info = dict()
+        relativepath = None
+        tag_to_field = self.tag_to_field
+        for child in el:
+            tag = child.tag
+            if tag == self.location_tag:
+                if relativepath is None:
+                    relativepath = child.attrib['href']
+                continue
+            fname = tag_to_field.get(tag)
+            # Like find(), the first element with the tag wins
+            if fname is None or fname in package_info:
+                continue
+            if tag == self.SIZE_TAG:
+                try:
+                    package_info[fname] = int(child.attrib.get('package', 0))
+                except ValueError:
+                    package_info[fname] = 0
+                continue
+            package_info[fname] = child.text
+            if tag == self.CHECKSUM_TAG and 'type' in child.attrib:
+                package_info['checksumtype'] = child.attrib['type']
+        if relativepath is not None:
+            package_info['relativepath'] = relativepath
+        package_info['filename'] = self.klass.filename_from_unit_key(
+            package_info)
+        return UpstreamPackage(self.klass, package_info)
+
+
+def package_list_generator(xml_handle, process_func):
+    """
+    Generate the result of process_func for each package element in
+    primary.xml.
+    """
+    return packages.package_list_generator(
+        xml_handle, primary.PACKAGE_TAG, process_func)
+
 
 class RepoSync(yumsync.RepoSync):
 
@@ -27,6 +179,8 @@ class RepoSync(yumsync.RepoSync):
         models.MSI.TYPE_ID: models.MSI,
         models.MSM.TYPE_ID: models.MSM,
     }
+    Extractors = dict((type_id, PackageExtractor(klass))
+                      for type_id, klass in Type_Class_Map.items())
 
     def __init__(self, *args, **kwargs):
         super(RepoSync, self).__init__(*args, **kwargs)
@@ -37,6 +191,101 @@ class RepoSync(yumsync.RepoSync):
         }
         # Enforce validation of downloaded content
         self.config.override_config[importer_constants.KEY_VALIDATE] = True
+        self.metadata_backend = self.config.get(
+            constants.CONFIG_METADATA_BACKEND)
+        self.metadata_cache = cache.MetadataCache.from_config(self.config)
+        self.trust_upstream_metadata = bool(self.config.get(
+            constants.CONFIG_TRUST_UPSTREAM_METADATA,
+            constants.CONFIG_TRUST_UPSTREAM_METADATA_DEFAULT))
+        self.trust_audit_rate = float(self.config.get(
+            constants.CONFIG_TRUST_AUDIT_RATE,
+            constants.CONFIG_TRUST_AUDIT_RATE_DEFAULT))
+        self.num_processing_workers = int(
+            self.config.get(constants.CONFIG_NUM_PROCESSING_WORKERS) or
+            multiprocessing.cpu_count())
+        # Same option pulp_rpm uses, set by --remove-missing
+        self.remove_missing = bool(self.config.get(
+            importer_constants.KEY_UNITS_REMOVE_MISSING,
+            constants.CONFIG_REMOVE_MISSING_UNITS_DEFAULT))
+        # Digests of the unit keys of the units saved or associated by this
+        # sync, if missing units are removed
+        self.synced_unit_keys = None
+        # Downloads in progress, shared with the other syncs on this host
+        self.download_registry = inflight.DownloadRegistry.from_config()
+        # Caching headers returned with repomd.xml
+        self.repomd_headers = dict(etag=None, last_modified=None)
+        self.repomd_not_modified = False
+        # The syncs this one runs for, itself included; see grouped()
+        self.members = [self]
+        # Number of concurrent downloads, adjusted while downloading
+        self.concurrency = None
+        if self.config.get(constants.CONFIG_ADAPTIVE_CONCURRENCY,
+                           constants.CONFIG_ADAPTIVE_CONCURRENCY_DEFAULT):
+            self.concurrency = concurrency.AdaptiveConcurrency(
+                int(self.config.get(constants.CONFIG_MIN_THREADS,
+                                    constants.CONFIG_MIN_THREADS_DEFAULT)),
+                int(self.config.get(constants.CONFIG_MAX_THREADS,
+                                    constants.CONFIG_MAX_THREADS_DEFAULT)),
+                initial=int(self.config.get(
+                    constants.CONFIG_NUM_THREADS,
+                    constants.CONFIG_NUM_THREADS_DEFAULT)))
+            # The downloader thread count is fixed once started; start as
+            # many as may be needed, and only hand them units while a
+            # download slot is available
+            self.nectar_config.max_concurrent = self.concurrency.maximum
+        # Units at least this large are downloaded in segments, in parallel
+        self.segmented_download_threshold = int(
+            self.config.get(constants.CONFIG_SEGMENTED_DOWNLOAD_THRESHOLD) or
+            0)
+        self.download_segments = int(self.config.get(
+            constants.CONFIG_DOWNLOAD_SEGMENTS,
+            constants.CONFIG_DOWNLOAD_SEGMENTS_DEFAULT))
+        # Mirrors packages are striped across, if the feed lists several
+        self.mirrors = None
+        # Persistent download directory, while downloading
+        self.staging = None
+        self.range_downloader = None
+        # Bounds the range downloads queued on the pool, and with them the
+        # download claims held, unless adaptive concurrency does
+        self.range_slots = None
+
+    @classmethod
+    def grouped(cls, syncs):
+        """
+        Have the first of several syncs of repositories sharing a feed run
+        for all of them. Metadata is downloaded and parsed once, each file
+        is downloaded once, and units are associated with all the
+        repositories in bulk. Options about what to download (threads,
+        trust, processing workers) are taken from the first sync;
+        remove_missing and force_full_sync apply to each repository.
+
+        :param syncs: RepoSync instances, all with the same feed
+        :type  syncs: list
+        :return: the first sync, which run() syncs the whole group
+        :rtype:  RepoSync
+        """
+        leader = syncs[0]
+        for member in syncs[1:]:
+            if member.sync_feed != leader.sync_feed:
+                raise ValueError(
+                    'Repositories synced together must share a feed')
+            # Progress is reported for the whole group
+            member.content_report = leader.content_report
+            member.progress_report = leader.progress_report
+        leader.members = list(syncs)
+        return leader
+
+    @property
+    def repos(self):
+        return [member.conduit.repo for member in self.members]
+
+    @property
+    def progress_summary(self):
+        """
+        Summary of the progress report, as passed to the conduit when
+        building sync reports.
+        """
+        return self._progress_summary
 
     def run(self):
         """
@@ -50,8 +299,9 @@ class RepoSync(yumsync.RepoSync):
         if not self.sync_feed:
             raise PulpCodedException(error_code=error_codes.RPM1004,
                                      reason='Not found')
+        feed = self.ordered_feed()
         url_count = 0
-        for url in self.sync_feed:
+        for url in feed:
             # Verify that we have a feed url.
             # if there is no feed url, then we have nothing to sync
             if url is None:
@@ -63,14 +313,24 @@ class RepoSync(yumsync.RepoSync):
             try:
                 with self.update_state(self.progress_report['metadata']):
                     metadata_files = self.check_metadata(url)
-                    self.fix_metadata(metadata_files)
-                    metadata_files = self.get_metadata(metadata_files)
+                    unchanged = (
+                        self.repomd_not_modified or
+                        self.upstream_unchanged(metadata_files, url))
+                    if not unchanged:
+                        self.fix_metadata(metadata_files)
+                        metadata_files = self.get_metadata(metadata_files)
 
-                    # Save the default checksum from the metadata
-                    self.save_default_metadata_checksum_on_repo(metadata_files)
+                        # Save the default checksum from the metadata
+                        for member in self.members:
+                            member.save_default_metadata_checksum_on_repo(
+                                metadata_files)
 
                 with self.update_state(self.content_report) as skip:
-                    if not (skip or self.skip_repomd_steps):
+                    if unchanged:
+                        _logger.info(_('Upstream metadata has not changed '
+                                       'since the last sync, skipping.'))
+                        self.content_report['state'] = constants.STATE_SKIPPED
+                    elif not (skip or self.skip_repomd_steps):
                         self.update_content(metadata_files, url)
 
             except PulpCodedException, e:
@@ -81,7 +341,7 @@ class RepoSync(yumsync.RepoSync):
                 # exception.
                 bad_mirror_exceptions = [error_codes.RPM1004, error_codes.RPM1006]  # noqa
                 if (e.error_code in bad_mirror_exceptions) and \
-                        url_count != len(self.sync_feed):
+                        url_count != len(feed):
                             continue
                 else:
                     self._set_failed_state(e)
@@ -94,22 +354,169 @@ class RepoSync(yumsync.RepoSync):
                 _logger.exception(e)
                 self._set_failed_state(e)
                 report = self.conduit.build_failure_report(
-                    self._progress_summary, self.progress_report)
+                    self.progress_summary, self.progress_report)
                 return report
 
             finally:
                 # clean up whatever we may have left behind
                 shutil.rmtree(self.tmp_dir, ignore_errors=True)
 
-            if self.config.override_config.get(importer_constants.KEY_FEED):
-                self.erase_repomd_revision()
-            else:
-                self.save_repomd_revision()
+            for member in self.members:
+                if member.config.override_config.get(
+                        importer_constants.KEY_FEED):
+                    member.erase_repomd_revision()
+                    member.save_sync_state(None)
+                elif not self.repomd_not_modified:
+                    member.save_repomd_revision()
+                    member.repomd_headers = self.repomd_headers
+                    member.save_sync_state(
+                        member._sync_state(metadata_files, url))
 
             _logger.info(_('Sync complete.'))
-            return self.conduit.build_success_report(self._progress_summary,
+            return self.conduit.build_success_report(self.progress_summary,
                                                      self.progress_report)
 
+    def ordered_feed(self):
+        """
+        Return the URLs of the feed in the order they are tried. If the feed
+        lists several mirrors, the fastest one with the newest metadata
+        comes first, as found by probing them all; the ranking is reused
+        for mirror_probe_ttl seconds.
+        """
+        feed = list(self.sync_feed)
+        if not self.config.get(constants.CONFIG_PROBE_MIRRORS,
+                               constants.CONFIG_PROBE_MIRRORS_DEFAULT):
+            return feed
+        # Local feeds are not worth probing
+        if len(feed) < 2 or any(url is None or
+                                self.local_feed_dir(url) is not None
+                                for url in feed):
+            return feed
+        ttl = int(self.config.get(constants.CONFIG_MIRROR_PROBE_TTL,
+                                  constants.CONFIG_MIRROR_PROBE_TTL_DEFAULT))
+        now = time.time()
+        previous = (self.conduit.get_scratchpad() or {}).get(
+            SCRATCHPAD_MIRROR_RANKING)
+        if (ttl and previous and previous.get('feed') == feed and
+                0 <= now - previous.get('probed_at', 0) < ttl):
+            return list(previous['ranking'])
+        _logger.info(_('Probing %(n)s mirrors') % dict(n=len(feed)))
+        session = nectar_threaded.build_session(self.nectar_config)
+        results = probe.probe(session, feed, url_modify=self._url_modify)
+        ranking = probe.rank(results)
+        _logger.debug("Mirror probes: %s", results)
+        self.save_mirror_ranking(dict(feed=feed, probed_at=now,
+                                      ranking=ranking))
+        return ranking
+
+    def save_mirror_ranking(self, ranking):
+        scratchpad = self.conduit.get_scratchpad() or {}
+        scratchpad[SCRATCHPAD_MIRROR_RANKING] = ranking
+        self.conduit.set_scratchpad(scratchpad)
+
+    def _sync_state(self, metadata_files, url):
+        """
+        Describe the upstream metadata and the repository contents, so a
+        later sync can decide nothing changed.
+        """
+        if metadata_files is None:
+            return None
+        primary_info = metadata_files.metadata.get(
+            primary.METADATA_FILE_NAME) or {}
+        state = dict(
+            feed=url,
+            revision=metadata_files.revision,
+            primary_checksum=primary_info.get('checksum'),
+            content_count=self._repo_content_count())
+        state.update(self.repomd_headers)
+        state.update(self._sync_options())
+        return state
+
+    def _sync_options(self):
+        """
+        The options that change what a sync does with unchanged upstream
+        metadata: when they change, the next sync is a full one.
+        """
+        return dict(remove_missing=self.remove_missing,
+                    trust_upstream_metadata=self.trust_upstream_metadata,
+                    metadata_backend=self.metadata_backend)
+
+    def _repo_content_count(self):
+        return platform_models.RepositoryContentUnit.objects(
+            repo_id=self.conduit.repo.repo_id).count()
+
+    def _previous_sync_state(self, url):
+        """
+        Return the state recorded by the last successful sync of the same
+        feed, provided the repository still has the same number of units,
+        was synced with the same options, has no units waiting for their
+        metadata to be extracted, and a full sync was not requested; None
+        otherwise.
+        """
+        if self.config.get(constants.CONFIG_FORCE_FULL_SYNC,
+                           constants.CONFIG_FORCE_FULL_SYNC_DEFAULT):
+            return None
+        previous = (self.conduit.get_scratchpad() or {}).get(
+            SCRATCHPAD_SYNC_STATE)
+        if not previous or previous.get('feed') != url:
+            return None
+        if previous.get('content_count') != self._repo_content_count():
+            return None
+        if any(previous.get(k) != v
+               for k, v in self._sync_options().items()):
+            return None
+        if not self.trust_upstream_metadata and any(
+                model_class.repo_has_upstream_metadata(self.conduit.repo)
+                for model_class in self.Type_Class_Map.values()):
+            return None
+        return previous
+
+    def _group_previous_sync_state(self, url):
+        """
+        Return the state recorded by the last successful sync, if all the
+        repositories synced together have one, describing the same
+        upstream repository; None otherwise.
+        """
+        previous = self._previous_sync_state(url)
+        for member in self.members[1:]:
+            if previous is None:
+                break
+            state = member._previous_sync_state(url)
+            if state is None or any(state.get(k) != previous.get(k)
+                                    for k in UPSTREAM_STATE_KEYS):
+                return None
+        return previous
+
+    def upstream_unchanged(self, metadata_files, url):
+        """
+        Return True if the upstream repomd revision and primary checksum
+        match the ones recorded by the last successful sync, and the
+        repository has the same number of units the sync left it with.
+        """
+        if metadata_files is None:
+            return False
+        previous = self._group_previous_sync_state(url)
+        if previous is None:
+            return False
+        current = self._sync_state(metadata_files, url)
+        if current['primary_checksum'] is None:
+            return False
+        return (current['revision'] == previous.get('revision') and
+                current['primary_checksum'] ==
+                previous.get('primary_checksum'))
+
+    def save_sync_state(self, state):
+        if self.content_report['state'] == constants.STATE_FAILED:
+            return
+        if self.content_report['error_details'] or \
+                self.content_report['items_left']:
+            # Some units are missing: the next sync must not skip them
+            # because upstream did not change
+            state = None
+        scratchpad = self.conduit.get_scratchpad() or {}
+        scratchpad[SCRATCHPAD_SYNC_STATE] = state
+        self.conduit.set_scratchpad(scratchpad)
+
     def check_metadata(self, url):
         """
         Download and parse repomd.xml
@@ -130,7 +537,8 @@ class RepoSync(yumsync.RepoSync):
                                                 self._url_modify)
         _logger.error(self.tmp_dir)
         try:
-            metadata_files.download_repomd()
+            self.repomd_not_modified = self.download_repomd(metadata_files,
+                                                            url)
         except IOError as e:
             # remember the reason so it can be reported to the user if no treeinfo is found either.
             self.repomd_not_found_reason = e.message
@@ -141,6 +549,9 @@ class RepoSync(yumsync.RepoSync):
 
         self.skip_repomd_steps = False
         self.metadata_found = True
+        if self.repomd_not_modified:
+            _logger.info(_('repomd.xml was not modified since the last sync.'))
+            return None
         _logger.info(_('Parsing metadata.'))
 
         try:
@@ -159,85 +570,585 @@ class RepoSync(yumsync.RepoSync):
         _logger.info(metadata_files)
         return metadata_files
 
+    def download_repomd(self, metadata_files, url):
+        """
+        Download repomd.xml into the metadata directory. If the last sync of
+        this feed is still valid, the request is made conditional on the
+        ETag and Last-Modified headers the server returned then, and nothing
+        is written if the server replies with 304 Not Modified.
+
+        :return: True if repomd.xml was not modified since the last sync
+        :rtype:  bool
+
+        :raises IOError: if the download failed
+        """
+        headers = dict()
+        previous = self._group_previous_sync_state(url)
+        if previous is not None:
+            if previous.get('etag'):
+                headers['If-None-Match'] = previous['etag']
+            if previous.get('last_modified'):
+                headers['If-Modified-Since'] = previous['last_modified']
+        # Same URL MetadataFiles would download: feeds may need query
+        # strings or tokens added
+        repomd_url = self._url_modify(urlparse.urljoin(
+            metadata_files.repo_url, 'repodata/repomd.xml'))
+        # Download in memory, so a 304 leaves no trace in the tmp dir
+        fobj = io.BytesIO()
+        report = metadata_files.downloader.download_one(
+            nectar_request.DownloadRequest(repomd_url, fobj,
+                                           headers=headers or None))
+        if report.state != nectar_report.DOWNLOAD_SUCCEEDED:
+            error_report = report.error_report or {}
+            if headers and error_report.get('response_code') == 304:
+                return True
+            raise IOError(report.error_msg or error_report.get(
+                'response_msg', 'Unable to download %s' % repomd_url))
+        response_headers = report.headers or {}
+        self.repomd_headers = dict(
+            etag=response_headers.get('ETag'),
+            last_modified=response_headers.get('Last-Modified'))
+        with open(os.path.join(metadata_files.dst_dir, 'repomd.xml'),
+                  'wb') as f:
+            f.write(fobj.getvalue())
+        return False
+
     def update_content(self, metadata_files, url):
         """
-        Decides what to download and then downloads it
+        Decides what to download and downloads it, as a pipeline: primary.xml
+        is processed in batches of PRIMARY_BATCH_SIZE packages on a separate
+        thread, and the units found to be missing are handed to the
+        downloader through a bounded queue while parsing goes on. Memory
+        usage does not depend on the size of the upstream repository, save
+        for the unit key digests collected when missing units are removed.
+        Missing units are only removed if all the units made it into the
+        repositories: the unit keys of the others are not known.
 
         :param metadata_files:  instance of MetadataFiles
         :type  metadata_files:  pulp_rpm.plugins.importers.yum.repomd.metadata.MetadataFiles
         :param url: curret URL we should sync
         :type: str
         """
-        to_download, fileless = self._decide_what_to_download(metadata_files)
-        self.download(metadata_files, to_download, url)
-        self.save_fileless(metadata_files, fileless)
+        unit_counts, total_size = self._count_packages(metadata_files)
+        self.content_report.set_initial_values(unit_counts, total_size)
+        self.set_progress()
+        if any(member.remove_missing for member in self.members):
+            self.synced_unit_keys = set()
+        # Waits for units downloaded elsewhere end when the pipeline is
+        # closed
+        pipeline = UnitPipeline(
+            lambda: self._units_to_download(metadata_files,
+                                            pipeline.stopped),
+            DOWNLOAD_QUEUE_SIZE)
+        pipeline.start()
+        try:
+            staging_area = self.download(
+                metadata_files, self._claimed(pipeline, pipeline.stopped),
+                url)
+        finally:
+            pipeline.close()
+            self.download_registry.release_all()
+        pipeline.raise_error()
+        if staging_area is not None and not self.canceled:
+            # Every unit was looked up: whatever else is staged is no longer
+            # needed
+            staging_area.prune()
+        synced_unit_keys, self.synced_unit_keys = self.synced_unit_keys, None
+        if synced_unit_keys is not None:
+            if self.content_report['error_details'] or \
+                    self.content_report['items_left']:
+                _logger.info(_('Some units could not be synced, not removing '
+                               'missing units.'))
+            else:
+                self.remove_missing_units(synced_unit_keys)
         self.conduit.build_success_report({}, {})
 
-    def _decide_what_to_download(self, metadata_files):
+    def _units_to_download(self, metadata_files, stopped=None):
+        """
+        Generate the upstream units that need to be downloaded. Existing
+        units are associated and fileless units are saved along the way.
+
+        :param stopped: threading.Event set when the units are no longer
+                        needed
+        """
         with metadata_files.get_metadata_file_handle(primary.METADATA_FILE_NAME) as primary_file_handle:  # noqa
-            package_info_generator = packages.package_list_generator(
-                primary_file_handle, primary.PACKAGE_TAG,
-                self._process_package_element)
+            package_info_generator = package_list_generator(
+                primary_file_handle, self._process_package_element)
+            for batch in _batches(package_info_generator,
+                                  PRIMARY_BATCH_SIZE):
+                to_download, fileless = self._decide_what_to_download(batch)
+                self.save_fileless(metadata_files, fileless)
+                for unit in to_download:
+                    yield unit
 
-            sep_units = self._separate_units_by_type(package_info_generator)
-        to_download = dict()
-        for model_class, units in sorted(sep_units.items()):
-            upstream_unit_keys = set(u.unit_key_as_named_tuple
-                                     for u in units)
-            # Units from the database
-            unit_generator = units_controller.find_units(units)
-            available_units = list(unit_generator)
-            # Compute the unit keys we need to download
-            wanted = upstream_unit_keys.difference(
-                u.unit_key_as_named_tuple for u in available_units)
-            for existing in available_units:
-                # Existing units get re-associated
-                yumsync.repo_controller.associate_single_unit(
-                    self.conduit.repo, existing)
-            to_download[model_class] = [
-                u for u in units if u.unit_key_as_named_tuple in wanted]
+    def _claimed(self, units, stopped=None):
+        """
+        Claim the downloads of units as they are handed to the downloader;
+        each claim is released once the unit is saved, or failed. Units
+        being downloaded by another sync on this host are left for the end,
+        and waited for.
+
+        :param stopped: threading.Event set when the units are no longer
+                        needed
+        """
+        deferred = []
+        for unit in units:
+            if self.download_registry.claim(unit.download_key):
+                yield unit
+            else:
+                deferred.append(unit)
+        while deferred:
+            waited, deferred = deferred, []
+            for unit in self._units_downloaded_elsewhere(waited, stopped):
+                if self.download_registry.claim(unit.download_key):
+                    yield unit
+                else:
+                    # Claimed by yet another sync in the meantime
+                    deferred.append(unit)
+
+    def _units_downloaded_elsewhere(self, units, stopped=None):
+        """
+        Wait for the downloads of units claimed by other syncs, and look the
+        units up again: the ones saved in the meantime are associated like
+        any existing unit, and the others (the download failed, or is still
+        going on) are generated, to be claimed again. Nothing is generated
+        once stopped is set.
+        """
+        if units:
+            _logger.info(_('Waiting for %(n)s units being downloaded by '
+                           'other syncs.') % dict(n=len(units)))
+        for batch in _batches(units, PRIMARY_BATCH_SIZE):
+            for unit in batch:
+                self.download_registry.wait(unit.download_key,
+                                            cancel=stopped)
+            if stopped is not None and stopped.is_set():
+                return
+            to_download, _fileless = self._decide_what_to_download(batch)
+            for unit in to_download:
+                yield unit
+
+    def _record_synced(self, units):
+        """
+        Record the unit keys of units saved or associated, as stored: units
+        saved from downloaded files get their unit key from the file, with
+        a sha256 checksum whatever checksum type upstream uses.
+        """
+        if self.synced_unit_keys is None:
+            return
+        self.synced_unit_keys.update(
+            [unit.unit_key_digest(unit.unit_key) for unit in units])
 
+    def remove_missing_units(self, synced_unit_keys):
+        """
+        Remove from the repositories with remove_missing set the units that
+        are no longer listed upstream. Each repository's associations are
+        streamed and compared with the unit key digests of the units the
+        sync saved or associated, and the difference is removed in bulk.
+
+        :param synced_unit_keys: digests of the unit keys, as returned by
+                                 Package.unit_key_digest
+        :type  synced_unit_keys: set
+        :return: the number of units removed
+        :rtype:  int
+        """
+        total = 0
+        for member in self.members:
+            if member.remove_missing:
+                total += self._remove_missing_from_repo(
+                    member.conduit.repo, synced_unit_keys)
+        self.set_progress()
+        return total
+
+    def _remove_missing_from_repo(self, repo, synced_unit_keys):
+        total = 0
+        for model_class in sorted(self.Type_Class_Map.values(),
+                                  key=lambda klass: klass.TYPE_ID):
+            missing = (
+                unit_id for unit_id, digest in
+                model_class.repo_unit_key_digests(repo)
+                if digest not in synced_unit_keys)
+            count = model_class.bulk_unassociate(missing, repo)
+            if count:
+                _logger.info(_('Removed %(n)s %(t)s units no longer present '
+                               'upstream from %(r)s') % dict(
+                                   n=count, t=model_class.TYPE,
+                                   r=repo.repo_id))
+            self.content_report.removed(model_class, count)
+            total += count
+        return total
+
+    @classmethod
+    def _count_packages(cls, metadata_files):
+        """
+        Cheap pass over primary.xml, only looking at the package type and
+        size, to compute the totals for the progress report.
+        """
         unit_counts = dict()
+        total_size = 0
+        with metadata_files.get_metadata_file_handle(primary.METADATA_FILE_NAME) as primary_file_handle:  # noqa
+            for pkg_type, size in package_list_generator(
+                    primary_file_handle, cls._package_type_and_size):
+                unit_counts[pkg_type] = unit_counts.get(pkg_type, 0) + 1
+                total_size += size
+        return unit_counts, total_size
+
+    @classmethod
+    def _package_type_and_size(cls, el):
+        size_element = el.find('{%s}size' % primary.COMMON_SPEC_URL)
+        try:
+            size = int(size_element.attrib.get('package', 0))
+        except (AttributeError, ValueError):
+            size = 0
+        return el.attrib.get('type'), size
+
+    def _decide_what_to_download(self, units):
+        """
+        Look up which of the upstream units are already in the database,
+        re-associate them, and return the ones that need to be downloaded.
+
+        :param units: a batch of upstream units
+        :return: a tuple of (units to download, fileless units to save)
+        """
+        sep_units = self._separate_units_by_type(units)
         flattened = set()
         fileless = set()
-        for model_class, wanted in to_download.items():
-            unit_counts[model_class.TYPE_ID] = len(wanted)
-            if 'filename' in model_class._fields:
-                flattened.update(wanted)
-            else:
-                fileless.update(wanted)
-
-        total_size = sum(x.size for x in flattened if x.size)
-        self.content_report.set_initial_values(unit_counts, total_size)
+        for model_class, units in sorted(sep_units.items()):
+            # Units from the database, looked up in bulk
+            available_units = model_class.find_by_unit_keys(units)
+            if not self.trust_upstream_metadata:
+                self._complete_metadata(model_class, [
+                    unit for unit in available_units.values()
+                    if unit.metadata_source ==
+                    models.METADATA_SOURCE_UPSTREAM])
+            # Existing units get re-associated, unless they already are
+            for repo in self.repos:
+                model_class.bulk_associate(available_units.values(), repo,
+                                           skip_associated=True)
+            self._record_synced(available_units.values())
+            for unit in units:
+                if unit.unit_key_as_named_tuple in available_units:
+                    # Counted by the pre-pass, but nothing to do
+                    self.content_report.skipped(unit)
+                elif 'filename' in model_class._fields:
+                    flattened.add(unit)
+                else:
+                    fileless.add(unit)
         self.set_progress()
         return flattened, fileless
 
+    def _complete_metadata(self, model_class, units):
+        """
+        Extract the metadata of units created out of primary.xml by an
+        earlier sync from their files in content storage, for the fields
+        primary.xml does not carry.
+        """
+        if not units:
+            return
+        _logger.info(_('Extracting the metadata of %(n)s units created from '
+                       'upstream metadata.') % dict(n=len(units)))
+        by_path = dict((unit._storage_path, unit) for unit in units)
+        results = model_class.from_files(
+            sorted(by_path), workers=self.num_processing_workers,
+            metadata_backend=self.metadata_backend,
+            metadata_cache=self.metadata_cache)
+        for result in results:
+            unit = by_path[result.path]
+            if result.error is not None:
+                _logger.warning("%s: cannot extract metadata: %s", unit,
+                                result.error)
+                continue
+            for fname in model_class.type_field_names():
+                setattr(unit, fname, getattr(result.unit, fname))
+            unit.metadata_source = None
+            unit.save()
+
     @classmethod
     def _separate_units_by_type(cls, units):
         ret = dict()
         for unit in units:
-            ret.setdefault(unit.__class__, set()).add(unit)
+            ret.setdefault(unit.model_class, set()).add(unit)
         return ret
 
+    @classmethod
+    def local_feed_dir(cls, url):
+        """
+        The directory a file:// feed points to, or None for other feeds.
+        """
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme != 'file':
+            return None
+        path = urllib.url2pathname(parsed.path)
+        if not os.path.isdir(path):
+            return None
+        return os.path.normpath(path)
+
+    def get_metadata(self, metadata_files):
+        """
+        For file:// feeds, metadata files are read in place rather than
+        downloaded into the working directory.
+        """
+        local_dir = self.local_feed_dir(metadata_files.repo_url)
+        if local_dir is None:
+            return super(RepoSync, self).get_metadata(metadata_files)
+        _logger.info(_('Reading metadata files from %(d)s.') % dict(
+            d=local_dir))
+        for file_info in metadata_files.metadata.values():
+            path = os.path.join(local_dir, file_info['relative_path'])
+            if not os.path.isfile(path):
+                raise IOError(_('Metadata file not found: %(p)s') % dict(
+                    p=path))
+            file_info['local_path'] = path
+        return metadata_files
+
     def download(self, metadata_files, units_to_download, url):
-        event_listener = CustomPackageListener(self, metadata_files)
+        """
+        Download the units, or import them from a local feed.
 
+        :return: the staging area the units were downloaded to, closed; None
+                 for local feeds
+        :rtype:  pulp_win.plugins.importers.staging.StagingArea
+        """
+        local_dir = self.local_feed_dir(url)
+        # Files from a local feed are imported in place, and must be left
+        # alone
+        event_listener = CustomPackageListener(
+            self, metadata_files, in_place=local_dir is not None)
+
+        staging_area = None
+        range_downloads = None
         try:
+            if local_dir is not None:
+                self.import_local_units(local_dir, units_to_download,
+                                        event_listener)
+                return None
+            # Downloads are kept across syncs, so an interrupted sync does
+            # not lose them
+            staging_area = self.staging = staging.StagingArea.from_config(
+                self.conduit.repo.repo_id)
+            self.range_downloader = ranged.RangeDownloader.from_nectar_config(
+                self.nectar_config)
+            # Metadata came from url; packages can come from any mirror
+            self.mirrors = self.mirror_set(url)
+            pool_size = (self.nectar_config.max_concurrent or
+                         constants.CONFIG_NUM_THREADS_DEFAULT)
+            range_downloads = multiprocessing.pool.ThreadPool(pool_size)
+            self.range_slots = threading.BoundedSemaphore(2 * pool_size)
+            units_to_download = self._staged_units(
+                url, units_to_download, event_listener, range_downloads)
+            if self.concurrency is not None:
+                units_to_download = self.concurrency.throttle(
+                    units_to_download)
+                self.content_report.concurrency(self.concurrency.limit)
+                self.set_progress()
             download_wrapper = alternate.Packages(
                 url,
                 self.nectar_config,
                 units_to_download,
-                self.tmp_dir,
+                staging_area.path,
                 event_listener,
                 self._url_modify)
 
             self.downloader = download_wrapper.downloader
-            _logger.info(_('Downloading %(num)s units.') %
-                         {'num': len(units_to_download)})
+            _logger.info(_('Downloading units.'))
             download_wrapper.download_packages()
             self.downloader = None
         finally:
-            pass
+            try:
+                if range_downloads is not None:
+                    range_downloads.close()
+                    range_downloads.join()
+                # Process whatever is left in the last batch
+                event_listener.flush()
+            finally:
+                if staging_area is not None:
+                    staging_area.close()
+                    self.staging = None
+                self.range_slots = None
+        return staging_area
+
+    def mirror_set(self, url):
+        """
+        Return the mirrors to stripe package downloads across, url first,
+        if the feed lists several and striping is enabled; None otherwise.
+        """
+        if not self.config.get(constants.CONFIG_STRIPE_MIRRORS,
+                               constants.CONFIG_STRIPE_MIRRORS_DEFAULT):
+            return None
+        urls = [url] + [u for u in self.sync_feed
+                        if u is not None and self.local_feed_dir(u) is None]
+        mirror_set = mirrors.MirrorSet(urls)
+        if len(mirror_set) < 2:
+            return None
+        _logger.info(_('Downloading from %(n)s mirrors') % dict(
+            n=len(mirror_set)))
+        return mirror_set
+
+    def _unit_url(self, url, unit):
+        if not url.endswith('/'):
+            url += '/'
+        return self._url_modify(urlparse.urljoin(url, unit.download_path))
+
+    def _segmented(self, unit):
+        return (self.segmented_download_threshold > 0 and
+                self.download_segments > 1 and unit.size is not None and
+                unit.size >= self.segmented_download_threshold)
+
+    def _stage(self, unit):
+        """
+        Record that a unit is about to be downloaded from scratch.
+
+        :return: the segments to download, if downloaded in segments
+        :rtype:  list
+        """
+        segments = None
+        if self._segmented(unit):
+            segments = ranged.split(unit.size, self.download_segments)
+        self.staging.start(unit, segments)
+        return segments
+
+    def _staged_units(self, url, units, event_listener, range_downloads):
+        """
+        Generate the units for nectar to download. Units an earlier sync
+        finished downloading are handed to the listener right away; the
+        ones it started downloading, the ones large enough to be downloaded
+        in segments, and all of them when striped across mirrors, are
+        downloaded on the range_downloads pool.
+        """
+        for unit in units:
+            path, offset, segments = self.staging.lookup(unit)
+            if offset and unit.size is not None and offset >= unit.size:
+                _logger.info(_('Using %(p)s, downloaded by an earlier sync') %
+                             dict(p=path))
+                report = StagedReport(self._unit_url(url, unit), path,
+                                      data=unit)
+                report.download_succeeded()
+                event_listener.download_succeeded(report)
+                continue
+            if not (offset or segments):
+                segments = self._stage(unit)
+                if segments is None and self.mirrors is None:
+                    yield unit
+                    continue
+            if self.concurrency is not None:
+                self.concurrency.acquire()
+            elif self.range_slots is not None:
+                self.range_slots.acquire()
+            range_downloads.apply_async(
+                self._range_download,
+                (url, unit, path, offset, segments, event_listener))
+
+    def _range_download(self, url, unit, path, offset, segments,
+                        event_listener):
+        """
+        Download a file with Range requests: in segments if given, and
+        otherwise from offset, where an earlier sync stopped. When striped
+        across mirrors, a download that fails is resumed on another one.
+        """
+        tried = set()
+        reported = False
+        try:
+            while True:
+                mirror = url
+                if self.mirrors is not None:
+                    mirror = self.mirrors.choose(exclude=tried)
+                report = nectar_report.DownloadReport(
+                    self._unit_url(mirror, unit), path, data=unit)
+                report.download_started()
+                started = time.time()
+                try:
+                    size = self._fetch_ranges(report.url, unit, path, offset,
+                                              segments)
+                    if unit.size is not None and size != unit.size:
+                        # Not the file primary.xml lists; start over
+                        self.staging.discard(path)
+                        raise ranged.RangeDownloadError(
+                            '%s: got %d bytes, expected %d' % (
+                                report.url, size, unit.size))
+                except Exception, e:
+                    report.error_msg = str(e)
+                    if self.mirrors is not None:
+                        self.mirrors.record(mirror, 0, None, failed=True)
+                        tried.add(mirror)
+                        if len(tried) < len(self.mirrors):
+                            _logger.info(_('%(e)s; trying another mirror') %
+                                         dict(e=e))
+                            path, offset, segments = self.staging.lookup(unit)
+                            if not (offset or segments):
+                                segments = self._stage(unit)
+                            continue
+                    report.download_failed()
+                    reported = True
+                    event_listener.download_failed(report)
+                    return
+                if self.mirrors is not None:
+                    self.mirrors.record(mirror, size - offset,
+                                        time.time() - started)
+                report.bytes_downloaded = size - offset
+                report.download_succeeded()
+                reported = True
+                event_listener.download_succeeded(report)
+                return
+        except Exception, e:
+            # Nothing would report errors raised in the pool
+            _logger.exception("Error downloading %r", unit)
+            if reported:
+                return
+            try:
+                # Releases the download slot, and reports the unit
+                report = nectar_report.DownloadReport(
+                    self._unit_url(url, unit), path, data=unit)
+                report.error_msg = str(e)
+                report.download_failed()
+                event_listener.download_failed(report)
+            finally:
+                # Other syncs must not wait for this unit
+                self.download_registry.release(unit.download_key)
+        finally:
+            if self.concurrency is None and self.range_slots is not None:
+                self.range_slots.release()
+
+    def _fetch_ranges(self, url, unit, path, offset, segments):
+        if segments:
+            _logger.info(_('Downloading %(u)s in %(n)s segments') % dict(
+                u=url, n=len(segments)))
+            try:
+                return self.range_downloader.fetch_segmented(
+                    url, path, unit.size, segments,
+                    checkpoint=functools.partial(
+                        self.staging.checkpoint_segments, path))
+            except ranged.RangeNotSupported:
+                _logger.info(_('%(u)s: Range not supported, downloading '
+                               'in one piece') % dict(u=url))
+                self.staging.start(unit)
+                offset = 0
+        elif offset:
+            _logger.info(_('Resuming download of %(u)s at %(o)s bytes') %
+                         dict(u=url, o=offset))
+        return self.range_downloader.fetch(
+            url, path, offset,
+            checkpoint=functools.partial(self.staging.checkpoint, path))
+
+    def import_local_units(self, local_dir, units, event_listener):
+        """
+        Hand the files of a file:// feed to the listener, as if they had
+        been downloaded, without copying them. They are later placed in
+        content storage by hard link, reflink or in-kernel copy.
+        """
+        _logger.info(_('Importing units from %(d)s.') % dict(d=local_dir))
+        for unit in units:
+            path = os.path.normpath(
+                os.path.join(local_dir, unit.download_path))
+            report = nectar_report.DownloadReport(path, path, data=unit)
+            if not path.startswith(local_dir + os.sep):
+                report.error_msg = 'Path outside of the feed: %s' % path
+            elif not os.path.isfile(path):
+                report.error_msg = 'File not found: %s' % path
+            if report.error_msg is None:
+                report.download_succeeded()
+                event_listener.download_succeeded(report)
+            else:
+                report.download_failed()
+                event_listener.download_failed(report)
 
     @classmethod
     def _process_package_element(cls, el):
@@ -245,74 +1156,380 @@ class RepoSync(yumsync.RepoSync):
         if pkg_type not in cls.Type_Class_Map:
             raise error_codes.RPM1004(
                 reason="Unsupported package type %s" % pkg_type)
-        klass = cls.Type_Class_Map[pkg_type]
-        package_info = dict()
-        field_names = set(klass._fields.keys())
-        field_names.add('size')
-        for fname in field_names:
-            if fname.startswith('_'):
-                continue
-            tag = '{%s}%s' % (primary.COMMON_SPEC_URL, fname)
-            value = el.find(tag)
-            if value is not None:
-                package_info[fname] = value.text
-                if fname == 'checksum' and 'type' in value.attrib:
-                    package_info['checksumtype'] = value.attrib['type']
-                if fname == 'size':
-                    try:
-                        size = int(value.attrib.get('package', 0))
-                    except ValueError:
-                        size = 0
-                    package_info[fname] = size
-        if 'relativepath' in klass._fields:
-            location_element = el.find(primary.LOCATION_TAG)
-            if location_element is not None:
-                href = location_element.attrib['href']
-                package_info['relativepath'] = href
-
-        package_info['filename'] = klass.filename_from_unit_key(package_info)
-        return klass(**package_info)
+        return cls.Extractors[pkg_type](el)
 
     def fix_metadata(self, metadata_files):
         metadata_files.generate_dbs = lambda *args, **kwargs: None
 
     def add_unit(self, metadata_files, unit, file_path):
-        unit = unit.save_and_associate(file_path, self.conduit.repo)
-        self.progress_report['content'].success(unit)
+        return self.add_units(metadata_files, [(unit, file_path)])[0]
+
+    def add_units(self, metadata_files, units_and_paths):
+        """
+        Save and associate a batch of units with a constant number of
+        database round trips.
+
+        :param units_and_paths: list of (unit, file_path) tuples
+        :return: the saved units, in the same order
+        """
+        if not units_and_paths:
+            return []
+        # Downloaded files are discarded afterwards, and files from local
+        # feeds are not modified: either way, content storage can share
+        # their data
+        units = models.Package.bulk_save_and_associate(
+            units_and_paths, self.conduit.repo, link_content=True)
+        for repo in self.repos[1:]:
+            models.Package.bulk_associate(units, repo)
+        self._record_synced(units)
+        for unit in units:
+            self.progress_report['content'].success(unit)
+            _logger.info("Added %r", unit)
         self.set_progress()
-        _logger.info("Added %r", unit)
-        return unit
+        return units
 
     def save_fileless(self, metadata_files, units):
-        for unit in units:
-            self.add_unit(metadata_files, unit, None)
+        self.add_units(metadata_files,
+                       [(unit.to_unit(), None) for unit in units])
+
+
+def _batches(iterable, size):
+    """
+    Split an iterable into lists of at most size items, lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class StagedReport(nectar_report.DownloadReport):
+    """
+    Report for a file an earlier sync downloaded.
+    """
+
+
+class UnitPipeline(object):
+    """
+    Runs a generator on a separate thread, and makes the items it generates
+    available by iterating over the pipeline. At most maxsize items are
+    queued: the producer blocks when the consumer falls behind.
+    """
+    _END = object()
+
+    def __init__(self, produce, maxsize):
+        self.queue = Queue.Queue(maxsize=maxsize)
+        # Set when the consumer goes away; producers that block on anything
+        # but the queue should watch it
+        self.stopped = threading.Event()
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, args=(produce, ))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self._END:
+                return
+            yield item
+
+    def _run(self, produce):
+        try:
+            for item in produce():
+                if not self._put(item):
+                    return
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._put(self._END)
+
+    def _put(self, item):
+        # Check periodically whether the consumer went away
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def close(self):
+        """
+        Stop the producer, if still running, and wait for it.
+        """
+        self.stopped.set()
+        self._thread.join()
+
+    def raise_error(self):
+        """
+        Raise the exception the producer failed with, if any.
+        """
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
 
 
 class CustomPackageListener(PackageListener):
+    """
+    Downloaded files are handed off, through a bounded queue, to a
+    processing thread, so the downloader does not wait for them to be
+    processed. The processing thread takes the files in batches of up to
+    batch_size, extracts their metadata with Package.from_files on a pool of
+    num_processing_workers workers, and saves the units.
+    """
+    _END = object()
+
+    def __init__(self, sync, metadata_files, in_place=False):
+        super(CustomPackageListener, self).__init__(sync, metadata_files)
+        # Files are not temporary downloads, and are not removed
+        self.in_place = in_place
+        self.workers = self.sync.num_processing_workers
+        self.batch_size = max(self.workers, 1)
+        # (unit, path) tuples for downloaded files not yet processed. When
+        # full, download callbacks block until processing catches up.
+        self._queue = Queue.Queue(maxsize=2 * self.batch_size)
+        self._pool = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
     def download_succeeded(self, report):
-        with util.deleting(report.destination):
-            unit = report.data
-            try:
-                super(CustomPackageListener, self).download_succeeded(report)
-            except (verification.VerificationException,
-                    util.InvalidChecksumType):
-                # verification failed, unit not added
-                _logger.error("%s: download failed", report.data._content_type_id)
+        unit = report.data
+        self._release_slot(report, failed=False)
+        try:
+            super(CustomPackageListener, self).download_succeeded(report)
+        except (verification.VerificationException,
+                util.InvalidChecksumType):
+            # verification failed, unit not added
+            _logger.error("%s: download failed", unit._content_type_id)
+            if self.sync.staging is not None:
+                self.sync.staging.discard(report.destination)
+            elif not self.in_place:
+                self._discard(report.destination)
+            self.sync.download_registry.release(unit.download_key)
+            return
+        self._queue.put((unit, report.destination))
+
+    def download_failed(self, report):
+        self._release_slot(report, failed=True)
+        self.sync.download_registry.release(report.data.download_key)
+        super(CustomPackageListener, self).download_failed(report)
+
+    def _release_slot(self, report, failed):
+        concurrency = self.sync.concurrency
+        # Files from local feeds, or staged by an earlier sync, do not go
+        # through the downloader
+        if concurrency is None or self.in_place or \
+                isinstance(report, StagedReport):
+            return
+        seconds = None
+        if report.start_time is not None and report.finish_time is not None:
+            seconds = (report.finish_time - report.start_time).total_seconds()
+        if concurrency.release(report.bytes_downloaded or 0, seconds,
+                               failed=failed):
+            self.sync.content_report.concurrency(concurrency.limit)
+            self.sync.set_progress()
+
+    def flush(self):
+        """
+        Wait for all downloaded files to be processed, and stop the
+        processing thread. Raises the first error processing ran into.
+        """
+        self._queue.put(self._END)
+        self._thread.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def _run(self):
+        done = False
+        while not done:
+            item = self._queue.get()
+            if item is self._END:
                 return
+            # Process whatever else is available, without waiting for a
+            # full batch
+            pending = [item]
+            while len(pending) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is self._END:
+                    done = True
+                    break
+                pending.append(item)
+            try:
+                self._process(pending)
+            except Exception:
+                _logger.exception("Error processing downloaded units")
+                if self._exc_info is None:
+                    self._exc_info = sys.exc_info()
+
+    def _get_pool(self):
+        if self._pool is None and self.workers > 1:
+            self._pool = models.new_pool(self.workers)
+        return self._pool
+
+    def _process(self, pending):
+        by_class = dict()
+        for unit, path in pending:
+            by_class.setdefault(unit.model_class, dict())[path] = unit
+        to_add = []
+        try:
+            for klass, units in by_class.items():
+                to_extract = dict()
+                for path, unit in sorted(units.items()):
+                    if self._trusted(unit):
+                        unit_dl = self._unit_from_upstream(unit, path)
+                        self._staged_checked(path, unit_dl is not None)
+                        if unit_dl is not None:
+                            to_add.append((unit_dl, path))
+                    else:
+                        to_extract[path] = unit
+                if not to_extract:
+                    continue
+                # The upstream checksum is computed in the same pass over
+                # the file as the sha256 checksum and the metadata, instead
+                # of having the parent listener read the whole file once
+                # more.
+                checksum_types = set(
+                    u.checksumtype for u in to_extract.values())
+                results = klass.from_files(
+                    sorted(to_extract),
+                    metadata_backend=self.sync.metadata_backend,
+                    metadata_cache=self.sync.metadata_cache,
+                    checksum_types=checksum_types,
+                    pool=self._get_pool())
+                for result in results:
+                    unit = to_extract[result.path]
+                    verified = self._verify_result(unit, result)
+                    self._staged_checked(result.path, verified)
+                    if verified:
+                        if self.sync.trust_upstream_metadata:
+                            self._audit(unit, result.unit)
+                        to_add.append((result.unit, result.path))
+            # The whole batch is saved and associated at once
+            added_units = self.sync.add_units(self.metadata_files, to_add)
+            for added_unit in added_units:
+                if not added_unit.downloaded:
+                    added_unit.downloaded = True
+                    added_unit.save()
+        finally:
+            # Downloaded files have been imported into storage or rejected
+            if not self.in_place:
+                for unit, path in pending:
+                    self._discard(path)
+            # Other syncs waiting for these units can now pick them up
+            for unit, path in pending:
+                self.sync.download_registry.release(unit.download_key)
+
+    def _staged_checked(self, path, verified):
+        """
+        Record the outcome of the checksum verification of a downloaded
+        file: a verified file is imported by the next sync if this one does
+        not get to it, and a file that did not match is dropped.
+        """
+        if self.sync.staging is None:
+            return
+        if verified:
+            self.sync.staging.verified(path)
+        else:
+            self.sync.staging.discard(path)
+
+    @classmethod
+    def _discard(cls, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _trusted(self, unit):
+        """
+        Whether the unit can be created out of the upstream metadata, rather
+        than extracted from the file. A sample of the units (the audit rate)
+        is extracted anyway, and compared with the upstream metadata.
+        """
+        if not self.sync.trust_upstream_metadata:
+            return False
+        return random.random() >= self.sync.trust_audit_rate
+
+    def _unit_from_upstream(self, unit, path):
+        try:
+            checksums, size = unit.model_class.file_checksums(
+                path, [unit.checksumtype])
+        except (EnvironmentError, util.InvalidChecksumType), e:
+            self._reject(unit, str(e))
+            return None
+        if checksums[unit.checksumtype] != unit.checksum:
+            self._reject(unit, 'checksum mismatch')
+            return None
+        unit_dl = unit.to_unit()
+        # Same unit key as a unit extracted from the file would have
+        unit_dl.checksumtype = util.TYPE_SHA256
+        unit_dl.checksum = checksums[util.TYPE_SHA256]
+        unit_dl.size = size
+        unit_dl.checksums = checksums
+        # Extracted from the file by the next sync not trusting upstream
+        unit_dl.metadata_source = models.METADATA_SOURCE_UPSTREAM
+        _logger.info("Adding %s unit from upstream metadata",
+                     unit_dl._content_type_id)
+        return unit_dl
 
-            # At this point, the checksum validation should have already
-            # caught whether the unit is invalid, so we should be reasonably
-            # sure the same unit is on disk
-            unit_dl = unit.__class__.from_file(report.destination)
+    def _audit(self, unit, unit_dl):
+        """
+        Log differences between the upstream metadata and what was extracted
+        from the file. The extracted metadata is what gets saved.
+        """
+        fields = ['name', 'version']
+        fields.extend(unit.model_class.REPOMD_EXTRA_FIELDS)
+        upstream = unit.to_unit()
+        mismatches = [
+            (fname, getattr(upstream, fname), getattr(unit_dl, fname))
+            for fname in fields
+            if getattr(upstream, fname) != getattr(unit_dl, fname)]
+        for fname, expected, actual in mismatches:
+            _logger.warning(
+                "%s %s: upstream metadata does not match the file: "
+                "%s is %r, not %r", unit._content_type_id, unit.filename,
+                fname, actual, expected)
+        return not mismatches
 
-            _logger.info("Adding %s unit", unit_dl._content_type_id)
-            added_unit = self.sync.add_unit(self.metadata_files, unit_dl,
-                                            report.destination)
-            if not added_unit.downloaded:
-                added_unit.downloaded = True
-                added_unit.save()
+    def _verify_result(self, unit, result):
+        if result.error is not None:
+            self._reject(unit, str(result.error))
+            return False
+        unit_dl = result.unit
+        if unit_dl.checksums[unit.checksumtype] != unit.checksum:
+            self._reject(unit, 'checksum mismatch')
+            return False
+        _logger.info("Adding %s unit", unit_dl._content_type_id)
+        return True
+
+    def _reject(self, unit, error):
+        """
+        Report a downloaded file that did not make it into a unit.
+        """
+        _logger.error("%s: download failed: %s", unit._content_type_id,
+                      error)
+        self.sync.progress_report['content'].failure(
+            unit, dict(filename=unit.filename, error_message=error))
+        self.sync.set_progress()
 
     def _verify_size(self, *args, **kwargs):
         # Since size is not part of the metadata saved in the repomd files, we
         # are bypassing this verification
         return
+
+    def _verify_checksum(self, *args, **kwargs):
+        # The checksum is verified in download_succeeded, while reading the
+        # metadata out of the file
+        return
@@ -1,27 +1,61 @@
+import itertools
 import logging
+import multiprocessing
+import os
 
 from pulp.server.db import connection
+from pulp_win.plugins.db import models
 from pulp_win.plugins.db.models import MSM
 
 
 _logger = logging.getLogger(__name__)
 
 
+def _read_module_dependency(path):
+    """
+    Pool worker: read the ModuleDependency table only, without hashing the
+    file. Errors are returned rather than raised.
+    """
+    try:
+        md = MSM._read_metadata(path, models.NativeMetadataBackend.name)
+    except models.Error as e:
+        return path, None, e
+    return path, md.get('ModuleDependency', []), None
+
+
 def migrate(*args, **kwargs):
     """
-    Add a ModuleDependency property. The property is extracted from running
-    msiinfo on the msm file.
+    Add a ModuleDependency property. The property is read from the msm
+    file's database; files are processed concurrently.
     """
     collection = connection.get_collection('units_msm')
 
     # Collect all units without ModuleDependency
-    mds = dict()
+    unit_ids = dict()
     for unit in collection.find({'ModuleDependency':{'$exists':False}}):
         if not os.path.exists(unit['_storage_path']):
-            module_dep = []
-        else:
-            md = MSM._read_metadata(unit['_storage_path'])
-            module_dep = md.get('ModuleDependency', [])
+            collection.update_one(dict(_id=unit['_id']),
+                                  {'$set': dict(ModuleDependency=[])})
+            continue
+        unit_ids.setdefault(unit['_storage_path'], []).append(unit['_id'])
 
-        collection.update_one(dict(_id=unit['_id']),
-                              {'$set': dict(ModuleDependency=module_dep)})
+    pool = None
+    workers = multiprocessing.cpu_count()
+    if workers > 1 and len(unit_ids) > 1:
+        pool = models.new_pool(workers)
+        results = pool.imap_unordered(_read_module_dependency,
+                                      sorted(unit_ids))
+    else:
+        results = itertools.imap(_read_module_dependency, sorted(unit_ids))
+    try:
+        for path, module_dep, error in results:
+            if error is not None:
+                raise error
+            for _id in unit_ids[path]:
+                collection.update_one(
+                    dict(_id=_id),
+                    {'$set': dict(ModuleDependency=module_dep)})
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,116 @@
+"""
+Microbenchmark for parsing primary.xml during sync.
+
+Generates a synthetic primary.xml and times building units out of it:
+ - with the per-field find() lookups sync used to do
+ - with sync.PackageExtractor
+
+Run from the plugins directory:
+
+    python -m test.benchmarks.primary_parse [number-of-packages]
+"""
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pulp.server import config
+config.check_config_files = lambda *args: None
+
+from pulp_rpm.plugins.importers.yum.repomd import packages, primary  # noqa
+from pulp_win.plugins.importers import sync  # noqa
+
+PACKAGE_TEMPLATE = """\
+  <package type="%(type)s">
+    <checksum pkgid="YES" type="sha256">%(checksum)064x</checksum>
+    <name>package-%(idx)d</name>
+    <version>1.%(idx)d</version>
+    <size package="%(size)d"/>
+    <location href="package-%(idx)d.%(type)s"/>
+    <ProductCode>{%(idx)08X-0123-4567-89AB-0123456789AB}</ProductCode>
+    <UpgradeCode>{%(idx)08X-0123-4567-89AB-BA9876543210}</UpgradeCode>
+    <ProductName>Package %(idx)d</ProductName>
+  </package>
+"""
+
+
+def write_primary(path, count):
+    with open(path, "w") as fobj:
+        fobj.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<metadata xmlns="%s" packages="%d">\n' %
+                   (primary.COMMON_SPEC_URL, count))
+        for idx in range(count):
+            fobj.write(PACKAGE_TEMPLATE % dict(
+                type=("msi", "msm")[idx % 2], checksum=idx, idx=idx,
+                size=1024 + idx))
+        fobj.write('</metadata>\n')
+
+
+def find_per_field(el):
+    # What RepoSync._process_package_element used to do
+    klass = sync.RepoSync.Type_Class_Map[el.attrib.get('type')]
+    package_info = dict()
+    field_names = set(klass._fields.keys())
+    field_names.add('size')
+    for fname in field_names:
+        if fname.startswith('_'):
+            continue
+        value = el.find('{%s}%s' % (primary.COMMON_SPEC_URL, fname))
+        if value is not None:
+            package_info[fname] = value.text
+            if fname == 'checksum' and 'type' in value.attrib:
+                package_info['checksumtype'] = value.attrib['type']
+            if fname == 'size':
+                try:
+                    size = int(value.attrib.get('package', 0))
+                except ValueError:
+                    size = 0
+                package_info[fname] = size
+    location_element = el.find(primary.LOCATION_TAG)
+    if location_element is not None:
+        package_info['relativepath'] = location_element.attrib['href']
+    package_info['filename'] = klass.filename_from_unit_key(package_info)
+    return klass(**package_info)
+
+
+def elementtree_extractor(path):
+    with open(path) as fobj:
+        for unit in packages.package_list_generator(
+                fobj, primary.PACKAGE_TAG,
+                sync.RepoSync._process_package_element):
+            yield unit
+
+
+def elementtree_find(path):
+    with open(path) as fobj:
+        for unit in packages.package_list_generator(
+                fobj, primary.PACKAGE_TAG, find_per_field):
+            yield unit
+
+
+def run(name, func, path, count):
+    gc.collect()
+    start = time.time()
+    parsed = sum(1 for _ in func(path))
+    elapsed = time.time() - start
+    assert parsed == count, (name, parsed)
+    print "%-30s %8.2fs %10.0f packages/s" % (name, elapsed, count / elapsed)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    work_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(work_dir, "primary.xml")
+        write_primary(path, count)
+        print "%d packages, %d bytes" % (count, os.stat(path).st_size)
+        run("ElementTree, find per field", elementtree_find, path, count)
+        run("ElementTree, extractor", elementtree_extractor, path, count)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
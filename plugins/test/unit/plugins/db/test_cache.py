@@ -0,0 +1,55 @@
+"""
+Contains tests for pulp_win.plugins.db.cache
+"""
+
+import itertools
+import mock
+import os
+from .... import testbase
+from pulp_win.plugins.db import cache
+
+
+class TestMetadataCache(testbase.TestCase):
+    def _new_cache(self, max_entries=10):
+        return cache.MetadataCache(
+            os.path.join(self.work_dir, "cache", "md.sqlite"), max_entries)
+
+    def test_get_put(self):
+        mdc = self._new_cache()
+        self.assertEquals(None, mdc.get("aaa", 10, "native-1"))
+        rows = dict(Property=[[u"ProductName", u"lorem-ipsum"]])
+        mdc.put("aaa", 10, "native-1", set(["Property", "File"]), rows)
+        self.assertEquals((set(["Property", "File"]), rows),
+                          mdc.get("aaa", 10, "native-1"))
+        # Different size or extractor version are misses
+        self.assertEquals(None, mdc.get("aaa", 11, "native-1"))
+        self.assertEquals(None, mdc.get("aaa", 10, "native-2"))
+
+        # Entries persist across instances
+        mdc.close()
+        self.assertEquals((set(["Property", "File"]), rows),
+                          self._new_cache().get("aaa", 10, "native-1"))
+
+    @mock.patch("pulp_win.plugins.db.cache.time.time")
+    def test_lru_eviction(self, _time):
+        _time.side_effect = itertools.count()
+        mdc = self._new_cache(max_entries=2)
+        mdc.put("a", 1, "v", set(), {})
+        mdc.put("b", 1, "v", set(), {})
+        # Touch a, so b is the least recently used
+        self.assertNotEqual(None, mdc.get("a", 1, "v"))
+        mdc.put("c", 1, "v", set(), {})
+        self.assertNotEqual(None, mdc.get("a", 1, "v"))
+        self.assertEquals(None, mdc.get("b", 1, "v"))
+        self.assertNotEqual(None, mdc.get("c", 1, "v"))
+
+    def test_from_config(self):
+        mdc = cache.MetadataCache.from_config({})
+        self.assertEquals(
+            os.path.join(self.pulp_working_dir, cache.CACHE_FILENAME),
+            mdc.path)
+        self.assertEquals(10000, mdc.max_entries)
+
+        self.assertEquals(
+            None,
+            cache.MetadataCache.from_config(dict(metadata_cache_size=0)))
@@ -8,7 +8,7 @@ import mock
 import os
 # Important to import testbase, since it mocks the server's config import snafu
 from .... import testbase
-from pulp_win.plugins.db import models
+from pulp_win.plugins.db import cache, models
 
 DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
                            '../../../data'))
@@ -26,6 +26,87 @@ class TestModel(testbase.TestCase):
             'checksumtype': 'sha256',
             })
 
+    def test_from_file_native_backend(self):
+        msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
+        pkg = models.MSI.from_file(msi_path, metadata_backend='native')
+        self.assertEquals('lorem-ipsum', pkg.ProductName)
+        self.assertEquals('Cicero Enterprises', pkg.Manufacturer)
+        self.assertEquals('{0FE5FDB7-1DA6-44D2-8C17-10510D12D0EE}',
+                          pkg.ProductCode)
+        self.assertEquals('{12345678-1234-1234-1234-111111111111}',
+                          pkg.UpgradeCode)
+        self.assertEquals([], pkg.ModuleSignature)
+        self.assertEquals(9728, pkg.size)
+
+    @mock.patch("pulp_win.plugins.db.models.NativeMetadataBackend.read_tables",
+                side_effect=models.NativeMetadataBackend.read_tables)
+    def test_from_file_metadata_cache(self, _read_tables):
+        msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
+        mdc = cache.MetadataCache(os.path.join(self.work_dir, "md.sqlite"),
+                                  10)
+        pkg = models.MSI.from_file(msi_path, metadata_cache=mdc)
+        self.assertEquals(1, _read_tables.call_count)
+        # All tables needed for either an MSI or an MSM are cached
+        _read_tables.assert_called_once_with(
+            mock.ANY, models.CACHED_METADATA_TABLES)
+
+        pkg2 = models.MSI.from_file(msi_path, metadata_cache=mdc)
+        self.assertEquals(1, _read_tables.call_count)
+        self.assertEquals(pkg.unit_key, pkg2.unit_key)
+        self.assertEquals(pkg.ProductCode, pkg2.ProductCode)
+
+        # The cached entry is used for an MSM too
+        with self.assertRaises(models.InvalidPackageError):
+            models.MSM.from_file(msi_path, metadata_cache=mdc)
+        self.assertEquals(1, _read_tables.call_count)
+
+    def test_from_file_checksum_types(self):
+        msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
+        pkg = models.MSI.from_file(msi_path, checksum_types=['md5', 'sha1'])
+        self.assertEquals(
+            dict(
+                md5='8b31af56a0f2812275f81e1e10a1e594',
+                sha1='e9c828cfeddb8768cbf37b95deb234b383d91e2f',
+                sha256='6fab18ef14a41010b1c865a948bbbdb41ce0779a4520acabb936d931410fac07',  # noqa
+            ),
+            pkg.checksums)
+        self.assertEquals(9728, pkg.size)
+
+        # File objects are read too
+        with open(msi_path, "rb") as fobj:
+            pkg = models.MSI.from_file(fobj)
+        self.assertEquals(pkg.checksum, pkg.checksums['sha256'])
+        self.assertEquals('lorem-ipsum', pkg.ProductName)
+
+    def test_from_files(self):
+        msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
+        for workers in [1, 2]:
+            results = models.MSI.from_files(
+                [msi_path, __file__, '/missing-file'], workers=workers,
+                checksum_types=['sha1'])
+            results = dict((x.path, x) for x in results)
+            self.assertEquals(
+                sorted([msi_path, __file__, '/missing-file']),
+                sorted(results))
+            pkg = results[msi_path].unit
+            self.assertEquals(None, results[msi_path].error)
+            self.assertEquals('lorem-ipsum', pkg.name)
+            self.assertEquals('e9c828cfeddb8768cbf37b95deb234b383d91e2f',
+                              pkg.checksums['sha1'])
+            self.assertEquals(None, results[__file__].unit)
+            self.assertTrue(isinstance(results[__file__].error,
+                                       models.InvalidPackageError))
+            self.assertEquals(
+                "[Errno 2] No such file or directory: u'/missing-file'",
+                str(results['/missing-file'].error))
+
+    def test_from_file_unknown_backend(self):
+        msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
+        with self.assertRaises(models.Error) as ctx:
+            models.MSI.from_file(msi_path, metadata_backend='bogus')
+        self.assertEquals("Unknown metadata backend: bogus",
+                          str(ctx.exception))
+
     def test_from_file_different_checksumtype(self):
         metadata = dict(checksumtype='sha1',
                         checksum='e9c828cfeddb8768cbf37b95deb234b383d91e2f')
@@ -85,7 +166,8 @@ class TestModel(testbase.TestCase):
         metadata = dict(checksumtype='sha256',
                         checksum='doesntmatter')
         msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
-        pkg = models.MSI.from_file(msi_path, metadata)
+        pkg = models.MSI.from_file(msi_path, metadata,
+                                   metadata_backend='msiinfo')
         self.assertEquals("lorem-ipsum",
                           pkg.unit_key['name'])
         self.assertEquals("0.0.1",
@@ -122,7 +204,8 @@ class TestModel(testbase.TestCase):
         metadata = dict(checksumtype='sha256',
                         checksum='doesntmatter')
         msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
-        pkg = models.MSI.from_file(msi_path, metadata)
+        pkg = models.MSI.from_file(msi_path, metadata,
+                                   metadata_backend='msiinfo')
         self.assertEquals("lorem-ipsum",
                           pkg.unit_key['name'])
         self.assertEquals("0.0.1",
@@ -159,7 +242,8 @@ class TestModel(testbase.TestCase):
         metadata = dict(checksumtype='sha256',
                         checksum='doesntmatter')
         msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
-        pkg = models.MSI.from_file(msi_path, metadata)
+        pkg = models.MSI.from_file(msi_path, metadata,
+                                   metadata_backend='msiinfo')
         self.assertEquals("lorem-ipsum",
                           pkg.unit_key['name'])
         self.assertEquals("0.0.1",
@@ -184,7 +268,8 @@ class TestModel(testbase.TestCase):
         metadata = dict(checksumtype='sha256',
                         checksum='doesntmatter')
         msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
-        pkg = models.MSM.from_file(msi_path, metadata)
+        pkg = models.MSM.from_file(msi_path, metadata,
+                                   metadata_backend='msiinfo')
         self.assertEquals("foobar",
                           pkg.unit_key['name'])
         self.assertEquals("1.2.3.4",
@@ -193,6 +278,313 @@ class TestModel(testbase.TestCase):
                           pkg.guid)
         self.assertListEqual([{"name": "sasenvesntl"}], pkg.ModuleDependency)
 
+    @mock.patch("pulp_win.plugins.db.models.MsidumpMetadataBackend._run_cmd")
+    def test_from_file_msm_msidump(self, _run_cmd):
+        msm_md_path = os.path.join(DATA_DIR, "msm-msiinfo-export.out")
+        msm_mm_path = os.path.join(
+            DATA_DIR, "msm-msiinfo-export-ModuleDependency.out")
+        idt_files = {
+            "ModuleSignature.idt": open(msm_md_path).read(),
+            "ModuleDependency.idt": open(msm_mm_path).read(),
+            "_SummaryInformation.idt": "",
+        }
+
+        def dump(cmd):
+            self.assertEquals(models.MSIDUMP_PATH, cmd[0])
+            dump_dir = cmd[2]
+            for fname, contents in idt_files.items():
+                with open(os.path.join(dump_dir, fname), "w") as fobj:
+                    fobj.write(contents)
+            return "", ""
+
+        _run_cmd.side_effect = dump
+        metadata = dict(checksumtype='sha256',
+                        checksum='doesntmatter')
+        msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
+        pkg = models.MSM.from_file(msi_path, metadata,
+                                   metadata_backend='msidump')
+        self.assertEquals(1, _run_cmd.call_count)
+        self.assertEquals("foobar",
+                          pkg.unit_key['name'])
+        self.assertEquals("1.2.3.4",
+                          pkg.unit_key['version'])
+        self.assertEquals("8E012345_0123_4567_0123_0123456789AB",
+                          pkg.guid)
+        self.assertListEqual([{"name": "sasenvesntl"}], pkg.ModuleDependency)
+        # The scratch directory got removed
+        self.assertFalse(os.path.exists(_run_cmd.call_args[0][0][2]))
+
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    @mock.patch("pulp_win.plugins.db.models.MSI.safe_import_content")
+    @mock.patch("pulp_win.plugins.db.models.MSI.set_storage_path")
+    @mock.patch("pulp_win.plugins.db.models.MSI.objects")
+    @mock.patch("pulp_win.plugins.db.models.MSI._get_collection")
+    def test_bulk_save_and_associate(self, _get_collection, _objects,
+                                     _set_storage_path, _safe_import_content,
+                                     _RCU):
+        units = [
+            models.MSI(name="a", version="1", checksumtype="sha256",
+                       checksum="csum%d" % i, id="id%d" % i)
+            for i in range(3)]
+        existing = models.MSI(name="a", version="1", checksumtype="sha256",
+                              checksum="csum1", id="existing1")
+        # The second unit is already in the database
+        _get_collection.return_value.insert_many.side_effect = \
+            models.BulkWriteError(dict(writeErrors=[
+                dict(index=1, code=11000, errmsg="E11000 duplicate key")]))
+        _objects.filter.return_value = [existing]
+        repo = mock.MagicMock(repo_id="repo1")
+
+        ret = models.Package.bulk_save_and_associate(
+            [(units[0], "/a/0.msi"), (units[1], "/a/1.msi"),
+             (units[2], "/a/2.msi")], repo)
+
+        self.assertEquals([units[0], existing, units[2]], ret)
+        self.assertEquals(
+            1, _get_collection.return_value.insert_many.call_count)
+        _objects.filter.assert_called_once_with(checksumtype="sha256",
+                                                checksum__in=["csum1"])
+        # Only new units get their content imported
+        self.assertEquals(
+            [mock.call("/a/0.msi"), mock.call("/a/2.msi")],
+            _safe_import_content.call_args_list)
+        # A single bulk write for all associations
+        ops = _RCU._get_collection.return_value.bulk_write.call_args[0][0]
+        self.assertEquals(
+            ["existing1", "id0", "id2"],
+            [op._filter['unit_id'] for op in ops])
+        self.assertEquals(set(["repo1"]),
+                          set(op._filter['repo_id'] for op in ops))
+
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    @mock.patch("pulp_win.plugins.db.models.MSI.safe_import_content")
+    @mock.patch("pulp_win.plugins.db.models.MSI._get_collection")
+    def test_bulk_save_new_unit(self, _get_collection, _safe_import_content,
+                                _RCU):
+        unit = models.MSI(name="a", version="1", checksumtype="sha256",
+                          checksum="csum0")
+        self.assertEquals(None, getattr(unit, "_last_updated", None))
+        validated = []
+
+        def validate():
+            # _last_updated is required: pre_save has to have set it
+            self.assertNotEquals(None, getattr(unit, "_last_updated", None))
+            validated.append(unit)
+
+        repo = mock.MagicMock(repo_id="repo1")
+        with mock.patch.object(unit, "validate", side_effect=validate):
+            ret = models.Package.bulk_save_and_associate(
+                [(unit, "/a/0.msi")], repo)
+        self.assertEquals([unit], ret)
+        self.assertEquals([unit], validated)
+        self.assertEquals(
+            1, _get_collection.return_value.insert_many.call_count)
+
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    @mock.patch("pulp_win.plugins.db.models.MSI.safe_import_content")
+    @mock.patch("pulp_win.plugins.db.models.MSI._get_collection")
+    def test_bulk_save_and_associate_link_content(
+            self, _get_collection, _safe_import_content, _RCU):
+        file_path, checksum = self.new_file("a-1.msi")
+        unit = models.MSI(name="a", version="1", checksumtype="sha256",
+                          checksum=checksum)
+        repo = mock.MagicMock(repo_id="repo1")
+
+        models.Package.bulk_save_and_associate(
+            [(unit, file_path)], repo, link_content=True)
+        self.assertEquals(0, _safe_import_content.call_count)
+        self.assertEquals(os.stat(file_path).st_ino,
+                          os.stat(unit._storage_path).st_ino)
+
+    @mock.patch("pulp_win.plugins.db.models.repo_controller")
+    @mock.patch("pulp_win.plugins.db.models.MSI.safe_import_content")
+    @mock.patch("pulp_win.plugins.db.models.MSI.save")
+    def test_save_and_associate_link_content(self, _save,
+                                             _safe_import_content,
+                                             _repo_controller):
+        file_path, checksum = self.new_file("a-1.msi")
+        unit = models.MSI(name="a", version="1", checksumtype="sha256",
+                          checksum=checksum)
+        repo = mock.MagicMock(repo_id="repo1")
+
+        self.assertEquals(unit, unit.save_and_associate(
+            file_path, repo, link_content=True))
+        self.assertEquals(models.storage.HARDLINK, unit.import_method)
+        self.assertEquals(0, _safe_import_content.call_count)
+        _repo_controller.associate_single_unit.assert_called_once_with(
+            repository=repo, unit=unit)
+
+        # Storage on a different filesystem: the file gets copied
+        unit = models.MSI(name="a", version="1", checksumtype="sha256",
+                          checksum=checksum)
+        with mock.patch("pulp_win.plugins.db.storage.os.link") as _link:
+            _link.side_effect = OSError(models.storage.errno.EXDEV,
+                                        "Cross-device link")
+            unit.save_and_associate(file_path, repo, link_content=True)
+        self.assertIn(unit.import_method, (models.storage.REFLINK,
+                                           models.storage.COPY_FILE_RANGE,
+                                           models.storage.COPY))
+        self.assertNotEquals(os.stat(file_path).st_ino,
+                             os.stat(unit._storage_path).st_ino)
+        with open(unit._storage_path) as fobj:
+            self.assertEquals(open(file_path).read(), fobj.read())
+
+    @mock.patch("pulp_win.plugins.db.models.BULK_CHUNK_SIZE", 2)
+    @mock.patch("pulp_win.plugins.db.models.MSI.objects")
+    def test_find_by_unit_keys(self, _objects):
+        units = [
+            models.MSI(name="a", version="1", checksumtype="sha256",
+                       checksum="csum%d" % i)
+            for i in range(3)]
+        units.append(models.MSI(name="a", version="1", checksumtype="md5",
+                                checksum="csum0"))
+        # Same checksum, different name: not a match
+        other = models.MSI(name="b", version="1", checksumtype="sha256",
+                           checksum="csum1")
+        _objects.filter.side_effect = [[units[0], other], [units[2]], []]
+
+        ret = models.MSI.find_by_unit_keys(units)
+        self.assertEquals(
+            dict((u.unit_key_as_named_tuple, u)
+                 for u in (units[0], units[2])),
+            ret)
+        self.assertEquals(
+            [
+                mock.call(checksumtype="md5", checksum__in=["csum0"]),
+                mock.call(checksumtype="sha256",
+                          checksum__in=["csum0", "csum1"]),
+                mock.call(checksumtype="sha256", checksum__in=["csum2"]),
+            ],
+            _objects.filter.call_args_list)
+
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    def test_bulk_associate_skip_associated(self, _RCU):
+        units = [
+            models.MSI(name="a", version="1", checksumtype="sha256",
+                       checksum="csum%d" % i, id="id%d" % i)
+            for i in range(3)]
+        collection = _RCU._get_collection.return_value
+        collection.find.return_value = [dict(unit_id="id1")]
+        repo = mock.MagicMock(repo_id="repo1")
+
+        self.assertEquals(2, models.MSI.bulk_associate(
+            units, repo, skip_associated=True))
+        collection.find.assert_called_once_with(
+            dict(repo_id="repo1", unit_id={'$in': ["id0", "id1", "id2"]}),
+            projection=dict(unit_id=True, _id=False))
+        ops = collection.bulk_write.call_args[0][0]
+        self.assertEquals(["id0", "id2"],
+                          [op._filter['unit_id'] for op in ops])
+
+        # Nothing is written if all units are associated
+        collection.bulk_write.reset_mock()
+        collection.find.return_value = [dict(unit_id=u.id) for u in units]
+        self.assertEquals(0, models.MSI.bulk_associate(
+            units, repo, skip_associated=True))
+        self.assertEquals(0, collection.bulk_write.call_count)
+
+    @mock.patch("pulp_win.plugins.db.models.BULK_CHUNK_SIZE", 2)
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    def test_bulk_unassociate(self, _RCU):
+        collection = _RCU._get_collection.return_value
+        collection.delete_many.side_effect = [
+            mock.MagicMock(deleted_count=2), mock.MagicMock(deleted_count=1)]
+        repo = mock.MagicMock(repo_id="repo1")
+
+        unit_ids = ("id%d" % i for i in range(3))
+        self.assertEquals(3, models.MSI.bulk_unassociate(unit_ids, repo))
+        self.assertEquals(
+            [mock.call(dict(repo_id="repo1",
+                            unit_id={'$in': ["id0", "id1"]})),
+             mock.call(dict(repo_id="repo1", unit_id={'$in': ["id2"]}))],
+            collection.delete_many.call_args_list)
+
+    def test_unit_key_digest(self):
+        unit = models.MSI(name="a", version="1", checksumtype="sha256",
+                          checksum="csum")
+        digest = models.MSI.unit_key_digest(unit.unit_key)
+        self.assertEquals(20, len(digest))
+        # Only the unit key matters, whatever the string type
+        self.assertEquals(digest, models.MSI.unit_key_digest(
+            dict(_id="id0", name=u"a", version=u"1", checksumtype="sha256",
+                 checksum="csum")))
+        self.assertNotEquals(digest, models.MSM.unit_key_digest(
+            unit.unit_key))
+        self.assertNotEquals(digest, models.MSI.unit_key_digest(
+            dict(unit.unit_key, version="2")))
+
+    @mock.patch("pulp_win.plugins.db.models.BULK_CHUNK_SIZE", 2)
+    @mock.patch("pulp_win.plugins.db.models.MSI._get_collection")
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    def test_repo_unit_key_digests(self, _RCU, _get_collection):
+        docs = [
+            dict(_id="id%d" % i, name="a", version=str(i),
+                 checksumtype="sha256", checksum="csum%d" % i)
+            for i in range(3)]
+        _RCU._get_collection.return_value.find.return_value = iter(
+            [dict(unit_id=doc['_id']) for doc in docs])
+        _get_collection.return_value.find.side_effect = [docs[:2], docs[2:]]
+        repo = mock.MagicMock(repo_id="repo1")
+
+        self.assertEquals(
+            [(doc['_id'], models.MSI.unit_key_digest(doc)) for doc in docs],
+            list(models.MSI.repo_unit_key_digests(repo)))
+        _RCU._get_collection.return_value.find.assert_called_once_with(
+            dict(repo_id="repo1", unit_type_id="msi"),
+            projection=dict(unit_id=True, _id=False))
+        projection = dict(name=True, version=True, checksumtype=True,
+                          checksum=True)
+        self.assertEquals(
+            [mock.call({'_id': {'$in': ["id0", "id1"]}},
+                       projection=projection),
+             mock.call({'_id': {'$in': ["id2"]}}, projection=projection)],
+            _get_collection.return_value.find.call_args_list)
+
+    @mock.patch("pulp_win.plugins.db.models.BULK_CHUNK_SIZE", 2)
+    @mock.patch("pulp_win.plugins.db.models.MSI._get_collection")
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    def test_repo_has_upstream_metadata(self, _RCU, _get_collection):
+        _RCU._get_collection.return_value.find.return_value = iter(
+            [dict(unit_id="id%d" % i) for i in range(3)])
+        _get_collection.return_value.find_one.side_effect = [
+            None, dict(_id="id2")]
+        repo = mock.MagicMock(repo_id="repo1")
+
+        self.assertTrue(models.MSI.repo_has_upstream_metadata(repo))
+        self.assertEquals(
+            [mock.call({'_id': {'$in': ["id0", "id1"]},
+                        'metadata_source': "upstream"},
+                       projection=dict(_id=True)),
+             mock.call({'_id': {'$in': ["id2"]},
+                        'metadata_source': "upstream"},
+                       projection=dict(_id=True))],
+            _get_collection.return_value.find_one.call_args_list)
+
+        _RCU._get_collection.return_value.find.return_value = iter(
+            [dict(unit_id="id0")])
+        _get_collection.return_value.find_one.side_effect = None
+        _get_collection.return_value.find_one.return_value = None
+        self.assertFalse(models.MSI.repo_has_upstream_metadata(repo))
+
+    @mock.patch("pulp_win.plugins.db.models.MSI._get_collection")
+    def test_bulk_save_and_associate_error(self, _get_collection):
+        unit = models.MSI(name="a", version="1", checksumtype="sha256",
+                          checksum="csum")
+        _get_collection.return_value.insert_many.side_effect = \
+            models.BulkWriteError(dict(writeErrors=[
+                dict(index=0, code=121, errmsg="Validation failed")]))
+        with self.assertRaises(models.BulkWriteError):
+            models.Package.bulk_save_and_associate([(unit, None)],
+                                                   mock.MagicMock())
+
+    def test_type_field_names(self):
+        self.assertEquals(
+            ['Manufacturer', 'ModuleSignature', 'ProductCode', 'ProductName',
+             'UpgradeCode'],
+            models.MSI.type_field_names())
+        self.assertEquals(['ModuleDependency', 'guid'],
+                          models.MSM.type_field_names())
+
     def test_render_primary_msi(self):
         pkg = models.MSI(name="burgundy", version="1.1.1984.0",
                          checksumtype="sha256", checksum="chksum",
@@ -0,0 +1,57 @@
+"""
+Contains tests for pulp_win.plugins.db.msidb
+"""
+
+import os
+from .... import testbase
+from pulp_win.plugins.db import msidb
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                           '../../../data'))
+
+
+class TestMsiDb(testbase.TestCase):
+    def test_decode_stream_name(self):
+        self.assertEquals(
+            msidb.TABLE_PREFIX + u'_StringPool',
+            msidb.decode_stream_name(
+                u'\u4840\u3f3f\u4577\u446c\u3e6a\u44b2\u482f'))
+        self.assertEquals(
+            msidb.TABLE_PREFIX + u'Property',
+            msidb.decode_stream_name(u'\u4840\u4559\u44f2\u4568\u4737'))
+        # Names that are not compressed are left alone
+        self.assertEquals(u'\x05SummaryInformation',
+                          msidb.decode_stream_name(u'\x05SummaryInformation'))
+
+    def test_read_tables(self):
+        msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
+        tables, rows = msidb.read_tables(
+            msi_path, ['Property', 'ModuleSignature', 'Upgrade'])
+        self.assertTrue('Property' in tables)
+        self.assertFalse('ModuleSignature' in tables)
+        self.assertEquals(['Property', 'Upgrade'], sorted(rows))
+        props = dict(rows['Property'])
+        self.assertEquals('lorem-ipsum', props['ProductName'])
+        self.assertEquals('0.0.1', props['ProductVersion'])
+        self.assertEquals('1033', props['ProductLanguage'])
+        # NULL values and integers
+        self.assertEquals(
+            [u'{12345678-1234-1234-1234-111111111111}', u'0.0.1', u'',
+             u'', u'258', u'', u'NEWERVERSIONDETECTED'],
+            rows['Upgrade'][1])
+
+    def test_read_tables_file_object(self):
+        msi_path = os.path.join(DATA_DIR, "lorem-ipsum-0.0.1.msi")
+        with open(msi_path, "rb") as fobj:
+            tables, rows = msidb.read_tables(fobj, ['Property'])
+        self.assertEquals('Cicero Enterprises',
+                          dict(rows['Property'])['Manufacturer'])
+
+    def test_read_tables_not_ole(self):
+        with self.assertRaises(msidb.InvalidFileError) as ctx:
+            msidb.read_tables(__file__, ['Property'])
+        self.assertEquals("Not an OLE compound file", str(ctx.exception))
+
+    def test_read_tables_missing_file(self):
+        with self.assertRaises(msidb.Error):
+            msidb.read_tables('/missing-file', ['Property'])
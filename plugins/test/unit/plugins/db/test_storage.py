@@ -0,0 +1,79 @@
+"""
+Contains tests for pulp_win.plugins.db.storage
+"""
+
+import errno
+import mock
+import os
+from .... import testbase
+from pulp_win.plugins.db import storage
+
+
+class TestImportFile(testbase.TestCase):
+    def setUp(self):
+        super(TestImportFile, self).setUp()
+        self.src = os.path.join(self.work_dir, "feed", "a-1.msi")
+        os.makedirs(os.path.dirname(self.src))
+        self.contents = "".join(chr(x % 256) for x in range(100000))
+        with open(self.src, "wb") as fobj:
+            fobj.write(self.contents)
+        self.dst = os.path.join(self.work_dir, "content", "aa", "a-1.msi")
+
+    def assertImported(self, method, expected_method):
+        self.assertEquals(expected_method, method)
+        with open(self.dst, "rb") as fobj:
+            self.assertEquals(self.contents, fobj.read())
+        # No temporary file left behind
+        self.assertEquals(["a-1.msi"], os.listdir(os.path.dirname(self.dst)))
+
+    def test_import_file_hardlink(self):
+        method = storage.import_file(self.src, self.dst)
+        self.assertImported(method, storage.HARDLINK)
+        self.assertEquals(os.stat(self.src).st_ino, os.stat(self.dst).st_ino)
+
+    @mock.patch("pulp_win.plugins.db.storage._reflink")
+    @mock.patch("pulp_win.plugins.db.storage.os.link")
+    def test_import_file_reflink(self, _link, _reflink):
+        _link.side_effect = OSError(errno.EXDEV, "Cross-device link")
+        method = storage.import_file(self.src, self.dst)
+        self.assertEquals(storage.REFLINK, method)
+        self.assertEquals(1, _reflink.call_count)
+
+    @mock.patch("pulp_win.plugins.db.storage._reflink")
+    def test_import_file_kernel_copy(self, _reflink):
+        _reflink.side_effect = IOError(errno.EOPNOTSUPP, "Not supported")
+        if storage._get_copy_file_range() is None:
+            self.skipTest("copy_file_range is not available")
+        method = storage.import_file(self.src, self.dst, allow_hardlink=False)
+        self.assertImported(method, storage.COPY_FILE_RANGE)
+        self.assertNotEquals(os.stat(self.src).st_ino,
+                             os.stat(self.dst).st_ino)
+
+    @mock.patch("pulp_win.plugins.db.storage._kernel_copy")
+    @mock.patch("pulp_win.plugins.db.storage._reflink")
+    def test_import_file_copy(self, _reflink, _kernel_copy):
+        _reflink.side_effect = IOError(errno.EOPNOTSUPP, "Not supported")
+
+        def partial_copy(fsrc, fdst):
+            # Some data was copied before failing
+            fdst.write("garbage")
+            raise OSError(errno.EXDEV, "Cross-device link")
+
+        _kernel_copy.side_effect = partial_copy
+        method = storage.import_file(self.src, self.dst, allow_hardlink=False)
+        self.assertImported(method, storage.COPY)
+
+    @mock.patch("pulp_win.plugins.db.storage._reflink")
+    def test_import_file_error(self, _reflink):
+        _reflink.side_effect = IOError(errno.EIO, "I/O error")
+        with self.assertRaises(IOError):
+            storage.import_file(self.src, self.dst, allow_hardlink=False)
+        # Neither the destination nor a temporary file
+        self.assertEquals([], os.listdir(os.path.dirname(self.dst)))
+
+    def test_import_file_replaces(self):
+        os.makedirs(os.path.dirname(self.dst))
+        with open(self.dst, "wb") as fobj:
+            fobj.write("old")
+        method = storage.import_file(self.src, self.dst)
+        self.assertImported(method, storage.HARDLINK)
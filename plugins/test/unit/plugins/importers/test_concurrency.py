@@ -0,0 +1,92 @@
+"""
+Contains tests for pulp_win.plugins.importers.concurrency
+"""
+
+import mock
+import threading
+from .... import testbase
+from pulp_win.plugins.importers import concurrency
+
+
+class TestAdaptiveConcurrency(testbase.TestCase):
+    def _new_controller(self, minimum=1, maximum=8, initial=4):
+        self.now = 1000.0
+        _time = mock.patch(
+            "pulp_win.plugins.importers.concurrency.time.time",
+            side_effect=lambda: self.now)
+        _time.start()
+        self.addCleanup(_time.stop)
+        return concurrency.AdaptiveConcurrency(minimum, maximum, initial)
+
+    def _window(self, ctrl, nbytes, failures=0):
+        """
+        Complete a round of downloads, one per slot, nbytes in total.
+        """
+        count = ctrl.limit
+        for _ in range(count):
+            ctrl.acquire()
+        self.now += concurrency.ADJUST_INTERVAL
+        changed = False
+        for idx in range(count):
+            changed = ctrl.release(nbytes / count, 1.0,
+                                   failed=idx < failures) or changed
+        return changed
+
+    def test_bounds(self):
+        ctrl = concurrency.AdaptiveConcurrency(2, 4, 10)
+        self.assertEquals((2, 4, 4), (ctrl.minimum, ctrl.maximum, ctrl.limit))
+        ctrl = concurrency.AdaptiveConcurrency(0, 0)
+        self.assertEquals((1, 1, 1), (ctrl.minimum, ctrl.maximum, ctrl.limit))
+
+    def test_hill_climb(self):
+        ctrl = self._new_controller()
+        # Grows while throughput improves
+        self.assertTrue(self._window(ctrl, 4000))
+        self.assertEquals(5, ctrl.limit)
+        self.assertTrue(self._window(ctrl, 5000))
+        self.assertEquals(6, ctrl.limit)
+        # Throughput no longer improves: back off
+        self.assertTrue(self._window(ctrl, 5000))
+        self.assertEquals(5, ctrl.limit)
+        # Average throughput of one download
+        self.assertEquals(5000 // 6, ctrl.connection_rate)
+
+    def test_not_adjusted_before_window(self):
+        ctrl = self._new_controller()
+        ctrl.acquire()
+        self.now += concurrency.ADJUST_INTERVAL
+        # Fewer completions than slots
+        self.assertFalse(ctrl.release(100, 1.0))
+        self.assertEquals(4, ctrl.limit)
+        self.assertEquals(0, ctrl.active)
+
+    def test_errors(self):
+        ctrl = self._new_controller()
+        self.assertTrue(self._window(ctrl, 4000, failures=2))
+        self.assertEquals(2, ctrl.limit)
+        self.assertTrue(self._window(ctrl, 4000, failures=2))
+        self.assertEquals(1, ctrl.limit)
+        # Never below the minimum
+        self._window(ctrl, 4000, failures=1)
+        self.assertEquals(1, ctrl.limit)
+
+    def test_upper_bound(self):
+        ctrl = self._new_controller(maximum=4)
+        self.assertFalse(self._window(ctrl, 4000))
+        self.assertEquals(4, ctrl.limit)
+
+    def test_throttle(self):
+        ctrl = concurrency.AdaptiveConcurrency(1, 1)
+        items = ctrl.throttle(iter([1, 2]))
+        self.assertEquals(1, next(items))
+        self.assertEquals(1, ctrl.active)
+        # The next item waits for the first download to finish
+        result = []
+        consumer = threading.Thread(target=lambda: result.extend(items))
+        consumer.start()
+        consumer.join(0.1)
+        self.assertTrue(consumer.is_alive())
+        ctrl.release(10, 1.0)
+        consumer.join(5)
+        self.assertFalse(consumer.is_alive())
+        self.assertEquals([2], result)
@@ -76,9 +76,24 @@ class TestWinImporter(testbase.TestCase):
     """
     This class contains tests for the WinImporter class.
     """
+    @classmethod
+    def _upserts(cls, repo, units):
+        now = models.dateutils.format_iso8601_utc_timestamp.return_value
+        return [
+            models.pymongo.UpdateOne(
+                dict(repo_id=repo.repo_id, unit_id=u.id,
+                     unit_type_id=u._content_type_id),
+                {'$setOnInsert': dict(created=now),
+                 '$set': dict(updated=now)},
+                upsert=True)
+            for u in sorted(units, key=lambda x: x.id)]
+
     @mock.patch("pulp_win.plugins.importers.importer.platform_models")
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    @mock.patch("pulp_win.plugins.db.models.dateutils")
     @mock.patch("pulp_win.plugins.db.models.repo_controller")
-    def test_import_units_units_none(self, _repo_controller, _platform_models):
+    def test_import_units_units_none(self, _repo_controller, _dateutils,
+                                     _RCU, _platform_models):
         """
         Assert correct behavior when units == None.
         """
@@ -107,20 +122,17 @@ class TestWinImporter(testbase.TestCase):
         _repo_controller.find_repo_content_units.assert_called_once_with(
             src_repo, yield_content_unit=True)
         # Assert that the units were associated correctly
-        _u = sorted(units)
         self.assertEquals(
-            [
-                mock.call(repository=dst_repo, unit=_u[0]),
-                mock.call(repository=dst_repo, unit=_u[1]),
-                mock.call(repository=dst_repo, unit=_u[2]),
-            ],
-            _repo_controller.associate_single_unit.call_args_list)
+            [mock.call(self._upserts(dst_repo, units), ordered=False)],
+            _RCU._get_collection.return_value.bulk_write.call_args_list)
         self.assertEqual(imported_units, sorted(units))
 
     @mock.patch("pulp_win.plugins.importers.importer.platform_models")
+    @mock.patch("pulp_win.plugins.db.models.RepositoryContentUnit")
+    @mock.patch("pulp_win.plugins.db.models.dateutils")
     @mock.patch("pulp_win.plugins.db.models.repo_controller")
-    def test_import_units_units_not_none(self, _repo_controller,
-                                         _platform_models):
+    def test_import_units_units_not_none(self, _repo_controller, _dateutils,
+                                         _RCU, _platform_models):
         """
         Assert correct behavior when units != None.
         """
@@ -146,14 +158,9 @@ class TestWinImporter(testbase.TestCase):
         self.assertEqual(
             0, _repo_controller.find_repo_content_units.call_count)
         # Assert that the units were associated correctly
-        _u = sorted(units)
         self.assertEquals(
-            [
-                mock.call(repository=dst_repo, unit=_u[0]),
-                mock.call(repository=dst_repo, unit=_u[1]),
-                mock.call(repository=dst_repo, unit=_u[2]),
-            ],
-            _repo_controller.associate_single_unit.call_args_list)
+            [mock.call(self._upserts(dst_repo, units), ordered=False)],
+            _RCU._get_collection.return_value.bulk_write.call_args_list)
         # Assert that the units were returned
         self.assertEqual(imported_units, sorted(units))
 
@@ -205,7 +212,9 @@ class TestWinImporter(testbase.TestCase):
         report = pulpimp.upload_unit(repo, type_id, unit_key, metadata,
                                      msi_file, conduit, config)
 
-        from_file.assert_called_once_with(file_path, metadata)
+        from_file.assert_called_once_with(file_path, metadata,
+                                          metadata_backend=None,
+                                          metadata_cache=mock.ANY)
 
         obj_id = _get_db.return_value.__getitem__.return_value.save.return_value.decode.return_value  # noqa
 
@@ -223,7 +232,8 @@ class TestWinImporter(testbase.TestCase):
         self.assertEqual(report,
                          {'success_flag': True,
                           'details': dict(
-                              unit=dict(unit_key=unit_key, metadata=metadata)
+                              unit=dict(unit_key=unit_key, metadata=metadata),
+                              import_method=models.storage.HARDLINK,
                           ),
                           'summary': ''})
 
@@ -260,7 +270,9 @@ class TestWinImporter(testbase.TestCase):
         report = pulpimp.upload_unit(repo, type_id, unit_key, metadata,
                                      msi_file, conduit, config)
 
-        from_file.assert_called_once_with(file_path, metadata)
+        from_file.assert_called_once_with(file_path, metadata,
+                                          metadata_backend=None,
+                                          metadata_cache=mock.ANY)
 
         obj_id = _get_db.return_value.__getitem__.return_value.save.return_value.decode.return_value  # noqa
 
@@ -278,7 +290,8 @@ class TestWinImporter(testbase.TestCase):
         self.assertEqual(report,
                          {'success_flag': True,
                           'details': dict(
-                              unit=dict(unit_key=unit_key, metadata=metadata)
+                              unit=dict(unit_key=unit_key, metadata=metadata),
+                              import_method=models.storage.HARDLINK,
                           ),
                           'summary': ''})
 
@@ -291,6 +304,116 @@ class TestWinImporter(testbase.TestCase):
 
         self.assertEqual(return_value, (True, None))
 
+    def test_validate_config_metadata_backend(self):
+        pulpimp = importer.WinImporter()
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(metadata_backend='msidump'))
+        self.assertEqual(return_value, (True, None))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(metadata_backend='bogus'))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'Unknown value for metadata_backend: bogus'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(metadata_cache_size='-1'))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'metadata_cache_size must be a non-negative integer'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(num_processing_workers=0))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'num_processing_workers must be a positive integer'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(adaptive_concurrency=True, min_threads=2,
+                                   max_threads=10))
+        self.assertEqual(return_value, (True, None))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(min_threads=10, max_threads='x'))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'max_threads must be a positive integer'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(min_threads=10, max_threads=2))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'min_threads must not be greater than max_threads'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(segmented_download_threshold=-1,
+                                   download_segments=0))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'segmented_download_threshold must be a non-negative integer\n'
+             'download_segments must be a positive integer'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(stripe_mirrors='no'))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'stripe_mirrors must be a boolean'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(probe_mirrors='no', mirror_probe_ttl=-1))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'probe_mirrors must be a boolean\n'
+             'mirror_probe_ttl must be a non-negative integer'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(force_full_sync='yes'))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'force_full_sync must be a boolean'))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(trust_upstream_metadata=True,
+                                   trust_upstream_metadata_audit_rate=0.1))
+        self.assertEqual(return_value, (True, None))
+
+        return_value = pulpimp.validate_config(
+            mock.MagicMock(), dict(trust_upstream_metadata_audit_rate=2))
+        self.assertEqual(
+            return_value,
+            (False, 'Configuration errors:\n'
+             'trust_upstream_metadata_audit_rate must be a number between '
+             '0 and 1'))
+
+    @mock.patch('pulp_win.plugins.db.models.MSI.from_file')
+    @mock.patch("pulp_win.plugins.importers.importer.plugin_api")
+    def test_upload_unit_metadata_backend(self, _plugin_api, from_file):
+        _plugin_api.get_unit_model_by_id.return_value = models.MSI
+        file_path, checksum = self.new_file("foo.msi")
+        from_file.side_effect = models.InvalidPackageError("bad")
+
+        pulpimp = importer.WinImporter()
+        config = dict(metadata_backend='msidump', metadata_cache_size=0)
+        report = pulpimp.upload_unit(mock.MagicMock(), ids.TYPE_ID_MSI,
+                                     dict(), dict(), file_path,
+                                     mock.MagicMock(), config)
+        from_file.assert_called_once_with(file_path, dict(),
+                                          metadata_backend='msidump',
+                                          metadata_cache=None)
+        self.assertEqual(
+            {'success_flag': False, 'summary': '',
+             'details': {'errors': ['bad']}},
+            report)
+
     @mock.patch("pulp_win.plugins.importers.importer.sync.RepoSync")
     def test_sync(self, _RepoSync):
         # Basic test to make sure we're passing information correctly into
@@ -307,3 +430,39 @@ class TestWinImporter(testbase.TestCase):
         _RepoSync.assert_called_once_with(
             repo.repo_obj, conduit, cfg)
         self.assertEquals(repo.repo_obj, conduit.repo)
+
+    @mock.patch("pulp_win.plugins.db.models.repo_controller")
+    @mock.patch("pulp_win.plugins.importers.importer.sync.RepoSync")
+    def test_sync_repo_group(self, _RepoSync, _repo_controller):
+        repos = [mock.MagicMock() for _ in range(3)]
+        conduits = [mock.MagicMock() for _ in range(3)]
+        cfgs = [mock.MagicMock() for _ in range(3)]
+        syncs = [mock.MagicMock() for _ in range(3)]
+        _RepoSync.side_effect = syncs
+        leader = _RepoSync.grouped.return_value
+        leader.run.return_value.success_flag = True
+
+        pulpimp = importer.WinImporter()
+        reports = pulpimp.sync_repo_group(zip(repos, conduits, cfgs))
+
+        self.assertEquals(
+            [mock.call(r.repo_obj, c, cfg)
+             for r, c, cfg in zip(repos, conduits, cfgs)],
+            _RepoSync.call_args_list)
+        _RepoSync.grouped.assert_called_once_with(syncs)
+        self.assertEquals(leader, pulpimp._current_sync)
+        # A single sync for the whole group
+        leader.run.assert_called_once_with()
+        self.assertEquals(
+            [leader.run.return_value] +
+            [s.conduit.build_success_report.return_value
+             for s in syncs[1:]],
+            reports)
+        syncs[1].conduit.build_success_report.assert_called_once_with(
+            leader.progress_summary, leader.progress_report)
+        self.assertEquals([r.repo_obj for r in repos],
+                          [c.repo for c in conduits])
+        # Unit counts are rebuilt for every repository
+        self.assertEquals(
+            [mock.call(s.conduit.repo) for s in syncs],
+            _repo_controller.rebuild_content_unit_counts.call_args_list)
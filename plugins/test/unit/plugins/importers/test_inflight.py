@@ -0,0 +1,96 @@
+"""
+Contains tests for pulp_win.plugins.importers.inflight
+"""
+
+import mock
+import os
+import threading
+from .... import testbase
+from pulp_win.plugins.importers import inflight
+
+KEY = ("sha256", "0123456789abcdef")
+
+
+class TestDownloadRegistry(testbase.TestCase):
+    def _new_registry(self):
+        return inflight.DownloadRegistry(
+            os.path.join(self.work_dir, "downloads"))
+
+    def test_from_config(self):
+        registry = inflight.DownloadRegistry.from_config()
+        self.assertEquals(
+            os.path.join(self.pulp_working_dir, inflight.REGISTRY_DIRNAME),
+            registry.path)
+
+    def test_claim_release(self):
+        reg1 = self._new_registry()
+        reg2 = self._new_registry()
+        self.assertTrue(reg1.claim(KEY))
+        # Claiming again is fine
+        self.assertTrue(reg1.claim(KEY))
+        # Claimed elsewhere
+        self.assertFalse(reg2.claim(KEY))
+        self.assertTrue(reg2.claim(("sha256", "other")))
+
+        reg1.release(KEY)
+        self.assertTrue(reg2.claim(KEY))
+        reg2.release_all()
+        # Claim files are removed once released
+        self.assertEquals([], os.listdir(reg1.path))
+        # Releasing what is not claimed does nothing
+        reg1.release(KEY)
+
+    def test_claim_stale(self):
+        reg1 = self._new_registry()
+        self.assertTrue(reg1.claim(KEY))
+        # The claiming process went away without releasing
+        os.close(reg1._claims.pop(KEY))
+        self.assertTrue(self._new_registry().claim(KEY))
+
+    def test_wait(self):
+        reg1 = self._new_registry()
+        reg2 = self._new_registry()
+        # Nothing to wait for
+        self.assertTrue(reg2.wait(KEY))
+
+        self.assertTrue(reg1.claim(KEY))
+        self.assertFalse(reg2.wait(KEY, timeout=0))
+
+        with mock.patch("pulp_win.plugins.importers.inflight.time.sleep") \
+                as _sleep:
+            # Released while waiting
+            _sleep.side_effect = lambda *args: reg1.release(KEY)
+            self.assertTrue(reg2.wait(KEY))
+        self.assertEquals(1, _sleep.call_count)
+
+    def test_wait_cancel(self):
+        reg1 = self._new_registry()
+        reg2 = self._new_registry()
+        self.assertTrue(reg1.claim(KEY))
+        cancel = threading.Event()
+        waiter = threading.Thread(target=reg2.wait, args=(KEY, ),
+                                  kwargs=dict(cancel=cancel))
+        waiter.start()
+        waiter.join(0.1)
+        self.assertTrue(waiter.is_alive())
+        cancel.set()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        # Still claimed
+        self.assertFalse(reg2.wait(KEY, cancel=cancel))
+
+    def test_wait_thread(self):
+        # Claims are also honored within a process, e.g. between syncs in
+        # different threads
+        reg1 = self._new_registry()
+        reg2 = self._new_registry()
+        self.assertTrue(reg1.claim(KEY))
+        waiter = threading.Thread(target=reg2.wait, args=(KEY, ))
+        with mock.patch("pulp_win.plugins.importers.inflight.POLL_INTERVAL",
+                        0.01):
+            waiter.start()
+            waiter.join(0.1)
+            self.assertTrue(waiter.is_alive())
+            reg1.release(KEY)
+            waiter.join(5)
+        self.assertFalse(waiter.is_alive())
@@ -0,0 +1,83 @@
+"""
+Contains tests for pulp_win.plugins.importers.mirrors
+"""
+
+import mock
+from .... import testbase
+from pulp_win.plugins.importers import mirrors
+
+URLS = ["http://m1/repo", "http://m2/repo/", "http://m3/repo/"]
+
+
+class TestMirrorSet(testbase.TestCase):
+    def setUp(self):
+        super(TestMirrorSet, self).setUp()
+        self.now = 1000.0
+        _time = mock.patch("pulp_win.plugins.importers.mirrors.time.time",
+                           side_effect=lambda: self.now)
+        _time.start()
+        self.addCleanup(_time.stop)
+
+    def _choices(self, mirror_set, picks, exclude=()):
+        """
+        Choose with random.uniform returning each of picks, as a fraction of
+        the total weight.
+        """
+        result = []
+        with mock.patch("pulp_win.plugins.importers.mirrors.random.uniform",
+                        side_effect=lambda low, high: pick * high):
+            for pick in picks:
+                result.append(mirror_set.choose(exclude=exclude))
+        return result
+
+    def test_init(self):
+        mirror_set = mirrors.MirrorSet(URLS + ["http://m1/repo/"])
+        self.assertEquals(3, len(mirror_set))
+        self.assertEquals("http://m1/repo/", mirror_set.mirrors[0].url)
+
+    def test_weighted(self):
+        mirror_set = mirrors.MirrorSet(URLS)
+        # Not measured yet: same weight
+        self.assertEquals(
+            ["http://m1/repo/", "http://m2/repo/", "http://m3/repo/"],
+            self._choices(mirror_set, [0.3, 0.6, 0.9]))
+
+        mirror_set.record("http://m1/repo/a.msi", 3000, 1)
+        mirror_set.record("http://m2/repo/a.msi", 1000, 1)
+        # m3 gets the average weight: 3000, 1000, 2000
+        self.assertEquals(
+            ["http://m1/repo/", "http://m2/repo/", "http://m3/repo/"],
+            self._choices(mirror_set, [0.49, 0.66, 0.67]))
+        self.assertEquals(
+            ["http://m3/repo/"],
+            self._choices(mirror_set, [0.5],
+                          exclude=["http://m1/repo/", "http://m2/repo/"]))
+
+        # Moving average
+        mirror_set.record("http://m2/repo/b.msi", 2000, 1)
+        self.assertEquals(1300, mirror_set.mirrors[1].rate)
+
+    def test_errors(self):
+        mirror_set = mirrors.MirrorSet(URLS)
+        mirror_set.record("http://m1/repo/a.msi", 0, None, failed=True)
+        mirror_set.record("http://m2/repo/a.msi", 0, None, failed=True)
+        mirror_set.record("http://m2/repo/b.msi", 0, None, failed=True)
+        self.assertEquals(["http://m3/repo/"] * 2,
+                          self._choices(mirror_set, [0.1, 0.9]))
+        # All of them out: the one back first is picked
+        self.assertEquals(["http://m1/repo/"],
+                          self._choices(mirror_set, [0.9],
+                                        exclude=URLS[2:]))
+        self.assertEquals(None, mirror_set.choose(exclude=[
+            m.url for m in mirror_set.mirrors]))
+
+        # m1 is back after ERROR_BACKOFF, m2 after twice that
+        self.now += mirrors.ERROR_BACKOFF
+        self.assertEquals(["http://m1/repo/", "http://m3/repo/"],
+                          self._choices(mirror_set, [0.1, 0.9]))
+        self.now += mirrors.ERROR_BACKOFF
+        self.assertEquals(["http://m2/repo/"],
+                          self._choices(mirror_set, [0.5]))
+        # A success resets the backoff
+        mirror_set.record("http://m2/repo/c.msi", 1000, 1)
+        self.assertEquals(0, mirror_set.mirrors[1].errors)
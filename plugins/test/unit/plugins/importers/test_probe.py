@@ -0,0 +1,86 @@
+"""
+Contains tests for pulp_win.plugins.importers.probe
+"""
+
+import BaseHTTPServer
+import requests
+import threading
+from .... import testbase
+from pulp_win.plugins.importers import probe
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <revision>%s</revision>
+</repomd>
+"""
+
+
+class RepomdHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves /<mirror>/repodata/repomd.xml with the revision in revisions.
+    """
+    revisions = dict(m1="1476732856", m2="1476732900")
+
+    def do_GET(self):
+        mirror, _, path = self.path.lstrip('/').partition('/')
+        if path != probe.REPOMD_PATH or mirror not in self.revisions:
+            self.send_error(404)
+            return
+        body = REPOMD % self.revisions[mirror]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestProbe(testbase.TestCase):
+    def setUp(self):
+        super(TestProbe, self).setUp()
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RepomdHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.base_url = "http://127.0.0.1:%d/" % server.server_port
+
+    def test_probe(self):
+        urls = [self.base_url + "m1", self.base_url + "m2/",
+                self.base_url + "m3/"]
+        results = probe.probe(requests.Session(), urls)
+        self.assertEquals(urls, [r.url for r in results])
+        self.assertEquals(["1476732856", "1476732900", None],
+                          [r.revision for r in results])
+        self.assertEquals(None, results[0].error)
+        self.assertTrue(results[0].latency >= 0)
+        self.assertEquals(None, results[2].latency)
+        self.assertTrue(results[2].error.startswith("HTTP 404"))
+        # Newest revision first
+        self.assertEquals([urls[1], urls[0], urls[2]], probe.rank(results))
+
+    def test_probe_url_modify(self):
+        urls = [self.base_url + "m1/", self.base_url + "m2/"]
+        # Only m2 is served under the modified URL
+        results = probe.probe(
+            requests.Session(), urls,
+            url_modify=lambda url: url.replace("/m1/", "/m3/"))
+        self.assertTrue(results[0].error.startswith("HTTP 404"))
+        self.assertEquals("1476732900", results[1].revision)
+
+    def test_rank(self):
+        results = [
+            probe.ProbeResult("http://m1/", error="timed out"),
+            probe.ProbeResult("http://m2/", 0.5, "1476732856"),
+            probe.ProbeResult("http://m3/", 0.2, "1476732856"),
+            probe.ProbeResult("http://m4/", 0.1, "999"),
+            probe.ProbeResult("http://m5/", 0.05),
+            probe.ProbeResult("http://m6/", 0.3, "1476732900"),
+            probe.ProbeResult("http://m7/", error="HTTP 404 Not Found"),
+        ]
+        self.assertEquals(
+            ["http://m6/", "http://m3/", "http://m2/", "http://m4/",
+             "http://m5/", "http://m1/", "http://m7/"],
+            probe.rank(results))
@@ -0,0 +1,212 @@
+"""
+Contains tests for pulp_win.plugins.importers.ranged
+"""
+
+import BaseHTTPServer
+import mock
+import os
+import re
+import requests
+import threading
+from .... import testbase
+from pulp_win.plugins.importers import ranged
+
+DATA = "".join(chr(i % 256) for i in range(10000))
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves DATA, honoring single Range requests unless honor_range is False.
+    If cut_at is set, the next response ends early, after cut_at bytes.
+    """
+    honor_range = True
+    cut_at = None
+    # The Range header of each request
+    requests = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        with self.lock:
+            self.requests.append(range_header)
+        if self.path != "/repo/a.msi":
+            self.send_error(404)
+            return
+        match = re.match(r'bytes=(\d+)-(\d*)$', range_header or '')
+        if not (match and self.honor_range):
+            self._send(200, DATA)
+            return
+        start = int(match.group(1))
+        end = int(match.group(2) or len(DATA) - 1) + 1
+        if start >= len(DATA):
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % len(DATA))
+            self.end_headers()
+            return
+        self._send(206, DATA[start:end], {
+            'Content-Range': 'bytes %d-%d/%d' % (start, end - 1, len(DATA))})
+
+    def _send(self, code, body, headers=None):
+        self.send_response(code)
+        for name, value in sorted((headers or {}).items()):
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        with self.lock:
+            cut_at, RangeHandler.cut_at = RangeHandler.cut_at, None
+        if cut_at is not None:
+            body = body[:cut_at]
+            self.close_connection = 1
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRangeDownloader(testbase.TestCase):
+    def setUp(self):
+        super(TestRangeDownloader, self).setUp()
+        RangeHandler.honor_range = True
+        RangeHandler.cut_at = None
+        RangeHandler.requests = []
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RangeHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = "http://127.0.0.1:%d/repo/a.msi" % server.server_port
+        self.path = os.path.join(self.work_dir, "a.msi")
+        self.downloader = ranged.RangeDownloader(requests.Session())
+
+    def _partial(self, data):
+        with open(self.path, "wb") as fobj:
+            fobj.write(data)
+
+    def test_fetch(self):
+        self.assertEquals(len(DATA), self.downloader.fetch(self.url,
+                                                           self.path))
+        self.assertEquals(DATA, open(self.path, "rb").read())
+        self.assertEquals([None], RangeHandler.requests)
+
+    def test_resume(self):
+        # Whatever is past the offset is replaced
+        self._partial(DATA[:4000] + "garbage")
+        checkpoints = []
+        with mock.patch.object(ranged, "CHECKPOINT_SIZE", 2500):
+            self.assertEquals(
+                len(DATA),
+                self.downloader.fetch(self.url, self.path, 4000,
+                                      checkpoint=checkpoints.append))
+        self.assertEquals(DATA, open(self.path, "rb").read())
+        self.assertEquals(["bytes=4000-"], RangeHandler.requests)
+        self.assertEquals(len(DATA), checkpoints[-1])
+        self.assertTrue(len(checkpoints) > 1)
+
+    def test_range_not_honored(self):
+        RangeHandler.honor_range = False
+        self._partial("garbage")
+        self.assertEquals(len(DATA),
+                          self.downloader.fetch(self.url, self.path, 4000))
+        self.assertEquals(DATA, open(self.path, "rb").read())
+
+    def test_already_complete(self):
+        self._partial(DATA)
+        self.assertEquals(len(DATA),
+                          self.downloader.fetch(self.url, self.path,
+                                                len(DATA)))
+        self.assertEquals(DATA, open(self.path, "rb").read())
+
+    def test_errors(self):
+        with self.assertRaises(ranged.RangeDownloadError):
+            self.downloader.fetch(self.url + ".missing", self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEquals([None], RangeHandler.requests)
+
+        response = mock.MagicMock(status_code=206, headers={
+            'Content-Range': 'bytes 0-9999/10000'})
+        self.downloader.session = mock.MagicMock()
+        self.downloader.session.get.return_value = response
+        with self.assertRaises(ranged.RangeDownloadError):
+            self.downloader.fetch(self.url, self.path, 4000)
+        response.close.assert_called_once_with()
+
+    def test_fetch_retried(self):
+        RangeHandler.cut_at = 3000
+        checkpoints = []
+        self.assertEquals(len(DATA), self.downloader.fetch(
+            self.url, self.path, checkpoint=checkpoints.append))
+        self.assertEquals(DATA, open(self.path, "rb").read())
+        # Resumed where the transfer broke
+        self.assertEquals([None, "bytes=3000-"], RangeHandler.requests)
+        self.assertEquals([3000, len(DATA)], checkpoints)
+
+    def test_split(self):
+        self.assertEquals([[0, 3, 0], [3, 6, 3], [6, 10, 6]],
+                          ranged.split(10, 3))
+        # No empty segments
+        self.assertEquals([[0, 1, 0], [1, 2, 1]], ranged.split(2, 8))
+        self.assertEquals([[0, 0, 0]], ranged.split(0, 4))
+
+    def test_fetch_segmented(self):
+        checkpoints = []
+        self.assertEquals(len(DATA), self.downloader.fetch_segmented(
+            self.url, self.path, len(DATA), ranged.split(len(DATA), 4),
+            checkpoint=checkpoints.append))
+        self.assertEquals(DATA, open(self.path, "rb").read())
+        self.assertEquals(
+            ["bytes=0-2499", "bytes=2500-4999", "bytes=5000-7499",
+             "bytes=7500-9999"],
+            sorted(RangeHandler.requests))
+        self.assertEquals(
+            [[0, 2500, 2500], [2500, 5000, 5000], [5000, 7500, 7500],
+             [7500, 10000, 10000]],
+            checkpoints[-1])
+
+    def test_fetch_segmented_resume(self):
+        # Segments reached by an interrupted download; the rest of the file
+        # is garbage
+        data = DATA[:1000] + "x" * 4000 + DATA[5000:6000] + "x" * 4000
+        self._partial(data)
+        segments = [[0, 5000, 1000], [5000, 10000, 6000]]
+        self.downloader.fetch_segmented(self.url, self.path, len(DATA),
+                                        segments)
+        self.assertEquals(DATA, open(self.path, "rb").read())
+        self.assertEquals(["bytes=1000-4999", "bytes=6000-9999"],
+                          sorted(RangeHandler.requests))
+
+        # Complete segments are not downloaded again
+        RangeHandler.requests = []
+        self.downloader.fetch_segmented(
+            self.url, self.path, len(DATA),
+            [[0, 5000, 5000], [5000, 10000, 9000]])
+        self.assertEquals(["bytes=9000-9999"], RangeHandler.requests)
+        self.assertEquals(DATA, open(self.path, "rb").read())
+
+    def test_fetch_segmented_retried(self):
+        RangeHandler.cut_at = 1000
+        checkpoints = []
+        self.downloader.fetch_segmented(
+            self.url, self.path, len(DATA), [[0, len(DATA), 0]],
+            checkpoint=checkpoints.append)
+        self.assertEquals(DATA, open(self.path, "rb").read())
+        self.assertEquals(["bytes=0-9999", "bytes=1000-9999"],
+                          RangeHandler.requests)
+        self.assertEquals([[[0, 10000, 1000]], [[0, 10000, 10000]]],
+                          checkpoints)
+
+    def test_fetch_segmented_range_not_supported(self):
+        RangeHandler.honor_range = False
+        with self.assertRaises(ranged.RangeNotSupported):
+            self.downloader.fetch_segmented(self.url, self.path, len(DATA),
+                                            ranged.split(len(DATA), 2))
+
+    def test_fetch_segmented_error(self):
+        self.downloader.tries = 2
+        with self.assertRaises(ranged.RangeDownloadError):
+            self.downloader.fetch_segmented(
+                self.url + ".missing", self.path, len(DATA),
+                ranged.split(len(DATA), 2))
+        # Not retried
+        self.assertEquals(["bytes=0-4999", "bytes=5000-9999"],
+                          sorted(RangeHandler.requests))
@@ -0,0 +1,139 @@
+"""
+Contains tests for pulp_win.plugins.importers.staging
+"""
+
+import json
+import mock
+import os
+from .... import testbase
+from pulp_win.plugins.importers import staging
+
+
+class TestStagingArea(testbase.TestCase):
+    def _new_area(self):
+        return staging.StagingArea(os.path.join(self.work_dir, "staging"))
+
+    def _unit(self, name, checksum="csum", size=10):
+        return mock.MagicMock(download_path="sub/%s" % name,
+                              checksumtype="sha256", checksum=checksum,
+                              size=size)
+
+    def _write(self, area, name, data):
+        path = os.path.join(area.path, name)
+        with open(path, "wb") as fobj:
+            fobj.write(data)
+        return path
+
+    def test_from_config(self):
+        area = staging.StagingArea.from_config("repo1")
+        self.assertEquals(
+            os.path.join(self.pulp_working_dir, staging.STAGING_DIRNAME,
+                         "repo1"),
+            area.path)
+
+    def test_resume_after_restart(self):
+        area = self._new_area()
+        unit_a, unit_b, unit_c = (self._unit(n) for n in
+                                  ("a.msi", "b.msi", "c.msi"))
+        self.assertEquals((os.path.join(area.path, "a.msi"), 0, None),
+                          area.lookup(unit_a))
+        path_a = area.start(unit_a)
+        path_b = area.start(unit_b)
+        path_c = area.start(unit_c)
+        # a was downloaded and verified, b written by the downloader up to
+        # 4 bytes, c resumed and checkpointed at 3 bytes, then written
+        # further
+        self._write(area, "a.msi", "0123456789")
+        area.verified(path_a)
+        self._write(area, "b.msi", "0123")
+        self._write(area, "c.msi", "012345")
+        area.checkpoint(path_c, 3)
+        # The worker dies
+        area.close()
+
+        area = self._new_area()
+        self.assertEquals((path_a, 10, None), area.lookup(unit_a))
+        self.assertEquals((path_b, 4, None), area.lookup(unit_b))
+        self.assertEquals((path_c, 3, None), area.lookup(unit_c))
+        area.close()
+        # The journal was compacted
+        with open(area.journal_path) as fobj:
+            entries = [json.loads(line) for line in fobj]
+        self.assertEquals(["a.msi", "b.msi", "c.msi"],
+                          sorted(e["name"] for e in entries))
+
+    def test_stale_files(self):
+        area = self._new_area()
+        unit_a, unit_b = self._unit("a.msi"), self._unit("b.msi")
+        path_a = area.start(unit_a)
+        self._write(area, "a.msi", "0123456789")
+        area.verified(path_a)
+        os.unlink(path_a)
+        path_b = area.start(unit_b)
+        # Not journaled
+        self._write(area, "stray.msi", "x")
+        # Larger than the unit
+        self._write(area, "b.msi", "0" * 11)
+        area.close()
+        # A torn record at the end of the journal
+        with open(area.journal_path, "a") as fobj:
+            fobj.write('{"name": "a.m')
+
+        area = self._new_area()
+        # a was verified, but its file is missing
+        self.assertEquals(0, area.lookup(unit_a)[1])
+        self.assertEquals(0, area.lookup(unit_b)[1])
+        self.assertEquals([staging.JOURNAL_FILENAME], os.listdir(area.path))
+        self.assertFalse(os.path.exists(path_b))
+        area.close()
+
+    def test_segments(self):
+        area = self._new_area()
+        unit = self._unit("a.msi")
+        path = area.start(unit, [[0, 5, 0], [5, 10, 5]])
+        self._write(area, "a.msi", "01" + "\0" * 5 + "78\0")
+        area.checkpoint_segments(path, [[0, 5, 2], [5, 10, 9]])
+        area.close()
+
+        area = self._new_area()
+        self.assertEquals((path, 6, [[0, 5, 2], [5, 10, 9]]),
+                          area.lookup(unit))
+        area.verified(path)
+        area.close()
+        area = self._new_area()
+        self.assertEquals((path, 10, None), area.lookup(unit))
+
+        # Not preallocated: unusable
+        path = area.start(unit, [[0, 5, 0], [5, 10, 5]])
+        self._write(area, "a.msi", "01")
+        area.close()
+        area = self._new_area()
+        self.assertEquals((path, 0, None), area.lookup(unit))
+        area.close()
+
+    def test_lookup_other_unit(self):
+        area = self._new_area()
+        path = area.start(self._unit("a.msi"))
+        self._write(area, "a.msi", "0123")
+        # Same file name upstream, different checksum
+        self.assertEquals((path, 0, None),
+                          area.lookup(self._unit("a.msi", checksum="new")))
+        self.assertFalse(os.path.exists(path))
+        area.close()
+
+    def test_discard_prune(self):
+        area = self._new_area()
+        path_a = area.start(self._unit("a.msi"))
+        path_b = area.start(self._unit("b.msi"))
+        self._write(area, "a.msi", "0123")
+        self._write(area, "b.msi", "0123")
+        area.discard(path_a)
+        self.assertFalse(os.path.exists(path_a))
+        area.close()
+
+        area = self._new_area()
+        area.lookup(self._unit("c.msi"))
+        # b was not needed by this sync
+        area.prune()
+        self.assertFalse(os.path.exists(path_b))
+        area.close()
@@ -1,43 +1,55 @@
 """
 Contains tests for plugins.importers.importer.
 """
+import BaseHTTPServer
+import datetime
 import json
 import mock
 import os
+import StringIO
+import threading
 
 from .... import testbase
-from pulp_win.plugins.importers import sync
+from pulp_win.plugins.importers import probe, staging, sync
 from pulp_win.plugins.importers.report import ContentReport
 
+# The options recorded in the sync state, as set by new_config()
+SYNC_OPTIONS = dict(remove_missing=False, trust_upstream_metadata=False,
+                    metadata_backend=None)
+
 
 class TestSync(testbase.TestCase):
-    def new_config(self, feed="http://example.com/repo"):
-        cfgdict = dict(feed=feed)
+    def new_config(self, feed="http://example.com/repo", **kwargs):
+        cfgdict = dict(feed=feed, **kwargs)
         config = mock.MagicMock()
         config.configure_mock(**cfgdict)
         config.flatten.return_value = cfgdict
         config.get.side_effect = cfgdict.get
         return config
 
-    @mock.patch("pulp_win.plugins.db.models.MSM.save_and_associate")
-    @mock.patch("pulp_win.plugins.db.models.MSM.from_file")
-    @mock.patch("pulp_win.plugins.db.models.MSI.save_and_associate")
-    @mock.patch("pulp_win.plugins.db.models.MSI.from_file")
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    @mock.patch("pulp_win.plugins.db.models.Package.bulk_associate")
+    @mock.patch("pulp_win.plugins.db.models.MSM.find_by_unit_keys")
+    @mock.patch("pulp_win.plugins.db.models.MSI.find_by_unit_keys")
+    @mock.patch("pulp_win.plugins.db.models.Package.bulk_save_and_associate")
+    @mock.patch("pulp_win.plugins.db.models.MSM.from_files")
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
     @mock.patch("nectar.downloaders.threaded.requests.Session")
     @mock.patch("pulp.server.content.sources.container.managers.content_catalog_manager")  # noqa
     @mock.patch("pulp.server.content.sources.container.ContentSource",
                 autospec=True)
     @mock.patch("pulp_rpm.plugins.importers.yum.sync.metadata.nectar_factory")
     @mock.patch("pulp.server.managers.repo._common.task.current")
-    @mock.patch("pulp_win.plugins.importers.sync.units_controller")
     @mock.patch("pulp_rpm.plugins.importers.yum.sync.repo_controller")
     @mock.patch("pulp_win.plugins.db.models.repo_controller")
     def test_sync(self, _db_repo_controller,
-                  _repo_controller, _units_controller, _task_current,
+                  _repo_controller, _task_current,
                   _nectar_factory, _ContentSource, _content_catalog_manager,
                   _Session,
-                  _msi_from_file, _msi_save_and_associate,
-                  _msm_from_file, _msm_save_and_associate):
+                  _msi_from_files, _msm_from_files,
+                  _bulk_save_and_associate, _msi_find_by_unit_keys,
+                  _msm_find_by_unit_keys, _bulk_associate,
+                  _platform_models):
         _task_current.request.id = 'aabb'
         worker_name = "worker01"
         _task_current.request.configure_mock(hostname=worker_name)
@@ -61,6 +73,7 @@ class TestSync(testbase.TestCase):
 
         repo = mock.MagicMock()
         conduit = mock.MagicMock(**{"last_sync.return_value": None})
+        conduit.repo.repo_id = "repo1"
         config = self.new_config()
 
         _repo_controller.missing_unit_count.return_value = 10
@@ -73,10 +86,10 @@ class TestSync(testbase.TestCase):
         ]
 
         # An existing unit which should not be re-downloaded
-        _units_controller.find_units.side_effect = [
-            [existing_units[0]],
-            [existing_units[1]],
-        ]
+        _msi_find_by_unit_keys.return_value = dict(
+            (u.unit_key_as_named_tuple, u) for u in existing_units[:1])
+        _msm_find_by_unit_keys.return_value = dict(
+            (u.unit_key_as_named_tuple, u) for u in existing_units[1:])
 
         _xml_content = {
             "repomd.xml": REPOMD_XML,
@@ -93,8 +106,14 @@ class TestSync(testbase.TestCase):
                     continue
                 raise Exception("Unknown metadata file requested")
 
+        def mock_download_one(request):
+            request.destination.write(REPOMD_XML)
+            return mock.MagicMock(state="succeeded", headers={})
+
         _nectar_factory.create_downloader.return_value.download.side_effect = \
             mock_download
+        _nectar_factory.create_downloader.return_value.download_one.\
+            side_effect = mock_download_one
 
         unit1 = sync.models.MSI(
             name='a', version='1', checksumtype='sha256',
@@ -102,8 +121,9 @@ class TestSync(testbase.TestCase):
             filename='a-1.msi', _last_updated=1234567890,
             size=123,
         )
-        _msi_from_file.return_value = unit1
-        _msi_save_and_associate.return_value = unit1
+        unit1.checksums = dict(sha256=unit1.checksum)
+        _msi_from_files.side_effect = lambda paths, **kw: [
+            sync.models.FileResult(p, unit1, None) for p in paths]
 
         unit2 = sync.models.MSM(
             name='a', version='1', checksumtype='sha256',
@@ -111,8 +131,13 @@ class TestSync(testbase.TestCase):
             filename='a-1.msm', _last_updated=1234567890,
             size=123,
         )
-        _msm_from_file.return_value = unit2
-        _msm_save_and_associate.return_value = unit2
+        unit2.checksums = dict(sha256=unit2.checksum)
+        _msm_from_files.side_effect = lambda paths, **kw: [
+            sync.models.FileResult(p, unit2, None) for p in paths]
+
+        _bulk_save_and_associate.side_effect = \
+            lambda units_and_paths, repo, **kwargs: [
+                u for u, _ in units_and_paths]
 
         reposync = sync.RepoSync(repo, conduit, config)
 
@@ -131,7 +156,9 @@ class TestSync(testbase.TestCase):
                                  'items_total': 2,
                                  'state': 'FINISHED', 'size_left': 0,
                                  'details': {'msm_done': 1, 'msi_total': 1,
-                                             'msm_total': 1, 'msi_done': 1},
+                                             'msm_total': 1, 'msi_done': 1,
+                                             'msi_removed': 0,
+                                             'msm_removed': 0},
                                  'error_details': []},
                      'metadata': {'state': 'FINISHED'}}
                 ),
@@ -157,32 +184,1358 @@ class TestSync(testbase.TestCase):
                             checksum=csm2)
         ]
 
-        # Make sure find_units was called with the expected arguments
+        # Make sure existing units were looked up in bulk
         self.assertEquals(
             [
                 set(x.unit_key_as_named_tuple for x in exp_msi),
                 set(x.unit_key_as_named_tuple for x in exp_msm),
             ],
-            [set(x.unit_key_as_named_tuple
-                 for x in cl[0][0])
-             for cl in _units_controller.find_units.call_args_list])
+            [set(x.unit_key_as_named_tuple for x in cl[0][0])
+             for cl in (_msi_find_by_unit_keys.call_args,
+                        _msm_find_by_unit_keys.call_args)])
+
+        # Make sure existing units are associated in bulk, skipping the ones
+        # already associated
+        self.assertEquals(
+            [
+                mock.call([existing_units[0]], conduit.repo,
+                          skip_associated=True),
+                mock.call([existing_units[1]], conduit.repo,
+                          skip_associated=True),
+            ],
+            [mock.call(list(cl[0][0]), *cl[0][1:], **cl[1])
+             for cl in _bulk_associate.call_args_list])
+
+        # Downloads went through the staging area, and were discarded once
+        # imported
+        self.assertEquals(
+            [staging.JOURNAL_FILENAME],
+            os.listdir(os.path.join(self.pulp_working_dir,
+                                    staging.STAGING_DIRNAME, "repo1")))
+
+    def _sync_state_fixture(self, scratchpad, config=None):
+        repo = mock.MagicMock(repo_id="repo1")
+        conduit = mock.MagicMock(repo=repo)
+        conduit.get_scratchpad.return_value = scratchpad
+        worker_dir = os.path.join(self.pulp_working_dir, "worker01")
+        if not os.path.isdir(worker_dir):
+            os.makedirs(worker_dir)
+        with mock.patch("pulp.server.managers.repo._common.task.current") \
+                as _task_current:
+            _task_current.request.id = 'aabb'
+            _task_current.request.configure_mock(hostname="worker01")
+            reposync = sync.RepoSync(repo, conduit,
+                                     self.new_config(**(config or {})))
+        metadata_files = mock.MagicMock(
+            revision=1476732856,
+            metadata=dict(primary=dict(checksum="CSUM1")))
+        return reposync, metadata_files
+
+    @mock.patch("pulp_win.plugins.db.models.Package."
+                "repo_has_upstream_metadata", return_value=False)
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    def test_upstream_unchanged(self, _platform_models,
+                                _repo_has_upstream_metadata):
+        _platform_models.RepositoryContentUnit.objects.return_value.\
+            count.return_value = 3
+        url = "http://example.com/repo"
+        state = dict(feed=url, revision=1476732856,
+                     primary_checksum="CSUM1", content_count=3,
+                     **SYNC_OPTIONS)
+        scratchpad = {sync.SCRATCHPAD_SYNC_STATE: state}
+
+        reposync, metadata_files = self._sync_state_fixture(scratchpad)
+        self.assertTrue(reposync.upstream_unchanged(metadata_files, url))
+        _platform_models.RepositoryContentUnit.objects.assert_called_with(
+            repo_id="repo1")
+        # A different feed
+        self.assertFalse(reposync.upstream_unchanged(
+            metadata_files, "http://example.com/other"))
+        # The primary file changed
+        metadata_files.metadata['primary']['checksum'] = "CSUM2"
+        self.assertFalse(reposync.upstream_unchanged(metadata_files, url))
+        metadata_files.metadata['primary']['checksum'] = "CSUM1"
+        # Units were removed from the repository since
+        _platform_models.RepositoryContentUnit.objects.return_value.\
+            count.return_value = 2
+        self.assertFalse(reposync.upstream_unchanged(metadata_files, url))
+
+    @mock.patch("pulp_win.plugins.db.models.Package."
+                "repo_has_upstream_metadata", return_value=False)
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    def test_upstream_unchanged_options(self, _platform_models,
+                                        _repo_has_upstream_metadata):
+        _platform_models.RepositoryContentUnit.objects.return_value.\
+            count.return_value = 3
+        url = "http://example.com/repo"
+        state = dict(feed=url, revision=1476732856,
+                     primary_checksum="CSUM1", content_count=3,
+                     **SYNC_OPTIONS)
+        scratchpad = {sync.SCRATCHPAD_SYNC_STATE: state}
+        reposync, metadata_files = self._sync_state_fixture(scratchpad)
+        self.assertTrue(reposync.upstream_unchanged(metadata_files, url))
+        self.assertEquals(state, reposync._sync_state(metadata_files, url))
+
+        # Options that change what a sync does force a full one
+        for options in (dict(remove_missing=True),
+                        dict(trust_upstream_metadata=True),
+                        dict(metadata_backend="msidump")):
+            reposync, metadata_files = self._sync_state_fixture(
+                scratchpad, config=options)
+            self.assertFalse(reposync.upstream_unchanged(metadata_files, url))
+
+        # So do units whose metadata is still to be extracted
+        _repo_has_upstream_metadata.return_value = True
+        reposync, metadata_files = self._sync_state_fixture(scratchpad)
+        self.assertFalse(reposync.upstream_unchanged(metadata_files, url))
+        # Unless upstream metadata is trusted
+        state = dict(state, trust_upstream_metadata=True)
+        reposync, metadata_files = self._sync_state_fixture(
+            {sync.SCRATCHPAD_SYNC_STATE: state},
+            config=dict(trust_upstream_metadata=True))
+        self.assertTrue(reposync.upstream_unchanged(metadata_files, url))
+
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    def test_upstream_unchanged_no_state(self, _platform_models):
+        reposync, metadata_files = self._sync_state_fixture(None)
+        self.assertFalse(reposync.upstream_unchanged(
+            metadata_files, "http://example.com/repo"))
+        self.assertFalse(reposync.upstream_unchanged(
+            None, "http://example.com/repo"))
+
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    def test_upstream_unchanged_force_full_sync(self, _platform_models):
+        _platform_models.RepositoryContentUnit.objects.return_value.\
+            count.return_value = 3
+        url = "http://example.com/repo"
+        state = dict(feed=url, revision=1476732856,
+                     primary_checksum="CSUM1", content_count=3,
+                     **SYNC_OPTIONS)
+        reposync, metadata_files = self._sync_state_fixture(
+            {sync.SCRATCHPAD_SYNC_STATE: state},
+            config=dict(force_full_sync=True))
+        self.assertFalse(reposync.upstream_unchanged(metadata_files, url))
+
+    @mock.patch("pulp_win.plugins.db.models.Package."
+                "repo_has_upstream_metadata", return_value=False)
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    def test_download_repomd_conditional(self, _platform_models,
+                                         _repo_has_upstream_metadata):
+        _platform_models.RepositoryContentUnit.objects.return_value.\
+            count.return_value = 3
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RepomdHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:%d/repo/" % server.server_port
+
+        reposync, _ = self._sync_state_fixture(None, config=dict(feed=url))
+        dst_dir = os.path.join(self.work_dir, "sync1")
+        os.makedirs(dst_dir)
+        metadata_files = sync.metadata.MetadataFiles(
+            url, dst_dir, reposync.nectar_config)
+        self.assertFalse(reposync.download_repomd(metadata_files, url))
+        self.assertEquals(REPOMD_XML,
+                          open(os.path.join(dst_dir, "repomd.xml")).read())
+        self.assertEquals(
+            dict(etag=RepomdHandler.etag,
+                 last_modified=RepomdHandler.last_modified),
+            reposync.repomd_headers)
+        self.assertEquals(None, RepomdHandler.requests[-1])
+
+        # The next sync sends the headers back, and gets a 304
+        state = dict(feed=url, content_count=3, **reposync.repomd_headers)
+        state.update(SYNC_OPTIONS)
+        reposync.conduit.get_scratchpad.return_value = {
+            sync.SCRATCHPAD_SYNC_STATE: state}
+        dst_dir = os.path.join(self.work_dir, "sync2")
+        os.makedirs(dst_dir)
+        metadata_files = sync.metadata.MetadataFiles(
+            url, dst_dir, reposync.nectar_config)
+        self.assertTrue(reposync.download_repomd(metadata_files, url))
+        self.assertEquals(RepomdHandler.etag, RepomdHandler.requests[-1])
+        # Nothing was written
+        self.assertEquals([], os.listdir(dst_dir))
+
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    def test_download_repomd_url_modify(self, _platform_models):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RepomdHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:%d/repo/" % server.server_port
+
+        reposync, _ = self._sync_state_fixture(None, config=dict(feed=url))
+        reposync._url_modify = mock.MagicMock(
+            side_effect=lambda u: u + "?token=abc")
+        dst_dir = os.path.join(self.work_dir, "sync1")
+        os.makedirs(dst_dir)
+        metadata_files = sync.metadata.MetadataFiles(
+            url, dst_dir, reposync.nectar_config)
+        self.assertFalse(reposync.download_repomd(metadata_files, url))
+        self.assertEquals("/repo/repodata/repomd.xml?token=abc",
+                          RepomdHandler.paths[-1])
+
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    def test_save_sync_state(self, _platform_models):
+        reposync, _ = self._sync_state_fixture(dict(other="value"))
+        state = dict(feed="http://example.com/repo")
+        reposync.save_sync_state(state)
+        reposync.conduit.set_scratchpad.assert_called_once_with(
+            {"other": "value", sync.SCRATCHPAD_SYNC_STATE: state})
+
+        # Syncs that missed some units do not save the upstream state
+        reposync.conduit.set_scratchpad.reset_mock()
+        reposync.content_report['error_details'].append(
+            dict(filename="a-1.msi", error_message="checksum mismatch"))
+        reposync.save_sync_state(state)
+        reposync.conduit.set_scratchpad.assert_called_once_with(
+            {"other": "value", sync.SCRATCHPAD_SYNC_STATE: None})
+
+        reposync.conduit.set_scratchpad.reset_mock()
+        reposync.content_report['error_details'] = []
+        reposync.content_report['items_left'] = 1
+        reposync.save_sync_state(state)
+        reposync.conduit.set_scratchpad.assert_called_once_with(
+            {"other": "value", sync.SCRATCHPAD_SYNC_STATE: None})
+
+        # Nothing is saved for failed syncs
+        reposync.conduit.set_scratchpad.reset_mock()
+        reposync.content_report['state'] = sync.constants.STATE_FAILED
+        reposync.save_sync_state(state)
+        self.assertEquals(0, reposync.conduit.set_scratchpad.call_count)
+
+    @classmethod
+    def _new_reposync(cls, trust_upstream_metadata=False,
+                      trust_audit_rate=0.0):
+        return mock.MagicMock(trust_upstream_metadata=trust_upstream_metadata,
+                              trust_audit_rate=trust_audit_rate,
+                              num_processing_workers=1, concurrency=None,
+                              staging=None)
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    def test_download_succeeded_trusted(self, _from_files,
+                                        _download_succeeded):
+        file_path, checksum = self.new_file("a-1.msi")
+        unit = sync.UpstreamPackage(
+            sync.models.MSI,
+            dict(name='a', version='1', checksumtype='sha256',
+                 checksum=checksum, size=36, filename='a-1.msi',
+                 relativepath='a-1.msi', ProductCode='{PC}'))
+        reposync = self._new_reposync(trust_upstream_metadata=True)
+        metadata_files = mock.MagicMock()
+        listener = sync.CustomPackageListener(reposync, metadata_files)
+        listener.download_succeeded(
+            mock.MagicMock(data=unit, destination=file_path))
+        listener.flush()
+
+        # Nothing extracted from the file
+        self.assertEquals(0, _from_files.call_count)
+        self.assertEquals(1, reposync.add_units.call_count)
+        [(unit_dl, path)] = reposync.add_units.call_args[0][1]
+        self.assertEquals(file_path, path)
+        self.assertTrue(isinstance(unit_dl, sync.models.MSI))
+        self.assertEquals(
+            dict(name='a', version='1', checksumtype='sha256',
+                 checksum=checksum),
+            unit_dl.unit_key)
+        self.assertEquals('{PC}', unit_dl.ProductCode)
+        self.assertEquals(36, unit_dl.size)
+        # Marked as missing the fields primary.xml does not carry
+        self.assertEquals(sync.models.METADATA_SOURCE_UPSTREAM,
+                          unit_dl.metadata_source)
+        self.assertFalse(os.path.exists(file_path))
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    def test_download_succeeded_trusted_checksum_mismatch(
+            self, _from_files, _download_succeeded):
+        file_path, checksum = self.new_file("a-1.msi")
+        unit = sync.UpstreamPackage(
+            sync.models.MSI,
+            dict(name='a', version='1', checksumtype='sha256',
+                 checksum='doesnotmatch'))
+        reposync = self._new_reposync(trust_upstream_metadata=True)
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock())
+        listener.download_succeeded(
+            mock.MagicMock(data=unit, destination=file_path))
+        listener.flush()
+
+        reposync.add_units.assert_called_once_with(
+            listener.metadata_files, [])
+        # Reported as failed
+        reposync.progress_report['content'].failure.assert_called_once_with(
+            unit, dict(filename=None, error_message='checksum mismatch'))
+
+    @mock.patch("pulp_win.plugins.importers.sync._logger")
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    def test_download_succeeded_trusted_audit(self, _from_files,
+                                              _download_succeeded, _logger):
+        file_path, checksum = self.new_file("a-1.msi")
+        unit = sync.UpstreamPackage(
+            sync.models.MSI,
+            dict(name='a', version='1', checksumtype='sha256',
+                 checksum=checksum, ProductCode='{PC}'))
+        unit_dl = sync.models.MSI(name='a', version='1',
+                                  checksumtype='sha256', checksum=checksum,
+                                  ProductCode='{OTHER}')
+        unit_dl.checksums = dict(sha256=checksum)
+        _from_files.return_value = [
+            sync.models.FileResult(file_path, unit_dl, None)]
+        # Every unit gets audited
+        reposync = self._new_reposync(trust_upstream_metadata=True,
+                                      trust_audit_rate=1.0)
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock())
+        listener.download_succeeded(
+            mock.MagicMock(data=unit, destination=file_path))
+        listener.flush()
+
+        self.assertEquals(1, _from_files.call_count)
+        # The metadata from the file wins
+        reposync.add_units.assert_called_once_with(
+            listener.metadata_files, [(unit_dl, file_path)])
+        self.assertEquals(1, _logger.warning.call_count)
+        self.assertEquals(
+            ('ProductCode', '{OTHER}', '{PC}'),
+            _logger.warning.call_args[0][-3:])
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    def test_download_succeeded(self, _from_files, _download_succeeded):
+        file_path, checksum = self.new_file("a-1.msi")
+        unit = sync.UpstreamPackage(
+            sync.models.MSI,
+            dict(name='a', version='1', checksumtype='sha256',
+                 checksum=checksum))
+        unit_dl = sync.models.MSI(name='a', version='1',
+                                  checksumtype='sha256', checksum=checksum)
+        unit_dl.checksums = dict(sha256=checksum)
+        _from_files.return_value = [
+            sync.models.FileResult(file_path, unit_dl, None)]
+        reposync = self._new_reposync()
+        metadata_files = mock.MagicMock()
+        listener = sync.CustomPackageListener(reposync, metadata_files)
+        report = mock.MagicMock(data=unit, destination=file_path)
+
+        listener.download_succeeded(report)
+        listener.flush()
+
+        _from_files.assert_called_once_with(
+            [file_path], metadata_backend=reposync.metadata_backend,
+            metadata_cache=reposync.metadata_cache,
+            checksum_types=set(['sha256']), pool=None)
+        reposync.add_units.assert_called_once_with(
+            metadata_files, [(unit_dl, file_path)])
+        self.assertFalse(os.path.exists(file_path))
+        # Released once saved
+        reposync.download_registry.release.assert_called_once_with(
+            ("sha256", checksum))
+
+    @mock.patch("pulp_win.plugins.db.models.new_pool")
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    def test_download_succeeded_batch(self, _from_files, _download_succeeded,
+                                      _new_pool):
+        files = [self.new_file("a-%d.msi" % i) for i in range(3)]
+        units = dict()
+        upstream = dict()
+        for file_path, checksum in files:
+            unit_key = dict(name='a', version='1', checksumtype='sha256',
+                            checksum=checksum)
+            upstream[file_path] = sync.UpstreamPackage(sync.models.MSI,
+                                                       unit_key)
+            unit = sync.models.MSI(**unit_key)
+            unit.checksums = dict(sha256=checksum)
+            units[file_path] = unit
+        _from_files.side_effect = lambda paths, **kw: [
+            sync.models.FileResult(p, units[p], None) for p in paths]
+        reposync = self._new_reposync()
+        reposync.num_processing_workers = 2
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock())
+
+        for file_path, _ in files:
+            listener.download_succeeded(mock.MagicMock(
+                data=upstream[file_path], destination=file_path))
+        listener.flush()
+
+        # Whatever was queued is added in batches of at most batch_size
+        added = []
+        for args, _ in reposync.add_units.call_args_list:
+            self.assertTrue(len(args[1]) <= listener.batch_size)
+            added.extend(args[1])
+        self.assertEquals(
+            sorted((units[p], p) for p, _ in files), sorted(added))
+        # The pool is created on demand, and released when done
+        pool = _new_pool.return_value
+        _new_pool.assert_called_once_with(2)
+        for args, kwargs in _from_files.call_args_list:
+            self.assertEquals(pool, kwargs['pool'])
+        pool.close.assert_called_once_with()
+        pool.join.assert_called_once_with()
+        self.assertEquals(None, listener._pool)
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    def test_download_succeeded_checksum_mismatch(self, _from_files,
+                                                  _download_succeeded):
+        file_path, checksum = self.new_file("a-1.msi")
+        unit = sync.UpstreamPackage(
+            sync.models.MSI,
+            dict(name='a', version='1', checksumtype='sha256',
+                 checksum='doesnotmatch'))
+        unit_dl = sync.models.MSI(name='a', version='1',
+                                  checksumtype='sha256', checksum=checksum)
+        unit_dl.checksums = dict(sha256=checksum)
+        _from_files.return_value = [
+            sync.models.FileResult(file_path, unit_dl, None)]
+        reposync = self._new_reposync()
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock())
+        report = mock.MagicMock(data=unit, destination=file_path)
 
-        # Make sure existing units are associated with their ID
+        listener.download_succeeded(report)
+        listener.flush()
+
+        reposync.add_units.assert_called_once_with(
+            listener.metadata_files, [])
+        self.assertFalse(os.path.exists(file_path))
+        reposync.progress_report['content'].failure.assert_called_once_with(
+            unit, dict(filename=None, error_message='checksum mismatch'))
+
+    def _parse_primary(self):
+        return list(sync.package_list_generator(
+            StringIO.StringIO(REPODATA_PRIMARY_XML),
+            sync.RepoSync._process_package_element))
+
+    def test_package_list_generator(self):
+        units = self._parse_primary()
         self.assertEquals(
             [
-                mock.call(conduit.repo, existing_units[0]),
-                # The second call is for DDF, even though we return a SAD
-                mock.call(conduit.repo, existing_units[1]),
+                (sync.models.MSI, "a", "1.0", "sha256",
+                 "8158106e4b75399561fc30c6e486f3a78a3c221a1101dcf2edd0f1547c9bdd3f",  # noqa
+                 123, "a-1.msi", "a-1.0.msi"),
+                (sync.models.MSI, "existing", "1", "sha256", "existing1",
+                 42, "existing-1.msi", "existing-1.msi"),
+                (sync.models.MSM, "a", "1", "sha256",
+                 "befd9977547415cccf82ac4e7f573f9cec1730dd124499c0a8f03b79ad73bf6a",  # noqa
+                 123, "a-1.msm", "a-1.msm"),
+                (sync.models.MSM, "existing", "1", "sha256", "existing2",
+                 123, "existing-2.msm", "existing-1.msm"),
             ],
-            _repo_controller.associate_single_unit.call_args_list)
+            [(u.model_class, u.name, u.version, u.checksumtype, u.checksum,
+              u.size, u.relativepath, u.filename) for u in units])
 
-        # Don't rely on unit equality - ensure we're really using the same id
-        # This is unnecessary because the ID is checked first, but just to be
-        # sure.
+    def test_count_packages(self):
+        metadata_files = mock.MagicMock()
+        metadata_files.get_metadata_file_handle.return_value.__enter__.\
+            return_value = StringIO.StringIO(REPODATA_PRIMARY_XML)
         self.assertEquals(
-            [x.id for x in existing_units],
-            [x[0][1].id
-             for x in _repo_controller.associate_single_unit.call_args_list])
+            (dict(msi=2, msm=2), 411),
+            sync.RepoSync._count_packages(metadata_files))
+
+    def test_unit_pipeline(self):
+        pipeline = sync.UnitPipeline(lambda: iter(range(10)), 2)
+        pipeline.start()
+        self.assertEquals(range(10), list(pipeline))
+        pipeline.close()
+        pipeline.raise_error()
+
+    def test_unit_pipeline_error(self):
+        def produce():
+            yield 1
+            raise ValueError("boom")
+
+        pipeline = sync.UnitPipeline(produce, 2)
+        pipeline.start()
+        self.assertEquals([1], list(pipeline))
+        pipeline.close()
+        with self.assertRaises(ValueError):
+            pipeline.raise_error()
+
+    def test_update_content_prune(self):
+        reposync, metadata_files = self._sync_state_fixture({})
+        reposync.set_progress = mock.MagicMock()
+        reposync._count_packages = mock.MagicMock(return_value=({}, 0))
+        reposync.download_registry = mock.MagicMock()
+        staging_area = mock.MagicMock()
+
+        def download(metadata_files, units, url):
+            list(units)
+            return staging_area
+
+        reposync.download = mock.MagicMock(side_effect=download)
+        reposync._units_to_download = mock.MagicMock(return_value=iter([]))
+        reposync.update_content(metadata_files, "http://example.com/repo")
+        staging_area.prune.assert_called_once_with()
+
+        # Not after a cancel: the remaining units were not looked up
+        staging_area.reset_mock()
+        reposync.canceled = True
+        reposync._units_to_download.return_value = iter([])
+        reposync.update_content(metadata_files, "http://example.com/repo")
+        self.assertEquals(0, staging_area.prune.call_count)
+
+        # Nor when looking them up failed
+        reposync.canceled = False
+
+        def produce(*args):
+            raise ValueError("boom")
+            yield
+
+        reposync._units_to_download.side_effect = produce
+        with self.assertRaises(ValueError):
+            reposync.update_content(metadata_files,
+                                    "http://example.com/repo")
+        self.assertEquals(0, staging_area.prune.call_count)
+
+    def test_unit_pipeline_backpressure(self):
+        produced = []
+        first_blocked = threading.Event()
+
+        def produce():
+            for i in range(100):
+                produced.append(i)
+                if i == 3:
+                    first_blocked.set()
+                yield i
+
+        pipeline = sync.UnitPipeline(produce, 2)
+        pipeline.start()
+        self.assertEquals(0, next(iter(pipeline)))
+        first_blocked.wait(5)
+        # One consumed, two queued and one waiting to be queued
+        self.assertEquals(4, len(produced))
+        # Closing stops the producer
+        pipeline.close()
+        self.assertEquals(4, len(produced))
+
+    def test_batches(self):
+        self.assertEquals(
+            [[0, 1], [2, 3], [4]],
+            list(sync._batches(iter(range(5)), 2)))
+        self.assertEquals([], list(sync._batches([], 2)))
+
+    def test_upstream_package(self):
+        pkg = sync.UpstreamPackage(
+            sync.models.MSI,
+            dict(name="a", version="1", checksumtype="sha256",
+                 checksum="csum", size=42, relativepath="msi/a-1.msi",
+                 filename="a-1.msi", ProductCode="{PC}"))
+        self.assertEquals(
+            dict(name="a", version="1", checksumtype="sha256",
+                 checksum="csum"),
+            pkg.unit_key)
+        self.assertEquals(sync.models.MSI.TYPE_ID, pkg._content_type_id)
+        self.assertEquals("msi/a-1.msi", pkg.download_path)
+        self.assertFalse(hasattr(pkg, '__dict__'))
+
+        unit = pkg.to_unit()
+        self.assertTrue(isinstance(unit, sync.models.MSI))
+        self.assertEquals(pkg.unit_key, unit.unit_key)
+        self.assertEquals(pkg.unit_key_as_named_tuple,
+                          unit.unit_key_as_named_tuple)
+        self.assertEquals(
+            (42, "msi/a-1.msi", "a-1.msi", "{PC}"),
+            (unit.size, unit.relativepath, unit.filename, unit.ProductCode))
+
+    def test_content_report_skipped(self):
+        cr = ContentReport()
+        cr.set_initial_values(dict(msi=2, msm=1), 300)
+        cr.skipped(sync.models.MSI(name="a", version="1", size=100))
+        self.assertEquals(2, cr['items_total'])
+        self.assertEquals(2, cr['items_left'])
+        self.assertEquals(200, cr['size_total'])
+        self.assertEquals(200, cr['size_left'])
+        self.assertEquals(1, cr['details']['msi_total'])
+        self.assertEquals(1, cr['details']['msm_total'])
+
+    def test_content_report_threads(self):
+        cr = ContentReport()
+        cr.set_initial_values(dict(msi=4000), 4000)
+        unit = sync.models.MSI(name="a", version="1", size=1)
+
+        def count(update):
+            for i in range(1000):
+                update(unit)
+
+        threads = [
+            threading.Thread(target=count, args=(cr.skipped, )),
+            threading.Thread(target=count, args=(cr.success, )),
+            threading.Thread(target=count, args=(
+                lambda u: cr.failure(u, dict(error_message="boom")), )),
+            threading.Thread(target=count, args=(cr.success, )),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(0, cr['items_left'])
+        self.assertEquals(0, cr['size_left'])
+        self.assertEquals(3000, cr['items_total'])
+        self.assertEquals(3000, cr['details']['msi_done'])
+        self.assertEquals(1000, len(cr['error_details']))
+
+    @mock.patch("pulp_win.plugins.db.models.MSM.bulk_unassociate")
+    @mock.patch("pulp_win.plugins.db.models.MSM.repo_unit_key_digests")
+    @mock.patch("pulp_win.plugins.db.models.MSI.bulk_unassociate")
+    @mock.patch("pulp_win.plugins.db.models.MSI.repo_unit_key_digests")
+    def test_remove_missing_units(self, _msi_digests, _msi_unassociate,
+                                  _msm_digests, _msm_unassociate):
+        reposync, _ = self._sync_state_fixture(
+            {}, config=dict(remove_missing=True))
+        self.assertTrue(reposync.remove_missing)
+        upstream = [
+            sync.UpstreamPackage(
+                sync.models.MSI, dict(name='a', version=str(i),
+                                      checksumtype='sha256',
+                                      checksum='csum%d' % i))
+            for i in range(2)]
+        synced_unit_keys = set(u.unit_key_digest for u in upstream)
+        _msi_digests.return_value = [
+            ("id0", upstream[0].unit_key_digest),
+            ("id1", "gone"),
+            ("id2", upstream[1].unit_key_digest),
+            ("id3", "gone too"),
+        ]
+        _msm_digests.return_value = []
+        removed = []
+
+        def unassociate(unit_ids, repo):
+            unit_ids = list(unit_ids)
+            removed.extend(unit_ids)
+            return len(unit_ids)
+
+        _msi_unassociate.side_effect = unassociate
+        _msm_unassociate.side_effect = unassociate
+
+        self.assertEquals(
+            2, reposync.remove_missing_units(synced_unit_keys))
+        self.assertEquals(["id1", "id3"], removed)
+        _msi_digests.assert_called_once_with(reposync.conduit.repo)
+        self.assertEquals(2, reposync.content_report['details']['msi_removed'])
+        self.assertEquals(0, reposync.content_report['details']['msm_removed'])
+
+    @mock.patch("pulp_win.plugins.db.models.MSI.bulk_unassociate")
+    @mock.patch("pulp_win.plugins.db.models.MSI.repo_unit_key_digests")
+    @mock.patch("pulp_win.plugins.db.models.Package.bulk_save_and_associate")
+    @mock.patch("pulp_win.plugins.db.models.MSI.bulk_associate")
+    @mock.patch("pulp_win.plugins.db.models.MSI.find_by_unit_keys")
+    def test_remove_missing_units_sha1_feed(
+            self, _find_by_unit_keys, _bulk_associate,
+            _bulk_save_and_associate, _digests, _unassociate):
+        reposync, _ = self._sync_state_fixture(
+            {}, config=dict(remove_missing=True))
+        reposync.set_progress = mock.MagicMock()
+        reposync.synced_unit_keys = set()
+        # Upstream lists sha1 checksums; units are stored with sha256 ones
+        upstream = [
+            sync.UpstreamPackage(sync.models.MSI, dict(
+                name='a', version=str(i), checksumtype='sha1',
+                checksum='sha1-%d' % i, filename='a-%d.msi' % i))
+            for i in range(2)]
+        stored = [
+            sync.models.MSI(name='a', version=str(i), checksumtype='sha256',
+                            checksum='sha256-%d' % i, id='id%d' % i,
+                            size=10)
+            for i in range(2)]
+        # The first one is already in the database, the second one is
+        # downloaded
+        _find_by_unit_keys.return_value = dict(
+            [(upstream[0].unit_key_as_named_tuple, stored[0])])
+        to_download, _fileless = reposync._decide_what_to_download(upstream)
+        self.assertEquals(set([upstream[1]]), to_download)
+        _bulk_save_and_associate.side_effect = \
+            lambda units_and_paths, repo, **kwargs: [
+                u for u, _path in units_and_paths]
+        reposync.add_units(None, [(stored[1], '/tmp/a-1.msi')])
+
+        _digests.return_value = [
+            (u.id, u.unit_key_digest(u.unit_key)) for u in stored] + [
+            ('gone', 'gone')]
+        removed = []
+
+        def unassociate(unit_ids, repo):
+            unit_ids = list(unit_ids)
+            removed.extend(unit_ids)
+            return len(unit_ids)
+
+        _unassociate.side_effect = unassociate
+        with mock.patch("pulp_win.plugins.db.models.MSM."
+                        "repo_unit_key_digests", return_value=[]):
+            self.assertEquals(
+                1, reposync.remove_missing_units(reposync.synced_unit_keys))
+        self.assertEquals(['gone'], removed)
+
+    @mock.patch("pulp_win.plugins.db.models.MSI.save")
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    @mock.patch("pulp_win.plugins.db.models.MSI.bulk_associate")
+    @mock.patch("pulp_win.plugins.db.models.MSI.find_by_unit_keys")
+    def test_decide_what_to_download_complete_metadata(
+            self, _find_by_unit_keys, _bulk_associate, _from_files, _save):
+        reposync, _ = self._sync_state_fixture({})
+        reposync.set_progress = mock.MagicMock()
+        existing = [
+            sync.models.MSI(name="a", version=str(i), checksumtype="sha256",
+                            checksum="csum%d" % i, ProductCode="{PC}")
+            for i in range(2)]
+        existing[0].metadata_source = sync.models.METADATA_SOURCE_UPSTREAM
+        existing[0]._storage_path = "/storage/a-0.msi"
+        units = [
+            sync.UpstreamPackage(sync.models.MSI, dict(
+                name=u.name, version=u.version, checksumtype="sha256",
+                checksum=u.checksum))
+            for u in existing]
+        _find_by_unit_keys.return_value = dict(
+            (u.unit_key_as_named_tuple, u) for u in existing)
+        extracted = sync.models.MSI(
+            name="a", version="0", checksumtype="sha256", checksum="csum0",
+            ProductCode="{PC}", Manufacturer="Acme",
+            ModuleSignature=[dict(name="m", guid="G", version="1")])
+        _from_files.return_value = [sync.models.FileResult(
+            "/storage/a-0.msi", extracted, None)]
+
+        self.assertEquals((set(), set()),
+                          reposync._decide_what_to_download(units))
+
+        # Only the unit created from upstream metadata is extracted again
+        self.assertEquals(["/storage/a-0.msi"], _from_files.call_args[0][0])
+        self.assertEquals("Acme", existing[0].Manufacturer)
+        self.assertEquals(extracted.ModuleSignature,
+                          existing[0].ModuleSignature)
+        self.assertEquals(None, existing[0].metadata_source)
+        self.assertEquals(1, _save.call_count)
+
+        # Not while upstream metadata is trusted
+        _from_files.reset_mock()
+        existing[1].metadata_source = sync.models.METADATA_SOURCE_UPSTREAM
+        reposync.trust_upstream_metadata = True
+        reposync._decide_what_to_download(units)
+        self.assertEquals(0, _from_files.call_count)
+
+    def test_remove_missing_default(self):
+        reposync, _ = self._sync_state_fixture({})
+        self.assertFalse(reposync.remove_missing)
+
+    def test_units_downloaded_elsewhere(self):
+        reposync, _ = self._sync_state_fixture({})
+        reposync.download_registry = mock.MagicMock()
+        units = [
+            sync.UpstreamPackage(sync.models.MSI, dict(
+                name='a', version=str(i), checksumtype='sha256',
+                checksum='csum%d' % i))
+            for i in range(2)]
+        # The first one was saved by the other sync, the second one failed
+        reposync._decide_what_to_download = mock.MagicMock(
+            return_value=(set(units[1:]), set()))
+
+        self.assertEquals(
+            units[1:], list(reposync._units_downloaded_elsewhere(units)))
+        self.assertEquals(
+            [mock.call(("sha256", "csum0"), cancel=None),
+             mock.call(("sha256", "csum1"), cancel=None)],
+            reposync.download_registry.wait.call_args_list)
+        reposync._decide_what_to_download.assert_called_once_with(units)
+        # Claimed by the caller
+        self.assertEquals(0, reposync.download_registry.claim.call_count)
+
+        # Nothing more once the pipeline is closed
+        stopped = threading.Event()
+        stopped.set()
+        self.assertEquals(
+            [], list(reposync._units_downloaded_elsewhere(units, stopped)))
+        self.assertEquals(
+            mock.call(("sha256", "csum1"), cancel=stopped),
+            reposync.download_registry.wait.call_args)
+        self.assertEquals(1, reposync._decide_what_to_download.call_count)
+
+    def test_claimed(self):
+        reposync, _ = self._sync_state_fixture({})
+        reposync.download_registry = mock.MagicMock()
+        units = [
+            sync.UpstreamPackage(sync.models.MSI, dict(
+                name='a', version=str(i), checksumtype='sha256',
+                checksum='csum%d' % i))
+            for i in range(3)]
+        claims = {
+            ("sha256", "csum0"): [True],
+            # Claimed by another sync, then by a third one while waiting
+            ("sha256", "csum1"): [False, False, True],
+            ("sha256", "csum2"): [True],
+        }
+        reposync.download_registry.claim.side_effect = \
+            lambda key: claims[key].pop(0)
+        waited = []
+
+        def downloaded_elsewhere(units, stopped):
+            waited.append(list(units))
+            return iter(units)
+
+        reposync._units_downloaded_elsewhere = mock.MagicMock(
+            side_effect=downloaded_elsewhere)
+        stopped = threading.Event()
+        self.assertEquals(
+            [units[0], units[2], units[1]],
+            list(reposync._claimed(iter(units), stopped)))
+        self.assertEquals([units[1:2], units[1:2]], waited)
+        self.assertEquals(stopped, reposync._units_downloaded_elsewhere.
+                          call_args[0][1])
+        self.assertEquals(dict((k, []) for k in claims), claims)
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_failed")  # noqa
+    def test_download_failed_releases(self, _download_failed):
+        unit = sync.UpstreamPackage(sync.models.MSI, dict(
+            name='a', version='1', checksumtype='sha256', checksum='csum'))
+        reposync = self._new_reposync()
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock())
+        report = mock.MagicMock(data=unit)
+        listener.download_failed(report)
+        listener.flush()
+        reposync.download_registry.release.assert_called_once_with(
+            ("sha256", "csum"))
+        _download_failed.assert_called_once_with(report)
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_failed")  # noqa
+    def test_download_failed_releases_slot(self, _download_failed):
+        unit = sync.UpstreamPackage(sync.models.MSI, dict(
+            name='a', version='1', checksumtype='sha256', checksum='csum'))
+        reposync = self._new_reposync()
+        reposync.concurrency = mock.MagicMock(limit=3)
+        reposync.concurrency.release.return_value = True
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock())
+        start = datetime.datetime(2016, 1, 1)
+        report = mock.MagicMock(
+            data=unit, bytes_downloaded=100, start_time=start,
+            finish_time=start + datetime.timedelta(seconds=2))
+        listener.download_failed(report)
+        listener.flush()
+        reposync.concurrency.release.assert_called_once_with(
+            100, 2.0, failed=True)
+        reposync.content_report.concurrency.assert_called_once_with(3)
+
+        # Files from local feeds did not take a download slot
+        reposync.concurrency.reset_mock()
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock(),
+                                              in_place=True)
+        listener.download_failed(report)
+        listener.flush()
+        self.assertFalse(reposync.concurrency.release.called)
+
+    def _group_fixture(self, scratchpads=({}, {}), configs=(None, None)):
+        syncs = []
+        for idx, (scratchpad, config) in enumerate(zip(scratchpads, configs)):
+            reposync, metadata_files = self._sync_state_fixture(scratchpad,
+                                                                config)
+            reposync.conduit.repo.repo_id = "repo%d" % (idx + 1)
+            syncs.append(reposync)
+        return sync.RepoSync.grouped(syncs), syncs, metadata_files
+
+    def test_grouped(self):
+        leader, syncs, _ = self._group_fixture()
+        self.assertEquals(syncs[0], leader)
+        self.assertEquals(syncs, leader.members)
+        self.assertEquals([s.conduit.repo for s in syncs], leader.repos)
+        # Progress is reported for the whole group
+        self.assertTrue(syncs[1].content_report is leader.content_report)
+        self.assertTrue(syncs[1].progress_report is leader.progress_report)
+
+        other, _ = self._sync_state_fixture(
+            {}, config=dict(feed="http://example.com/other"))
+        self.assertRaises(ValueError, sync.RepoSync.grouped,
+                          [syncs[0], other])
+
+    @mock.patch("pulp_win.plugins.db.models.MSI.bulk_associate")
+    @mock.patch("pulp_win.plugins.db.models.MSI.find_by_unit_keys")
+    def test_grouped_decide_what_to_download(self, _find_by_unit_keys,
+                                             _bulk_associate):
+        leader, syncs, _ = self._group_fixture()
+        leader.set_progress = mock.MagicMock()
+        units = [
+            sync.UpstreamPackage(sync.models.MSI, dict(
+                name='a', version=str(i), checksumtype='sha256',
+                checksum='csum%d' % i, filename='a-%d.msi' % i, size=1))
+            for i in range(2)]
+        existing = units[0].to_unit()
+        _find_by_unit_keys.return_value = {
+            existing.unit_key_as_named_tuple: existing}
+
+        to_download, fileless = leader._decide_what_to_download(units)
+        self.assertEquals(set(units[1:]), to_download)
+        # The existing unit is associated with all the repositories
+        self.assertEquals(
+            [mock.call([existing], s.conduit.repo, skip_associated=True)
+             for s in syncs],
+            _bulk_associate.call_args_list)
+
+    @mock.patch("pulp_win.plugins.db.models.Package.bulk_associate")
+    @mock.patch("pulp_win.plugins.db.models.Package.bulk_save_and_associate")
+    def test_grouped_add_units(self, _bulk_save_and_associate,
+                               _bulk_associate):
+        leader, syncs, _ = self._group_fixture()
+        leader.set_progress = mock.MagicMock()
+        unit = sync.models.MSI(name='a', version='1', checksumtype='sha256',
+                               checksum='csum', size=1)
+        _bulk_save_and_associate.return_value = [unit]
+
+        self.assertEquals([unit], leader.add_units(
+            mock.MagicMock(), [(unit, "/a-1.msi")]))
+        _bulk_save_and_associate.assert_called_once_with(
+            [(unit, "/a-1.msi")], syncs[0].conduit.repo, link_content=True)
+        _bulk_associate.assert_called_once_with(
+            [unit], syncs[1].conduit.repo)
+
+    @mock.patch("pulp_win.plugins.db.models.Package."
+                "repo_has_upstream_metadata", return_value=False)
+    @mock.patch("pulp_win.plugins.importers.sync.platform_models")
+    def test_grouped_previous_sync_state(self, _platform_models,
+                                         _repo_has_upstream_metadata):
+        _platform_models.RepositoryContentUnit.objects.return_value.\
+            count.return_value = 3
+        url = "http://example.com/repo"
+        state = dict(feed=url, revision=1476732856, primary_checksum="CSUM1",
+                     content_count=3, etag='"abc"', last_modified=None,
+                     **SYNC_OPTIONS)
+        scratchpad = {sync.SCRATCHPAD_SYNC_STATE: state}
+
+        leader, _, metadata_files = self._group_fixture(
+            (scratchpad, dict(scratchpad)))
+        self.assertEquals(state, leader._group_previous_sync_state(url))
+        self.assertTrue(leader.upstream_unchanged(metadata_files, url))
+
+        # A repository that was never synced
+        leader, _, metadata_files = self._group_fixture((scratchpad, {}))
+        self.assertEquals(None, leader._group_previous_sync_state(url))
+        self.assertFalse(leader.upstream_unchanged(metadata_files, url))
+
+        # Repositories last synced from different upstream revisions
+        other_state = dict(state, etag='"def"')
+        leader, _, _ = self._group_fixture(
+            (scratchpad, {sync.SCRATCHPAD_SYNC_STATE: other_state}))
+        self.assertEquals(None, leader._group_previous_sync_state(url))
+
+    @mock.patch("pulp_win.plugins.db.models.MSM.repo_unit_key_digests")
+    @mock.patch("pulp_win.plugins.db.models.MSI.bulk_unassociate")
+    @mock.patch("pulp_win.plugins.db.models.MSI.repo_unit_key_digests")
+    def test_grouped_remove_missing_units(self, _msi_digests,
+                                          _msi_unassociate, _msm_digests):
+        leader, syncs, _ = self._group_fixture(
+            configs=(None, dict(remove_missing=True)))
+        _msi_digests.return_value = [("id1", "gone")]
+        _msm_digests.return_value = []
+        _msi_unassociate.side_effect = lambda ids, repo: len(list(ids))
+
+        self.assertEquals(1, leader.remove_missing_units(set()))
+        # Only from the repository asking for it
+        _msi_digests.assert_called_once_with(syncs[1].conduit.repo)
+
+    def test_local_feed_dir(self):
+        feed_dir = os.path.join(self.work_dir, "feed")
+        os.makedirs(feed_dir)
+        self.assertEquals(
+            feed_dir, sync.RepoSync.local_feed_dir("file://%s/" % feed_dir))
+        self.assertEquals(
+            None, sync.RepoSync.local_feed_dir("http://example.com/feed/"))
+        self.assertEquals(
+            None, sync.RepoSync.local_feed_dir("file://%s/missing/" %
+                                               feed_dir))
+
+    def test_get_metadata_local(self):
+        feed_dir = os.path.join(self.work_dir, "feed")
+        os.makedirs(os.path.join(feed_dir, "repodata"))
+        primary_path = os.path.join(feed_dir, "repodata", "CSUM1-primary.xml")
+        with open(primary_path, "w") as fobj:
+            fobj.write(REPODATA_PRIMARY_XML)
+        reposync, metadata_files = self._sync_state_fixture({})
+        metadata_files.repo_url = "file://%s/" % feed_dir
+        metadata_files.metadata = dict(
+            primary=dict(relative_path="repodata/CSUM1-primary.xml"))
+
+        self.assertEquals(metadata_files,
+                          reposync.get_metadata(metadata_files))
+        # Read in place, not downloaded
+        self.assertEquals(primary_path,
+                          metadata_files.metadata['primary']['local_path'])
+        self.assertEquals(0, metadata_files.download_metadata_files.call_count)
+
+        metadata_files.metadata['other'] = dict(
+            relative_path="repodata/other.xml")
+        self.assertRaises(IOError, reposync.get_metadata, metadata_files)
+
+    def test_import_local_units(self):
+        feed_dir = os.path.join(self.work_dir, "feed")
+        os.makedirs(feed_dir)
+        file_path = os.path.join(feed_dir, "a-1.msi")
+        with open(file_path, "w") as fobj:
+            fobj.write("a-1")
+        with open(os.path.join(self.work_dir, "outside.msi"), "w") as fobj:
+            fobj.write("outside")
+        units = [
+            sync.UpstreamPackage(sync.models.MSI, dict(
+                name='a', version='1', relativepath=relativepath))
+            for relativepath in ("a-1.msi", "b-1.msi", "../outside.msi")]
+        reposync, _ = self._sync_state_fixture({})
+        listener = mock.MagicMock()
+
+        reposync.import_local_units(feed_dir, units, listener)
+        [report] = [
+            x[0][0] for x in listener.download_succeeded.call_args_list]
+        self.assertEquals((units[0], file_path),
+                          (report.data, report.destination))
+        self.assertEquals(
+            units[1:],
+            [x[0][0].data for x in listener.download_failed.call_args_list])
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    def test_download_succeeded_in_place(self, _from_files,
+                                         _download_succeeded):
+        file_path, checksum = self.new_file("a-1.msi")
+        unit = sync.UpstreamPackage(
+            sync.models.MSI,
+            dict(name='a', version='1', checksumtype='sha256',
+                 checksum=checksum))
+        unit_dl = sync.models.MSI(name='a', version='1',
+                                  checksumtype='sha256', checksum=checksum)
+        unit_dl.checksums = dict(sha256=checksum)
+        _from_files.return_value = [
+            sync.models.FileResult(file_path, unit_dl, None)]
+        reposync = self._new_reposync()
+        metadata_files = mock.MagicMock()
+        listener = sync.CustomPackageListener(reposync, metadata_files,
+                                              in_place=True)
+        listener.download_succeeded(
+            mock.MagicMock(data=unit, destination=file_path))
+        listener.flush()
+
+        reposync.add_units.assert_called_once_with(
+            metadata_files, [(unit_dl, file_path)])
+        # Files from a local feed are left alone
+        self.assertTrue(os.path.exists(file_path))
+
+    def _staged_fixture(self):
+        reposync, _ = self._sync_state_fixture({}, config=dict(
+            segmented_download_threshold=50, download_segments=2))
+        reposync._url_modify = lambda url: url
+        reposync.staging = staging.StagingArea(
+            os.path.join(self.work_dir, "staging"))
+        self.addCleanup(reposync.staging.close)
+        units = [
+            sync.UpstreamPackage(sync.models.MSI, dict(
+                name=name, version='1', checksumtype='sha256',
+                checksum='csum-' + name, size=size,
+                relativepath='sub/%s-1.msi' % name))
+            for name, size in (("a", 4), ("b", 4), ("c", 4), ("d", 100))]
+        return reposync, units
+
+    def test_staged_units(self):
+        reposync, units = self._staged_fixture()
+        # b was downloaded, c partially, by a sync that did not finish
+        for unit, data in zip(units[1:3], ("0123", "01")):
+            path = reposync.staging.start(unit)
+            with open(path, "wb") as fobj:
+                fobj.write(data)
+        listener = mock.MagicMock()
+        range_downloads = mock.MagicMock()
+        reposync.range_slots = mock.MagicMock()
+        url = "http://example.com/repo"
+
+        self.assertEquals(
+            units[:1], list(reposync._staged_units(url, units, listener,
+                                                   range_downloads)))
+        # A slot is taken for each range download queued
+        self.assertEquals(2, reposync.range_slots.acquire.call_count)
+        [report] = [
+            x[0][0] for x in listener.download_succeeded.call_args_list]
+        self.assertTrue(isinstance(report, sync.StagedReport))
+        self.assertEquals(
+            (units[1], "http://example.com/repo/sub/b-1.msi",
+             os.path.join(reposync.staging.path, "b-1.msi")),
+            (report.data, report.url, report.destination))
+        segments = [[0, 50, 0], [50, 100, 50]]
+        self.assertEquals(
+            [
+                mock.call(reposync._range_download, (
+                    url, units[2],
+                    os.path.join(reposync.staging.path, "c-1.msi"), 2, None,
+                    listener)),
+                # Large enough to be downloaded in segments
+                mock.call(reposync._range_download, (
+                    url, units[3],
+                    os.path.join(reposync.staging.path, "d-1.msi"), 0,
+                    segments, listener)),
+            ],
+            range_downloads.apply_async.call_args_list)
+        self.assertEquals(
+            segments,
+            reposync.staging._entries["d-1.msi"]["segments"])
+
+    def test_range_download(self):
+        reposync, units = self._staged_fixture()
+        reposync.range_downloader = mock.MagicMock()
+        reposync.range_downloader.fetch.return_value = 4
+        listener = mock.MagicMock()
+        url = "http://example.com/repo/"
+        path = os.path.join(reposync.staging.path, "c-1.msi")
+        reposync.range_slots = mock.MagicMock()
+
+        reposync._range_download(url, units[2], path, 2, None, listener)
+        self.assertEquals(1, reposync.range_slots.release.call_count)
+        [report] = [
+            x[0][0] for x in listener.download_succeeded.call_args_list]
+        self.assertEquals((units[2], 2), (report.data,
+                                          report.bytes_downloaded))
+        self.assertEquals(
+            ("http://example.com/repo/sub/c-1.msi", path, 2),
+            reposync.range_downloader.fetch.call_args[0])
+
+        reposync.range_downloader.fetch.side_effect = IOError("HTTP 500")
+        reposync._range_download(url, units[2], path, 2, None, listener)
+        [report] = [x[0][0] for x in listener.download_failed.call_args_list]
+        self.assertEquals("HTTP 500", report.error_msg)
+
+    def test_range_download_segmented(self):
+        reposync, units = self._staged_fixture()
+        reposync.range_downloader = mock.MagicMock()
+        reposync.range_downloader.fetch_segmented.return_value = 100
+        listener = mock.MagicMock()
+        url = "http://example.com/repo/"
+        path = reposync.staging.start(units[3], [[0, 50, 0], [50, 100, 50]])
+        segments = [[0, 50, 20], [50, 100, 50]]
+
+        reposync._range_download(url, units[3], path, 20, segments, listener)
+        [report] = [
+            x[0][0] for x in listener.download_succeeded.call_args_list]
+        self.assertEquals(80, report.bytes_downloaded)
+        self.assertEquals(
+            ("http://example.com/repo/sub/d-1.msi", path, 100, segments),
+            reposync.range_downloader.fetch_segmented.call_args[0])
+        self.assertFalse(reposync.range_downloader.fetch.called)
+
+        # The server does not support Range: download in one piece
+        reposync.range_downloader.fetch_segmented.side_effect = \
+            sync.ranged.RangeNotSupported("no")
+        reposync.range_downloader.fetch.return_value = 100
+        reposync._range_download(url, units[3], path, 20, segments, listener)
+        self.assertEquals(
+            ("http://example.com/repo/sub/d-1.msi", path, 0),
+            reposync.range_downloader.fetch.call_args[0])
+        self.assertEquals(
+            None, reposync.staging._entries["d-1.msi"]["segments"])
+        self.assertEquals(
+            100, listener.download_succeeded.call_args[0][0].bytes_downloaded)
+
+    def test_mirror_set(self):
+        feed_dir = os.path.join(self.work_dir, "feed")
+        os.makedirs(feed_dir)
+        feeds = ["http://m1/repo/", "http://m2/repo", "file://%s/" % feed_dir]
+        reposync, _ = self._sync_state_fixture({}, config=dict(
+            stripe_mirrors=True))
+        with mock.patch.object(sync.RepoSync, "sync_feed",
+                               new_callable=mock.PropertyMock) as _sync_feed:
+            _sync_feed.return_value = feeds
+            # Metadata came from the second mirror; local feeds are left out
+            self.assertEquals(
+                ["http://m2/repo/", "http://m1/repo/"],
+                [m.url for m in reposync.mirror_set(feeds[1]).mirrors])
+
+            _sync_feed.return_value = feeds[:1]
+            self.assertEquals(None, reposync.mirror_set(feeds[0]))
+
+            # Off by default
+            _sync_feed.return_value = feeds
+            reposync, _ = self._sync_state_fixture({})
+            self.assertEquals(None, reposync.mirror_set(feeds[0]))
+
+    @mock.patch("pulp_win.plugins.importers.sync.time.time")
+    @mock.patch("pulp_win.plugins.importers.sync.nectar_threaded")
+    @mock.patch("pulp_win.plugins.importers.sync.probe.probe")
+    def test_ordered_feed(self, _probe, _nectar_threaded, _time):
+        feeds = ["http://m1/repo/", "http://m2/repo/", "http://m3/repo/"]
+        _probe.return_value = [
+            probe.ProbeResult(feeds[0], 0.1, "1476732856"),
+            probe.ProbeResult(feeds[1], error="timed out"),
+            probe.ProbeResult(feeds[2], 0.3, "1476732900"),
+        ]
+        _time.return_value = 1000
+        scratchpad = {}
+        reposync, _ = self._sync_state_fixture(scratchpad, config=dict(
+            probe_mirrors=True))
+        reposync.conduit.set_scratchpad.side_effect = scratchpad.update
+        with mock.patch.object(sync.RepoSync, "sync_feed",
+                               new_callable=mock.PropertyMock) as _sync_feed:
+            _sync_feed.return_value = feeds
+            ranking = [feeds[2], feeds[0], feeds[1]]
+            self.assertEquals(ranking, reposync.ordered_feed())
+            _probe.assert_called_once_with(
+                _nectar_threaded.build_session.return_value, feeds,
+                url_modify=reposync._url_modify)
+            self.assertEquals(
+                dict(feed=feeds, probed_at=1000, ranking=ranking),
+                scratchpad[sync.SCRATCHPAD_MIRROR_RANKING])
+
+            # Within the TTL, the ranking is reused
+            _time.return_value = 1000 + 3599
+            self.assertEquals(ranking, reposync.ordered_feed())
+            self.assertEquals(1, _probe.call_count)
+
+            # Not once it expired, nor for a different feed
+            _time.return_value = 1000 + 3600
+            reposync.ordered_feed()
+            self.assertEquals(2, _probe.call_count)
+            _sync_feed.return_value = feeds[:2]
+            reposync.ordered_feed()
+            self.assertEquals(3, _probe.call_count)
+
+            # A single mirror is not probed
+            _sync_feed.return_value = feeds[:1]
+            self.assertEquals(feeds[:1], reposync.ordered_feed())
+            self.assertEquals(3, _probe.call_count)
+
+            # Off by default
+            _sync_feed.return_value = feeds
+            reposync, _ = self._sync_state_fixture({})
+            self.assertEquals(feeds, reposync.ordered_feed())
+            self.assertEquals(3, _probe.call_count)
+
+    def _mirrors_fixture(self):
+        reposync, units = self._staged_fixture()
+        urls = ["http://m1/repo/", "http://m2/repo/"]
+        reposync.mirrors = mock.MagicMock()
+        reposync.mirrors.__len__.return_value = len(urls)
+        reposync.mirrors.choose.side_effect = lambda exclude: [
+            u for u in urls if u not in exclude][0]
+        reposync.range_downloader = mock.MagicMock()
+        return reposync, units
+
+    def test_staged_units_mirrors(self):
+        reposync, units = self._mirrors_fixture()
+        range_downloads = mock.MagicMock()
+        listener = mock.MagicMock()
+        url = "http://m1/repo/"
+        # Striped: nothing is left for nectar
+        self.assertEquals([], list(reposync._staged_units(
+            url, units[:1], listener, range_downloads)))
+        range_downloads.apply_async.assert_called_once_with(
+            reposync._range_download,
+            (url, units[0], os.path.join(reposync.staging.path, "a-1.msi"),
+             0, None, listener))
+
+    def test_range_download_mirrors(self):
+        reposync, units = self._mirrors_fixture()
+        listener = mock.MagicMock()
+        path = reposync.staging.start(units[2])
+        with open(path, "wb") as fobj:
+            fobj.write("01")
+        reposync.staging.checkpoint(path, 2)
+        reposync.range_downloader.fetch.side_effect = [IOError("HTTP 503"), 4]
+
+        reposync._range_download("http://m1/repo/", units[2], path, 2, None,
+                                 listener)
+        # Resumed on the other mirror
+        self.assertEquals(
+            [("http://m1/repo/sub/c-1.msi", path, 2),
+             ("http://m2/repo/sub/c-1.msi", path, 2)],
+            [x[0] for x in reposync.range_downloader.fetch.call_args_list])
+        self.assertEquals(
+            [("http://m1/repo/", 0, None), ("http://m2/repo/", 2)],
+            [x[0][:3] if x[1] else x[0][:2]
+             for x in reposync.mirrors.record.call_args_list])
+        [report] = [
+            x[0][0] for x in listener.download_succeeded.call_args_list]
+        self.assertEquals(2, report.bytes_downloaded)
+        self.assertFalse(listener.download_failed.called)
+
+        # Not the file primary.xml lists, on either mirror
+        reposync.range_downloader.fetch.reset_mock()
+        reposync.range_downloader.fetch.side_effect = None
+        reposync.range_downloader.fetch.return_value = 5
+        reposync._range_download("http://m1/repo/", units[2], path, 2, None,
+                                 listener)
+        # Started over on the second mirror
+        self.assertEquals(
+            [2, 0],
+            [x[0][2] for x in reposync.range_downloader.fetch.call_args_list])
+        [report] = [x[0][0] for x in listener.download_failed.call_args_list]
+        self.assertTrue("expected 4" in report.error_msg)
+
+    def test_range_download_unexpected_error(self):
+        reposync, units = self._mirrors_fixture()
+        reposync.download_registry = mock.MagicMock()
+        listener = mock.MagicMock()
+        path = reposync.staging.start(units[2])
+        reposync.mirrors.choose.side_effect = ValueError("boom")
+
+        reposync._range_download("http://m1/repo/", units[2], path, 0, None,
+                                 listener)
+        # Still reported, so the download slot and the claim are released
+        [report] = [x[0][0] for x in listener.download_failed.call_args_list]
+        self.assertEquals(units[2], report.data)
+        self.assertEquals("boom", report.error_msg)
+        reposync.download_registry.release.assert_called_once_with(
+            units[2].download_key)
+
+        # Not twice, if the listener is what failed
+        listener.reset_mock()
+        reposync.mirrors.choose.side_effect = None
+        reposync.mirrors.choose.return_value = "http://m1/repo/"
+        reposync.range_downloader.fetch.return_value = 4
+        listener.download_succeeded.side_effect = ValueError("boom")
+        reposync._range_download("http://m1/repo/", units[2], path, 0, None,
+                                 listener)
+        self.assertFalse(listener.download_failed.called)
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    def test_download_succeeded_staged(self, _download_succeeded):
+        unit = sync.UpstreamPackage(sync.models.MSI, dict(
+            name='a', version='1', checksumtype='sha256', checksum='csum'))
+        reposync = self._new_reposync()
+        reposync.staging = mock.MagicMock()
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock())
+        listener._process = mock.MagicMock()
+        report = mock.MagicMock(data=unit, destination="/staging/a-1.msi")
+
+        listener.download_succeeded(report)
+        # Not before the checksum is verified, while processing
+        self.assertEquals(0, reposync.staging.verified.call_count)
+
+        _download_succeeded.side_effect = \
+            sync.verification.VerificationException("bad")
+        listener.download_succeeded(report)
+        reposync.staging.discard.assert_called_once_with("/staging/a-1.msi")
+        listener.flush()
+
+    @mock.patch("pulp_win.plugins.importers.sync.PackageListener.download_succeeded")  # noqa
+    @mock.patch("pulp_win.plugins.db.models.MSI.from_files")
+    def test_process_staged(self, _from_files, _download_succeeded):
+        paths = [self.new_file("%s-1.msi" % name) for name in ("a", "b")]
+        units = [
+            sync.UpstreamPackage(sync.models.MSI, dict(
+                name=name, version='1', checksumtype='sha256',
+                checksum=checksum))
+            for name, (_path, checksum) in zip(("a", "b"), paths)]
+        # b is corrupted
+        units[1].checksum = 'doesnotmatch'
+        results = []
+        for name, (path, checksum) in zip(("a", "b"), paths):
+            unit_dl = sync.models.MSI(name=name, version='1',
+                                      checksumtype='sha256',
+                                      checksum=checksum)
+            unit_dl.checksums = dict(sha256=checksum)
+            results.append(sync.models.FileResult(path, unit_dl, None))
+        _from_files.return_value = results
+        reposync = self._new_reposync()
+        reposync.staging = mock.MagicMock()
+        listener = sync.CustomPackageListener(reposync, mock.MagicMock())
+
+        listener._process([(unit, path)
+                           for unit, (path, _checksum) in zip(units, paths)])
+        reposync.staging.verified.assert_called_once_with(paths[0][0])
+        reposync.staging.discard.assert_called_once_with(paths[1][0])
+        listener.flush()
 
     def test_content_report_set_initial_values(self):
         cr = ContentReport()
@@ -193,6 +1546,36 @@ class TestSync(testbase.TestCase):
         self.assertEquals(0, cr['details']['msi_total'])
 
 
+class RepomdHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves REPOMD_XML, honoring If-None-Match
+    """
+    etag = '"5808f4b8-1f6"'
+    last_modified = 'Mon, 17 Oct 2016 19:34:16 GMT'
+    # The If-None-Match header of each request
+    requests = []
+    # The path of each request
+    paths = []
+
+    def do_GET(self):
+        if_none_match = self.headers.get('If-None-Match')
+        self.requests.append(if_none_match)
+        self.paths.append(self.path)
+        if if_none_match == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', self.last_modified)
+        self.send_header('Content-Length', str(len(REPOMD_XML)))
+        self.end_headers()
+        self.wfile.write(REPOMD_XML)
+
+    def log_message(self, *args):
+        pass
+
+
 REPOMD_XML = """\
 <?xml version="1.0" encoding="UTF-8"?>
 <repomd xmlns="http://linux.duke.edu/metadata/repo"